@@ -0,0 +1,213 @@
+'''
+Interval index of the stimulus epochs of a recording
+
+getPatches.m pairs the ON and OFF lines of the log into patches and Jailstat.m loops over all the patches for every
+video to set the frame masks. An EpochIndex keeps the epochs as sorted arrays of (start, end, kind, channel,
+parameters), so the queries over whole arrays of times are a few searchsorted calls:
+    overlapping(t0, t1): the epochs overlapping each interval [t0, t1]
+    active(times): the epoch running at each time, e.g. at each frame of a video
+    masks(times): a boolean mask per kind of epoch, e.g. onConstLED, onLooming, onPulsing of Jailstat.m, in one pass
+
+The kinds of epochs are those of getPatches.m:
+    'Constant LED': "Light ON" to "Light OFF" (LED_switch, LED_timer)
+    'Looming': "Starting playing time" to "Done playing time" of a video, parameter rv (r/v)
+    'Pulse': "Pulsing ON" to "Pulsing OFF" (LED_pulse), parameters frequency (Hz) and pulse_width (ms)
+An epoch starts at the first ON line after the previous OFF line of its kind and LED channel, an ON line without OFF
+line (e.g. at the end of a truncated log) opens no epoch. The times are numpy datetime64[us].
+
+Usage:
+    index = epochs.EpochIndex.from_log_table(jail_logs.read_logs('Jail/20240501'))
+    frames = epochs.frame_times(v_start, frame_count, real_fps)
+    masks = index.masks(frames) # {'Constant LED': bool array, 'Looming': ..., 'Pulse': ...}
+    query, epoch = index.overlapping(t0_array, t1_array) # pairs of overlapping (interval, epoch) indices
+'''
+import csv
+import numpy as np
+
+KINDS = {'Constant LED': ('Light ON', 'Light OFF'),
+         'Looming': ('Starting playing time', 'Done playing time'),
+         'Pulse': ('Pulsing ON', 'Pulsing OFF')}
+
+
+def as_us(t):
+    '''int64 microseconds since the epoch of datetime64 values, datetimes or their strings'''
+    return np.asarray(t, dtype='datetime64[us]').astype(np.int64)
+
+def frame_times(start, frame_count, fps):
+    '''datetime64[us] times of the frames of a video starting at start'''
+    return np.datetime64(start, 'us') + np.round(np.arange(frame_count) / fps * 1e6).astype('timedelta64[us]')
+
+def last_before(positions, values, at):
+    '''values of the last positions before each of at, NaN if there is none'''
+    i = np.searchsorted(positions, at) - 1
+    return np.where(i >= 0, values[np.maximum(i, 0)], np.nan) if len(positions) else np.full(len(at), np.nan)
+
+def pair(group, position, on, off):
+    '''
+    Rows of the ON and OFF lines of the epochs of one kind, an epoch does not span groups (files, LED channels)
+
+    Parameters:
+        group (int array): group of each line
+        position (int array): position of each line in the log, unique
+        on, off: boolean masks of the ON and OFF lines
+
+    Returns:
+        (ON rows, OFF rows) of the epochs
+    '''
+    span = int(position.max()) + 2 if len(position) else 1
+    key = group.astype(np.int64) * span + position # sorted by group, then by position
+    on_rows, off_rows = np.flatnonzero(on), np.flatnonzero(off)
+    on_rows, off_rows = on_rows[np.argsort(key[on_rows])], off_rows[np.argsort(key[off_rows])]
+    on_key, off_key = key[on_rows], key[off_rows]
+    previous = np.concatenate([[-1], off_key[:-1]]) # previous OFF line, or the start of the group of the OFF line
+    previous = np.where(previous // span == off_key // span, previous, off_key // span * span - 1)
+    first_on = np.searchsorted(on_key, previous, side='right') # first ON after the previous OFF
+    closed = first_on < len(on_key)
+    closed[closed] = on_key[first_on[closed]] < off_key[closed] # in the same group, before the OFF line
+    return on_rows[first_on[closed]], off_rows[closed]
+
+
+class EpochIndex:
+    '''
+    Stimulus epochs sorted by start, see the module docstring
+
+    Parameters:
+        start, end (datetime64[us] arrays): times of the epochs
+        kind, channel (str arrays): kind of each epoch (KINDS) and its LED channel, '' for the default one
+        parameters (dict): {name: float array}, NaN where the parameter does not apply
+    '''
+    def __init__(self, start, end, kind, channel, parameters=None):
+        order = np.argsort(as_us(start), kind='stable')
+        self.start = as_us(start)[order]
+        self.end = as_us(end)[order]
+        self.kind = np.asarray(kind, dtype=object)[order]
+        self.channel = np.asarray(channel, dtype=object)[order]
+        self.parameters = {name: np.asarray(values, dtype=float)[order] for name, values in (parameters or {}).items()}
+        self.reach = np.maximum.accumulate(self.end) if len(self.end) else self.end # latest end of the epochs so far
+        self._kinds = {} # {kind: EpochIndex of this kind only}
+
+    def __len__(self):
+        return len(self.start)
+
+    @classmethod
+    def from_log_table(cls, table, feedback=False):
+        '''
+        Epochs of an event table of jail_logs.py
+
+        Parameters:
+            feedback (bool): time the epochs by the feedback lines of the board instead of the lines of the controller
+                (the video lines have no feedback)
+        '''
+        position = np.arange(len(table['line'])) # the tables of jail_logs.py are in the order of the lines
+        group = np.unique(np.char.add(table['file'].astype(str), np.char.add('\n', table['channel'].astype(str))),
+                          return_inverse=True)[1].ravel()
+        on_rows, off_rows, kinds = [], [], []
+        for kind, (on_event, off_event) in KINDS.items():
+            timed = ~np.isnat(table['time']) & (table['feedback'] == (feedback and kind != 'Looming'))
+            on, off = pair(group, position, timed & (table['event'] == on_event), timed & (table['event'] == off_event))
+            on_rows.append(on), off_rows.append(off), kinds.append(np.full(len(on), kind, dtype=object))
+        on, off, kind = np.concatenate(on_rows), np.concatenate(off_rows), np.concatenate(kinds)
+        parameters = {}
+        for name, event, kind_name in (('rv', 'r/v', 'Looming'), ('frequency', 'Frequency', 'Pulse'),
+                                       ('pulse_width', 'Pulse width', 'Pulse')):
+            rows = table['event'] == event # the parameters are written before the ON line
+            parameters[name] = np.where(kind == kind_name, last_before(position[rows], table['value'][rows], on), np.nan)
+        return cls(table['time'][on], table['time'][off], kind, table['channel'][on], parameters)
+
+    @classmethod
+    def from_event_file(cls, path):
+        '''
+        Epochs of the CSV event file of a session ("<date>_<name>_events.csv", see log_writer.py)
+        The event file names the LED channels by their output, "LED ch<k>", and the default one "LED" is channel ''.
+        '''
+        with open(path, newline='', encoding='utf-8') as file:
+            rows = list(csv.DictReader(file))
+        event_type, target, value = (np.array([row[name] for row in rows], dtype=object) for name in ('type', 'target', 'value'))
+        time = np.array([row['wall'] for row in rows], dtype='datetime64[us]')
+        position = np.arange(len(rows))
+        group = np.unique(target.astype(str), return_inverse=True)[1].ravel() if len(rows) else position
+        state = np.array([text.split(' ')[0] for text in value], dtype=object) # 'on 10 Hz 5 ms' -> 'on'
+        on_rows, off_rows, kinds = [], [], []
+        for kind, (source, on_state, off_state) in {'Constant LED': ('LED', 'on', 'off'), 'Looming': ('video', 'start', 'end'),
+                                                    'Pulse': ('pulse', 'on', 'off')}.items():
+            on, off = pair(group, position, (event_type == source) & (state == on_state),
+                           (event_type == source) & (state == off_state))
+            on_rows.append(on), off_rows.append(off), kinds.append(np.full(len(on), kind, dtype=object))
+        on, off, kind = np.concatenate(on_rows), np.concatenate(off_rows), np.concatenate(kinds)
+        pulse = [text.split(' ') if len(text.split(' ')) == 5 else [np.nan] * 5 for text in value[on]] # on <f> Hz <w> ms
+        parameters = {'rv': np.full(len(on), np.nan),
+                      'frequency': np.array([fields[1] for fields in pulse], dtype=float),
+                      'pulse_width': np.array([fields[3] for fields in pulse], dtype=float)}
+        channel = np.where((kind == 'Looming') | (target[on] == 'LED'), '', target[on]).astype(object)
+        return cls(time[on], time[off], kind, channel, parameters)
+
+    def of_kind(self, kind):
+        '''the index of the epochs of one kind'''
+        if kind not in self._kinds:
+            rows = self.kind == kind
+            self._kinds[kind] = EpochIndex(self.start[rows].astype('datetime64[us]'), self.end[rows].astype('datetime64[us]'),
+                                           self.kind[rows], self.channel[rows],
+                                           {name: values[rows] for name, values in self.parameters.items()})
+        return self._kinds[kind]
+
+    def overlapping(self, t0, t1):
+        '''
+        Epochs overlapping the intervals [t0, t1]
+
+        Parameters:
+            t0, t1 (datetime64 arrays or scalars): bounds of the intervals
+
+        Returns:
+            (interval, epoch): index arrays of the overlapping pairs, sorted by interval then by start of the epoch
+        '''
+        t0, t1 = np.atleast_1d(as_us(t0)), np.atleast_1d(as_us(t1))
+        first = np.searchsorted(self.reach, t0, side='left') # the epochs before it all end before t0
+        last = np.searchsorted(self.start, t1, side='right') # the epochs from it all start after t1
+        count = np.maximum(last - first, 0)
+        interval = np.repeat(np.arange(len(t0)), count)
+        epoch = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count) + np.repeat(first, count)
+        keep = self.end[epoch] >= t0[interval] # nested epochs that end before t0
+        return interval[keep], epoch[keep]
+
+    def active(self, times, kind=None):
+        '''
+        Epoch running at each time, the latest started one if several run, -1 where none runs
+
+        Parameters:
+            times (datetime64 array): e.g. the frame_times() of a video
+            kind (str): only the epochs of this kind, the index returned is still the one of this EpochIndex
+        '''
+        index = self.of_kind(kind) if kind is not None else self
+        times = as_us(times)
+        i = np.searchsorted(index.start, times, side='right') - 1 # latest start before each time
+        found = np.full(len(times), -1)
+        pending = i >= 0
+        while pending.any(): # step back over the epochs that ended before the time, while an earlier one may run
+            rows = np.flatnonzero(pending)
+            running = index.end[i[rows]] >= times[rows]
+            found[rows[running]] = i[rows[running]]
+            i[rows] -= 1
+            pending[rows] = ~running & (i[rows] >= 0) & (index.reach[np.maximum(i[rows], 0)] >= times[rows])
+        if kind is None or not len(index):
+            return found
+        return np.where(found >= 0, np.flatnonzero(self.kind == kind)[np.maximum(found, 0)], -1)
+
+    def masks(self, times, kinds=None):
+        '''
+        {kind: boolean array} of the times within an epoch of each kind, e.g. for the frames of a video
+
+        Parameters:
+            times (datetime64 array): sorted times, e.g. the frame_times() of a video
+            kinds (list): kinds of epochs, all the kinds of KINDS by default
+        '''
+        times = as_us(times)
+        masks = {}
+        for kind in kinds or KINDS:
+            rows = self.kind == kind
+            first = np.searchsorted(times, self.start[rows], side='left')
+            after = np.searchsorted(times, self.end[rows], side='right')
+            depth = np.zeros(len(times) + 1, dtype=np.int64) # +1 at the first time of each epoch, -1 after the last
+            np.add.at(depth, first, 1)
+            np.add.at(depth, after, -1)
+            masks[kind] = np.cumsum(depth[:-1]) > 0
+        return masks
@@ -0,0 +1,173 @@
+'''
+Event tables of the text logs of the controller (Jail/<date>/<date>_<name>_log.txt)
+
+The Python counterpart of the parsing loop of Jailstat.m (checkEvent.m, tstr2time.m): each log file is read whole and
+tokenized by three compiled regexes instead of line by line, and all its timestamps are parsed at once by NumPy. The
+lines of both controller versions are recognized (controller_2_1_1, and controller_2_3_0 with its "[name] " tag of
+the LED channels), e.g.
+    Light ON at 2024-05-01 10:00:00.123       -> event 'Light ON', time
+    Feedback [blue] Pulsing OFF at ...        -> event 'Pulsing OFF', channel 'blue', feedback True, time
+    Received confirmation: "Shock pulses OFF (12 pulses)" at ... -> event 'Shock pulses OFF', feedback True, time, text
+    Pump value set to 200 at ...              -> event 'Pump value set to 200', time, and on the next line
+    Feedback received at ...                  -> event 'Pump value set to 200', feedback True, time
+    Starting playing time: ...                -> event 'Starting playing time', time
+    r/v = 40 ms, Real fps = 59.94, LED timer: 2 s, Pulse width: 10 ms, LED state: True -> event, value (, unit)
+    [2024-05-01 10:00:00] Input: r2           -> event 'Input', text 'r2', time
+
+Columns of the tables (numpy arrays of the same length, in the order of the lines):
+    file (str): path of the log file
+    line (int): line number, from 1
+    event (str): text of the line before its time or value, without "Feedback " and the channel tag
+    channel (str): name of the LED channel of a "[name] " tag, '' otherwise
+    feedback (bool): the time is the feedback of the board ("Feedback ..." lines)
+    time (datetime64[us]): time of the line, NaT for the value lines
+    value (float): value of the value lines (True/False as 1/0), NaN otherwise
+    unit (str): unit of the value, e.g. 'ms', 's', 'Hz', ''
+    text (str): text of the "Input" lines, the feedback of "Feedback: ..." and "Received confirmation" lines, '' otherwise
+
+Usage:
+    table = jail_logs.read_logs('Jail/20240501') # all the *_log.txt files of a folder, read in parallel
+    onsets = table['time'][(table['event'] == 'Light ON') & table['feedback']]
+    frame = jail_logs.to_dataframe(table) # requires pandas
+    python jail_logs.py <folder or log files> # writes <folder>/log_events.csv
+'''
+import os
+import re
+import sys
+import csv
+import glob
+import gzip
+import json
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+TIME = rb'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d{1,6})?'
+TIMED_LINE = re.compile(rb'^(?P<feedback>Feedback:? )?(?:\[(?P<channel>[^\]\r\n]*)\] )?(?P<event>[^\r\n]*?)'
+                        rb'(?: at|:) (?P<time>' + TIME + rb')', re.M)
+VALUE_LINE = re.compile(rb'^(?:\[(?P<channel>[^\]\r\n]*)\] )?(?P<event>[A-Za-z][\w/ ]*?)(?::| =) '
+                        rb'(?P<value>-?\d+(?:\.\d*)?|True|False)(?: (?P<unit>[A-Za-z%]+))?\r?$', re.M)
+# events of controller_2_3_0 written around their feedback, normalized to the event of the feedback like 'Light ON'
+SHOCK_EVENT = re.compile(rb'^(?:Sent command for |Received confirmation: ")(?P<text>(?P<event>Shock pulses O(?:N|FF))[^"]*)"?$')
+SCHEDULED_EVENT = re.compile(rb'^(?P<event>.*?)(?: \(\d+ pulses\))? of the scheduled \S+$') # feedback of "<command>@<seconds>"
+INPUT_LINE = re.compile(rb'^\[(?P<time>' + TIME + rb')\] Input: (?P<text>[^\r\n]*)', re.M)
+COLUMNS = ['file', 'line', 'event', 'channel', 'feedback', 'time', 'value', 'unit', 'text']
+
+
+def empty_table():
+    return {'file': np.empty(0, dtype=object), 'line': np.empty(0, dtype=np.int64), 'event': np.empty(0, dtype=object),
+            'channel': np.empty(0, dtype=object), 'feedback': np.empty(0, dtype=bool),
+            'time': np.empty(0, dtype='datetime64[us]'), 'value': np.empty(0, dtype=float),
+            'unit': np.empty(0, dtype=object), 'text': np.empty(0, dtype=object)}
+
+def read_log(path):
+    '''event table (dict of columns, see the module docstring) of one log file'''
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as log:
+        data = log.read()
+    rows = [] # (position, event, channel, feedback, time, value, unit, text)
+    event = b'Feedback'
+    for match in TIMED_LINE.finditer(data):
+        feedback, text = match['feedback'] is not None, b''
+        shock = SHOCK_EVENT.match(match['event'])
+        scheduled = SCHEDULED_EVENT.match(match['event']) if feedback else None
+        if match['feedback'] == b'Feedback: ': # "Feedback: <fb> at <time>" of the quit command
+            event, text = b'Feedback', match['event']
+        elif feedback and match['event'] == b'received': # "Feedback received at <time>", of the event of the line before
+            pass
+        elif shock:
+            event, feedback = shock['event'], match['event'].startswith(b'Received')
+            text = shock['text'] if feedback else b''
+        elif scheduled:
+            event = scheduled['event']
+        else:
+            event = match['event']
+        rows.append((match.start(), event, match['channel'] or b'', feedback, match['time'], b'nan', b'', text))
+    for match in VALUE_LINE.finditer(data):
+        value = {b'True': b'1', b'False': b'0'}.get(match['value'], match['value'])
+        rows.append((match.start(), match['event'], match['channel'] or b'', False, b'NaT', value, match['unit'] or b'', b''))
+    for match in INPUT_LINE.finditer(data):
+        rows.append((match.start(), b'Input', b'', False, match['time'], b'nan', b'', match['text']))
+    if not rows:
+        return empty_table()
+    rows.sort(key=lambda row: row[0])
+    position, event, channel, feedback, times, values, unit, text = zip(*rows)
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+    def strings(column):
+        return np.array([field.decode('utf-8', 'replace') for field in column], dtype=object)
+    return {'file': np.full(len(rows), path, dtype=object),
+            'line': np.searchsorted(newlines, np.array(position)) + 1,
+            'event': strings(event), 'channel': strings(channel),
+            'feedback': np.array(feedback, dtype=bool),
+            'time': np.array(times).astype('U').astype('datetime64[us]'), # one vectorized parse per file
+            'value': np.array(values).astype(float),
+            'unit': strings(unit), 'text': strings(text)}
+
+def segment_files(path):
+    '''the closed segments of a rotated log file (log_writer.py of controller_2_3_0), oldest first, then the file itself'''
+    manifest = os.path.splitext(path)[0] + '.manifest.json'
+    files = []
+    if os.path.exists(manifest):
+        with open(manifest) as segments:
+            for entry in json.load(segments)['segments']:
+                segment = os.path.join(os.path.dirname(path), entry['file'])
+                files.append(segment if os.path.exists(segment) else segment + '.gz') # compressed since
+    return files + ([path] if os.path.exists(path) else [])
+
+def log_files(paths):
+    '''the log files of a folder (all its *_log.txt files, sorted), a file, or a list of them, with their segments'''
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+    files = []
+    for path in paths:
+        if os.path.isdir(path): # the segments of a rotated log file are found even if the session ended with a rotation
+            logs = glob.glob(os.path.join(path, '*_log.txt')) + \
+                   [manifest[:-len('.manifest.json')] + '.txt' for manifest in glob.glob(os.path.join(path, '*_log.manifest.json'))]
+            for log in sorted(set(logs)):
+                files += segment_files(log)
+        else:
+            files += segment_files(path)
+    return files
+
+def concatenate(tables):
+    tables = [table for table in tables if len(table['line'])]
+    if not tables:
+        return empty_table()
+    return {column: np.concatenate([table[column] for table in tables]) for column in COLUMNS}
+
+def read_logs(paths, workers=None):
+    '''
+    Event table of many log files, parsed in parallel processes
+
+    Parameters:
+        paths (str or list): folders (all their *_log.txt files) and log files
+        workers (int): number of processes, None for the number of CPUs, 1 to parse in this process
+
+    Returns:
+        the tables of the files concatenated in the order of the files, see the module docstring
+    '''
+    files = log_files(paths)
+    if workers == 1 or len(files) < 2:
+        return concatenate([read_log(file) for file in files])
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return concatenate(list(executor.map(read_log, files, chunksize=max(1, len(files) // 64))))
+
+def to_dataframe(table):
+    '''pandas DataFrame of an event table'''
+    import pandas as pd # only needed for DataFrames
+    return pd.DataFrame({column: table[column] for column in COLUMNS})
+
+def write_csv(table, path):
+    '''write an event table to a CSV file, read back with pandas.read_csv() or readtable() of MATLAB'''
+    times = np.datetime_as_string(table['time'], unit='us')
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        rows = csv.writer(file)
+        rows.writerow(COLUMNS)
+        rows.writerows(zip(table['file'], table['line'], table['event'], table['channel'], table['feedback'].astype(int),
+                           np.char.replace(times, 'T', ' '), table['value'], table['unit'], table['text']))
+
+
+if __name__ == '__main__':
+    paths = sys.argv[1:] or ['.']
+    table = read_logs(paths)
+    out = os.path.join(paths[0] if os.path.isdir(paths[0]) else os.path.dirname(paths[0]) or '.', 'log_events.csv')
+    write_csv(table, out)
+    print(f'{len(table["line"])} events of {len(set(table["file"]))} log files written to {out}')
@@ -1,11 +1,48 @@
 import os
 import re
 import cv2
+import copy
 import time
+import threading
 import numpy as np
 import stimfunc as playstim
-from dataclasses import dataclass
+import serial_benchmark
+import firmware_sim
+import serial_link
+import log_writer
+import session_file
+import replay
+import status_renderer
+import waveform
+from dataclasses import dataclass, fields
 from datetime import datetime
+from event_time import EventTime
+from concurrent.futures import ThreadPoolExecutor
+
+@dataclass
+class LEDChannel:
+    '''mirrored state of an LED channel of the board'''
+    index: int = 0
+    '''channel number in the firmware, addressed by "ch<index>:"'''
+
+    name: str = 'red'
+    '''name of the channel in the commands, e.g. "r:green5", and in the log lines'''
+
+    LED_state: int = 0
+    '''state of the static LED (1=on, 0=off)'''
+
+    led_mode: str = 'off'
+    '''current LED mode: 'off', 'static', 'pulse', 'continuous' '''
+
+    continuous_pulse_state: bool = False
+    '''state of continuous pulse (True=on, False=off)'''
+
+
+def default_channel_attr(attr):
+    '''attribute of the first LED channel, used by the LED commands without channel'''
+    return property(lambda self: getattr(self.LED_channel(), attr),
+                    lambda self, value: setattr(self.LED_channel(), attr, value))
+
 
 @dataclass
 class StimController:
@@ -36,6 +73,10 @@ class StimController:
     LED_retention: int = 5000
     '''retention time (ms) of the LEDs in the video-LED timer mode'''
 
+    LED_channels: tuple = ('red',)
+    '''names of the LED channels of the firmware in channel order (red on pin 5, green on pin 6), e.g. ('red', 'green');
+    the first channel takes the LED commands without channel, the others are addressed by name, e.g. "r:green5"'''
+
     background_img = np.full((500,500,3),255,dtype=np.uint8)
     '''path of the background image of the video player'''
 
@@ -47,10 +88,45 @@ class StimController:
 
     board_type: str = 'Arduino Uno'
     '''type of the serial port board to connect to'''
+
+    multi_board: bool = False
+    '''set to True to connect to all boards of board_type, commands are addressed to them by "@<board> <command>"'''
+
+    board_count: int = 1
+    '''number of emulated boards when board_type is "Emulator" and multi_board is True'''
     
     baud_rate: int = 9600
     '''baud rate of the serial port, default to 9600'''
 
+    latency_file: str = os.path.join(script_path, 'serial_latency.json')
+    '''path to the file storing the measured round-trip latency of each command type per board, see "bench"'''
+
+    port_cache: str = os.path.join(script_path, 'serial_ports.json')
+    '''path to the file caching the VID/PID/serial number of the used boards, to find them again after a reconnect'''
+
+    status_interval: float = 10
+    '''interval (s) of reconciling the mirrored hardware states with the "status" of the board when idle, 0 to disable; always done before each command series'''
+    log_board_events: bool = True
+    '''whether the output changes recorded by the board (exact pulse edges) are pulled and logged after each command series and at the end of the session, see "events"'''
+    watchdog_window: float = 2
+    '''time (s) without any line from the host after which the board switches all outputs off, 0 to disable the watchdog'''
+    heartbeat_interval: float = 0.5
+    '''idle time (s) after which a heartbeat is sent to feed the watchdog of the board, shorter than watchdog_window'''
+    log_flush_interval: float = 0.2
+    '''interval (s) of the batch writes of the log file by its background writer, the commands only queue their lines'''
+    log_fsync_interval: float = 5
+    '''interval (s) of forcing the log file to disk (fsync), also done at the end of the session; 0 for every batch'''
+    log_segment_size: float = 50
+    '''size (MB) at which the log and autosaved protocol files are closed, compressed (gzip) and continued in a new segment, 0 for no limit'''
+    log_segment_interval: float = 0
+    '''time (h) after which the log and autosaved protocol files start a new segment, e.g. 24 for daily segments, 0 for no limit'''
+    log_event_store: bool = True
+    '''whether the events are also appended to the columnar event store of the session ("<date>_<name>_store", see event_store.py), queried with "last:"'''
+    session_container: bool = False
+    '''whether the session is also written to one HDF5 file ("<date>_<name>_session.h5", see session_file.py): events, commands, lines exchanged with the board, frame times and settings; requires h5py'''
+    prearm: bool = True
+    '''whether a hardware command following an 'isi' in a command series is sent ahead and run by the board at the end of the ISI'''
+
     window_bg: str = 'background'
     '''window name of the background image'''
 
@@ -98,6 +174,24 @@ class StimController:
     
     shock_state: bool = False
     '''state of shock pulses (True=on, False=off)'''
+
+    shock_frequency: float = 0.2
+    '''frequency (Hz) of the shock pulses'''
+
+    shock_pulse_width: int = 1250
+    '''width (ms) of each shock pulse, shorter than the period'''
+
+    shock_pulse_count: int = 0
+    '''number of shock pulses after "shock:on", the board stops by itself after the last one; 0 for no limit'''
+
+    trigger_frequency: float = 30
+    '''frequency (Hz) of the frame trigger train of "trig:on", e.g. the frame rate of the cameras'''
+
+    trigger_pulse_width: float = 5
+    '''width (ms) of each frame trigger pulse, shorter than the period'''
+
+    trigger_pulse_count: int = 0
+    '''number of frame trigger pulses after "trig:on", the board stops by itself after the last one; 0 for no limit'''
     
     air_state: bool = False
     '''state of the air valve (True=open, False=closed)'''
@@ -108,11 +202,14 @@ class StimController:
     odor_b_state: bool = False
     '''state of the odor B valve (True=open, False=closed)'''
     
-    continuous_pulse_state: bool = False
-    '''state of continuous pulse (True=on, False=off)'''
+    LED_state = default_channel_attr('LED_state')
+    '''state of the static LED of the first LED channel'''
     
-    led_mode: str = 'off'
-    '''Current LED mode: 'off', 'static', 'pulse', 'continuous' '''
+    continuous_pulse_state = default_channel_attr('continuous_pulse_state')
+    '''state of continuous pulse of the first LED channel (True=on, False=off)'''
+    
+    led_mode = default_channel_attr('led_mode')
+    '''Current LED mode of the first LED channel: 'off', 'static', 'pulse', 'continuous' '''
     
     execution_start: float = 0
     '''start time of the current combined command series in parse_combined_commands()'''
@@ -136,6 +233,12 @@ class StimController:
         'pulse_width':     'ms',
         'stimulus':        '',
         'pump_value':      '(0-255)',
+        'shock_frequency': 'Hz',
+        'shock_pulse_width': 'ms',
+        'shock_pulse_count': 'pulses',
+        'trigger_frequency': 'Hz',
+        'trigger_pulse_width': 'ms',
+        'trigger_pulse_count': 'pulses',
     }
 
     # Add new attributes for shortcuts
@@ -155,6 +258,12 @@ class StimController:
         
         self.mutable_attrs = list(self.attr_unit.keys()) # mutable attributes in running sessions
         
+        # one mirrored state per LED channel, see LED_channel()
+        for name in self.LED_channels:
+            if not re.fullmatch(r'[A-Za-z_]+', name) or name in ['on', 'off']:
+                raise ValueError(f'Invalid LED channel name "{name}", use letters and underscores only')
+        self.led_channels = {name: LEDChannel(index=i, name=name) for i, name in enumerate(self.LED_channels)}
+        
         if not self.protocol_dir:
             self.protocol_dir =  os.path.join(self.script_path, 'stim_protocols')
         if not self.protocol_saveas:
@@ -162,9 +271,22 @@ class StimController:
 
         
         # initializing serial port
+        self.boards = dict()
         if not self.ser:
-            self.ser = playstim.SetUpSerialPort(board_type=self.board_type, baud_rate=self.baud_rate)
-        self.LED_state = 0
+            if self.multi_board:
+                self.boards = playstim.SetUpSerialPorts(board_type=self.board_type, baud_rate=self.baud_rate, board_count=self.board_count,
+                                                        port_cache=self.port_cache)
+                self.ser = next(iter(self.boards.values())) if self.boards else ''
+            else:
+                self.ser = playstim.SetUpSerialPort(board_type=self.board_type, baud_rate=self.baud_rate, port_cache=self.port_cache)
+        
+        # loading the measured command latency of the connected board
+        self.board_id = playstim.get_board_id(self.ser)
+        if not self.boards and self.ser:
+            self.boards = {self.board_id: self.ser}
+        self.latency_model = serial_benchmark.load_latency_model(self.latency_file, self.board_id) if self.board_id else {}
+        if self.latency_model:
+            print(f'Loaded command latency model of board {self.board_id} from {self.latency_file}')
         
         # building the save path of log files
         if not self.save_path:
@@ -221,8 +343,17 @@ class StimController:
         print(f'Log file will be saved as: {self.log_name}')
         
         self.log_file = os.path.join(self.save_path, self.log_name)
+        # the log lines are queued and written in batches by a background thread, see log_writer.py
+        log_writer.start(self.log_file, self.log_flush_interval, self.log_fsync_interval, store=self.log_event_store,
+                         **self.log_segments())
+        self.start_session_container(self.log_file, self.ser)
+        if os.path.isdir(self.protocol_dir): # otherwise the protocol lines are appended directly, as without a writer
+            log_writer.start(self.protocol_saveas, self.log_flush_interval, self.log_fsync_interval, events=False,
+                             **self.log_segments())
+        self.command_index = 0 # index of the command of the session, recorded with each event of the CSV event file
+        log_writer.set_context(self.log_file, stimulus=self.stimulus)
         # write to log file
-        with open(self.log_file, 'a') as log:
+        with log_writer.open_log(self.log_file) as log:
             log.write('=' * 50 + '\n')
             log.write(f'New cycle started at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n')
             log.write('=' * 50 + '\n')
@@ -230,6 +361,249 @@ class StimController:
         # Initialize shortcuts dictionary
         self.shortcuts = {}
         self.load_shortcuts()
+        
+        # hardware states mirrored from the board, see reconcile_state()
+        self.state_lock = threading.Lock()
+        self.board_status = dict()
+        self.status_supported = True
+        self.events_supported = True
+        self.t_last_status = 0
+        self.shock_synced = True # the board runs the shock_* parameters, see apply_shock_parameters()
+        self.trigger_train = None # board clock samples of the last frame trigger train, see trigger_train_controller()
+        
+        # one controller per connected board, sharing the loaded stimulus videos, shortcuts and settings
+        self.abort_event = threading.Event()
+        '''set to stop the command series running on all boards'''
+        self.board_views = self.build_board_views()
+        
+        # the boards are reconnected automatically when their port disappears, see serial_link.py
+        for view in self.board_views.values():
+            if isinstance(view.ser, serial_link.ReconnectingSerial):
+                view.ser.log_path = view.log_file
+                view.ser.on_reconnect = view.resync_after_reconnect
+        
+        # the shock pulse train is kept by the board until it resets
+        for view in self.board_views.values():
+            view.apply_shock_parameters(changed_only=True)
+        
+        # the board switches its outputs off when the heartbeats of the host stop, see serial_link.Heartbeat
+        for view in self.board_views.values():
+            view.start_watchdog()
+
+    def build_board_views(self):
+        '''
+        Build one controller per board for concurrent multi-board execution
+        The first board is controlled by self; every other board gets a shallow copy of self with its own
+        serial port, hardware state, latency model, log file and protocol file.
+
+        Returns:
+            dict: {board id: StimController}
+        '''
+        board_views = dict()
+        for board_id, ser in self.boards.items():
+            if ser is self.ser:
+                board_views[board_id] = self
+                continue
+            view = copy.copy(self)
+            view.ser = ser
+            view.board_id = board_id
+            view.latency_model = serial_benchmark.load_latency_model(self.latency_file, board_id)
+            view.log_file = self.log_file[:-len('_log.txt')] + f'_{board_id}_log.txt'
+            view.protocol_saveas = self.protocol_saveas[:-len('.txt')] + f'_{board_id}.txt'
+            view.update_pulse = view.update_timer = False # no interactive prompts from concurrent boards
+            view.state_lock = threading.Lock()
+            view.board_status = dict()
+            view.led_channels = {name: copy.copy(channel) for name, channel in self.led_channels.items()}
+            log_writer.start(view.log_file, self.log_flush_interval, self.log_fsync_interval, store=self.log_event_store,
+                             **self.log_segments())
+            self.start_session_container(view.log_file, ser)
+            if os.path.isdir(self.protocol_dir):
+                log_writer.start(view.protocol_saveas, self.log_flush_interval, self.log_fsync_interval, events=False,
+                                 **self.log_segments())
+            log_writer.set_context(view.log_file, stimulus=view.stimulus)
+            with log_writer.open_log(view.log_file) as log:
+                log.write('=' * 50 + '\n')
+                log.write(f'New cycle started at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} on board {board_id}\n')
+                log.write('=' * 50 + '\n')
+            board_views[board_id] = view
+        if len(board_views) > 1:
+            print(f'{len(board_views)} boards are connected, address commands by "@<board> <command>", see "help boards"')
+        return board_views
+
+    def resolve_boards(self, target):
+        '''
+        Resolve the board address of "@<board> <command>"
+
+        Parameters:
+            target (str): "all", board numbers as listed by "boards" or board ids, separated by ","
+
+        Returns:
+            list: controllers of the addressed boards, None if any board is unknown
+        '''
+        board_ids = list(self.board_views.keys())
+        if target == 'all':
+            return list(self.board_views.values())
+        views = []
+        for name in target.split(','):
+            name = name.strip()
+            if name.isnumeric() and 1 <= int(name) <= len(board_ids):
+                views.append(self.board_views[board_ids[int(name)-1]])
+            elif name in self.board_views:
+                views.append(self.board_views[name])
+            else:
+                print(f'Unknown board: "{name}". Available boards: {", ".join(board_ids)} or "all"')
+                return None
+        return views
+
+    def list_boards(self):
+        '''list the connected boards'''
+        if not self.board_views:
+            print('No board is connected.')
+            return 1
+        print('\nConnected boards:')
+        for i, (board_id, view) in enumerate(self.board_views.items()):
+            print(f'  \033[34m@{i+1}\033[0m {board_id} on {view.ser.port}: LED={view.LED_state} pump={int(view.pump_state)} '
+                  f'air={int(view.air_state)} odor_a={int(view.odor_a_state)} odor_b={int(view.odor_b_state)} shock={int(view.shock_state)}')
+        return 0
+
+    def board_command(self, key_input):
+        '''
+        Execute "@<board> <command>" concurrently on the addressed boards
+        e.g. "@2 r5", "@1,3 pump:on > isi5 > pump:off", "@all shock:on"
+        Settings (set:) are shared and taken from the unaddressed controller at the time of the command.
+        '''
+        target, _, command = key_input[1:].partition(' ')
+        command = command.strip()
+        views = self.resolve_boards(target.strip())
+        if views is None:
+            return 1
+        if not command:
+            print('No command given. Usage: "@<board> <command>", e.g. "@2 r5" or "@all pump:on"')
+            return 1
+        
+        # video playing and interactive commands are not board specific
+        for cmd in self.expand_wrapped_commands(command).split('>'):
+            cmd = cmd.strip()
+            if cmd == '' or cmd.startswith('v') or cmd.startswith('help') or cmd.startswith('bench') or \
+               cmd in ['t', 'stim', self.stim_name, 'q', 'load', 'u', 'h', 'boards']:
+                print(f'"{cmd if cmd else "<Enter>"}" cannot be addressed to boards. Please input it without "@<board>".')
+                return 1
+        
+        shock_attrs = ['shock_frequency', 'shock_pulse_width', 'shock_pulse_count']
+        for view in views:
+            if view is not self:
+                shock_before = [getattr(view, attr) for attr in shock_attrs]
+                for attr in self.mutable_attrs:
+                    if attr not in ['stimulus', 'update_pulse', 'update_timer']:
+                        setattr(view, attr, getattr(self, attr))
+                if [getattr(view, attr) for attr in shock_attrs] != shock_before or not view.shock_synced:
+                    view.apply_shock_parameters() # "set:shock_*" was only sent to the board of this controller
+        
+        self.abort_event.clear()
+        with ThreadPoolExecutor(max_workers=len(views)) as pool:
+            futures = {view.board_id: pool.submit(view.run_board_input, command) for view in views}
+            try:
+                results = dict()
+                for board_id, future in futures.items():
+                    try:
+                        results[board_id] = future.result()
+                    except Exception as e:
+                        print(f'\n\033[31mError on board {board_id}: {type(e).__name__}: {str(e)}\033[0m')
+                        results[board_id] = 1
+            except KeyboardInterrupt:
+                self.abort_event.set() # let the other boards finish their current command and stop
+                for future in futures.values():
+                    future.exception()
+                self.abort_event.clear()
+                raise
+        
+        failed = [board_id for board_id, result in results.items() if result != 0]
+        if failed:
+            print(f'\n\033[33mCommand failed on board(s): {", ".join(failed)}\033[0m')
+            return 1
+        print(f'\nCommand completed on board(s): {", ".join(results.keys())}')
+        return 0
+
+    def run_board_input(self, key_input):
+        '''execute a single command or a command series on the board of this controller'''
+        self.ClearSerialBuffer()
+        if '>' in key_input:
+            return self.parse_combined_commands(key_input)
+        validated_cmd = self.validate_command(key_input)
+        if validated_cmd is None:
+            print(f'Invalid command for board {self.board_id}: {key_input}')
+            return 1
+        execute_state = self.process_command(validated_cmd)
+        if execute_state == 0:
+            log_cmd = key_input if key_input in self.shortcuts else validated_cmd
+            self.write_protocols(log_cmd, skip_isi=log_cmd.lower().startswith('isi'))
+        return execute_state
+
+    def resync_after_reconnect(self):
+        '''
+        Restore the outputs of the board after it was reconnected
+        The board resets when its port is reopened: the pump, the valves, the shock pulses and the continuous pulse
+        are switched on again, while the static LED, LED timers and pulse trains in progress are lost.
+        '''
+        was_on = {name: getattr(self, f'{name}_state') for name in ['pump', 'air', 'odor_a', 'odor_b', 'shock']}
+        was_pulsing = [led for led in self.led_channels.values() if led.continuous_pulse_state]
+        for led in self.led_channels.values():
+            if led.LED_state and led.led_mode != 'continuous':
+                print(f'\033[33mThe {led.name} LED was ON before the reconnect and is OFF now.\033[0m')
+        if self.trigger_train and self.trigger_train['running']: # the frames after the reset would not match the old board clock
+            print('\033[33mThe frame trigger train was stopped by the reconnect, please start it again with "trig:on".\033[0m')
+            self.trigger_train['running'] = False
+        self.reset_LED_channels()
+        self.pump_state = self.air_state = self.odor_a_state = self.odor_b_state = self.shock_state = False
+        playstim.forget_scheduled(self.ser) # the reset dropped the scheduled commands
+        
+        if self.pump_value != 200: # default of the firmware
+            playstim.set_pump_value(self.ser, self.log_file, self.pump_value)
+        if was_on['pump']:
+            self.pump_state = playstim.pump_switch(self.pump_state, self.ser, self.log_file, turn_on=True)
+        for valve in ['air', 'odor_a', 'odor_b']:
+            if was_on[valve]:
+                setattr(self, f'{valve}_state', playstim.valve_switch(valve, False, self.ser, self.log_file, turn_on=True))
+        self.apply_shock_parameters(changed_only=True)
+        self.arm_watchdog()
+        if was_on['shock']:
+            self.shock_state = playstim.shock_switch(self.shock_state, self.ser, self.log_file, turn_on=True)
+        for led in was_pulsing:
+            led.continuous_pulse_state = playstim.continuous_pulse_switch(led.continuous_pulse_state, self.ser, self.log_file, turn_on=True,
+                                                                          frequency=self.pulse_frequency, pulse_width=self.pulse_width,
+                                                                          **self.LED_target(led))
+            led.led_mode = 'continuous' if led.continuous_pulse_state else 'off'
+        restored = [name for name, state in was_on.items() if state] + [f'{led.name} continuous_pulse' for led in was_pulsing]
+        print(f'Board {self.board_id} state restored: {", ".join(restored) if restored else "all outputs off"}')
+        return 0
+
+    def arm_watchdog(self):
+        '''send watchdog_window to the board, which forgets it when it resets'''
+        if not self.ser or self.watchdog_window <= 0:
+            return 1
+        return playstim.set_watchdog(self.ser, self.log_file, self.watchdog_window)
+
+    def start_watchdog(self):
+        '''arm the watchdog of the board and start sending heartbeats'''
+        self.heartbeat = None
+        if self.arm_watchdog() != 0 or not isinstance(self.ser, serial_link.ReconnectingSerial):
+            return 1
+        self.heartbeat = serial_link.Heartbeat(self.ser, interval=self.heartbeat_interval).start()
+        return 0
+
+    def stop_watchdog(self):
+        '''stop the heartbeats and disarm the watchdog, e.g. before closing the port'''
+        if getattr(self, 'heartbeat', None) is None:
+            return 0
+        self.heartbeat.stop()
+        self.heartbeat = None
+        return playstim.set_watchdog(self.ser, self.log_file, 0)
+
+    def stop_all_boards(self):
+        '''send the quit command to all connected boards'''
+        for view in self.board_views.values():
+            view.stop_arduino()
+        return 0
 
     def load_shortcuts(self):
         """Load command shortcuts from the shortcuts file"""
@@ -263,7 +637,7 @@ class StimController:
                     # Skip reserved names (but don't error if already in shortcuts)
                     if shortcut_name in ['h', 'help', 'q', 'v', 'p', 't', 'well', 'u', 'run', 'load', 'trig',
                                         'stim', 'set', 'show', 'r', 'isi', 'pump', 'shock', 'air',
-                                        'odor_a', 'odor_b', 'stop'] or shortcut_name == self.stim_name:
+                                        'odor_a', 'odor_b', 'stop', 'bench', 'boards', 'status', 'events', 'wave', 'last', 'replay'] or shortcut_name == self.stim_name:
                         invalid_shortcuts.append((shortcut_name, f"Reserved command name"))
                         continue
                         
@@ -340,11 +714,19 @@ class StimController:
            command == 'stim' or command.startswith('help') or \
            command == 'pump' or command == 'shock' or command == 'air' or \
            command == 'odor_a' or command == 'odor_b' or command == 'stop' or \
-           command == 'shortcuts' or command == 'pulse' or command == 'bell':
+           command == 'shortcuts' or command == 'pulse' or command == 'bell' or \
+           command == 'bench' or command == 'boards' or command == 'status' or command == 'events':
             return True
             
         # Command with parameters
-        if command[0] == 'r' and command != 'run':
+        base, channel = self.split_LED_channel(command)
+        if '@' in command:
+            # hardware command run later by the board
+            return self.is_scheduled_command(command)
+        elif channel is not None:
+            # LED command addressed to a channel, e.g. 'r:green5'
+            return self.is_basic_command_valid(base)
+        elif command[0] == 'r' and command != 'run':
             # r commands (LED control)
             if len(command) == 1 or command[1:].replace('.', '').isnumeric():
                 return True
@@ -357,6 +739,9 @@ class StimController:
         elif command.lower().startswith('isi'):
             # ISI commands
             return len(command) > 3 and command[3:].replace('.', '').isnumeric()
+        # Validate timed valve/pump commands
+        elif self.is_output_timer(command):
+            return True
         # Validate pump commands
         elif command.startswith('pump:'):
             if command in ['pump:on', 'pump:off']:
@@ -367,14 +752,26 @@ class StimController:
         # Validate other device commands
         elif command.startswith('shock:'):
             return command in ['shock:on', 'shock:off']
+        elif command.startswith('trig:'):
+            return command in playstim.TRIGGER_TRAIN_COMMANDS
         elif command.startswith('pulse:'):
             return command in ['pulse:on', 'pulse:off']
+        elif command == 'bench:sim':
+            return True
+        elif command.startswith('bench:stress'):
+            return command == 'bench:stress' or (command.startswith('bench:stress:') and command[13:].replace('.','',1).isnumeric())
+        elif command.startswith('bench:'):
+            return command[6:].isnumeric()
+        elif command.startswith('last:'):
+            return len(command) > 5
         elif command.startswith('air:'):
             return command in ['air:on', 'air:off']
         elif command.startswith('odor_a:'):
             return command in ['odor_a:on', 'odor_a:off']
         elif command.startswith('odor_b:'):
             return command in ['odor_b:on', 'odor_b:off']
+        elif command.startswith('wave:'):
+            return self.is_waveform_valid(command)
                 
         # If we get here, command format is not recognized
         return False
@@ -470,7 +867,7 @@ class StimController:
         # Check if name is a built-in command
         if name in ['h', 'help', 'q', 'v', 'p', 't', 'well', 'u', 'run', 'load', 'trig',
                     'stim', 'set', 'show', 'r', 'isi', 'pump', 'shock', 'air',
-                    'odor_a', 'odor_b', 'stop'] or name == self.stim_name:
+                    'odor_a', 'odor_b', 'stop', 'bench', 'boards', 'status', 'events', 'wave', 'last', 'replay'] or name == self.stim_name:
             print(f"Cannot use '{name}' as shortcut name because it's a built-in command")
             return False
             
@@ -544,7 +941,7 @@ class StimController:
         command_series = self.shortcuts[shortcut_name]
         print(f"Executing shortcut '{shortcut_name}': {command_series}")
         # write to log
-        with open(self.log_file, 'a') as log:
+        with log_writer.open_log(self.log_file) as log:
             log.write(f"Executing shortcut '{shortcut_name}': {command_series}\n")
         
         # Fully expand all nested shortcuts first
@@ -712,13 +1109,14 @@ class StimController:
             print(f'Attribute {attr} is not immediately mutable!')
             print(f'Immediately mutable attributes: {self.mutable_attrs}')
             return
-        elif attr in ['LED_retention','video_retention','videoLED_timer','well_times','pulse_width']:
+        elif attr in ['LED_retention','video_retention','videoLED_timer','well_times','pulse_width','shock_pulse_width','shock_pulse_count',
+                      'trigger_pulse_count']:
             if val.isnumeric():
                 val = int(val)
             else:
                 print(f'Invalid value for {attr}!')
                 return
-        elif attr in ['u_time','pulse_span','pulse_frequency']:
+        elif attr in ['u_time','pulse_span','pulse_frequency','shock_frequency','trigger_frequency','trigger_pulse_width']:
             if val.isnumeric():
                 val = int(val)
             elif val.replace('.','').isnumeric():
@@ -738,8 +1136,32 @@ class StimController:
                 return
         setattr(self,attr,val)
         print(f'Current {attr} = {val} '+self.attr_unit[attr], type(getattr(self,attr)))
+        if attr.startswith('shock_') and self.ser:
+            self.apply_shock_parameters()
         return 0
     
+    def apply_shock_parameters(self, changed_only=False):
+        '''
+        Send shock_frequency, shock_pulse_width and shock_pulse_count to the board
+        
+        Parameters:
+            changed_only (bool): only send them if they differ from the defaults of the firmware (0.2 Hz, 1250 ms, no limit)
+        '''
+        if not self.ser:
+            return 1
+        if changed_only and (self.shock_frequency, self.shock_pulse_width, self.shock_pulse_count) == (0.2, 1250, 0):
+            self.shock_synced = True
+            return 0
+        if self.shock_frequency <= 0 or self.shock_pulse_width >= 1000 / self.shock_frequency:
+            # e.g. halfway through changing both frequency and pulse width, sent once they fit
+            print(f'\033[33mShock parameters are not sent yet: the pulse width ({self.shock_pulse_width} ms) must be shorter '
+                  f'than the period ({1000 / self.shock_frequency if self.shock_frequency > 0 else float("inf"):.0f} ms)\033[0m')
+            self.shock_synced = False
+            return 1
+        self.shock_synced = playstim.set_shock_parameters(self.ser, self.log_file, self.shock_frequency,
+                                                           self.shock_pulse_width, self.shock_pulse_count) == 0
+        return 0 if self.shock_synced else 1
+    
     def say_well(self):
         if self.well_times:
             print('well ' * self.well_times)
@@ -757,24 +1179,43 @@ class StimController:
         
     def terminate(self):
         '''terminate the current session'''
-        playstim.LED_switch(self.LED_state,self.ser,self.log_file,turn_on=False)
+        for view in self.board_views.values():
+            if view is not self:
+                view.switch_off_outputs()
+                if view.log_board_events: view.pull_board_events()
+                view.stop_watchdog()
+                view.ser.close()
+                log_writer.stop(view.log_file)
+                log_writer.stop(view.protocol_saveas)
+        self.switch_off_outputs()
+        if self.log_board_events: self.pull_board_events()
+        self.stop_watchdog()
+        cv2.destroyAllWindows()
+        if self.ser: self.ser.close()
+        log_writer.stop(self.log_file)
+        log_writer.stop(self.protocol_saveas)
+        print('Sessions terminated.')
+        if os.path.exists(self.protocol_saveas): print(f'Current protocol was saved as: {self.protocol_saveas}')
+        return 0
+    
+    def switch_off_outputs(self):
+        '''turn off the LEDs, pump, shock and all valves of the board'''
+        for led in self.led_channels.values():
+            playstim.LED_switch(led.LED_state,self.ser,self.log_file,turn_on=False,**self.LED_target(led))
         
         # Make sure to turn off pump and all valves
         if self.pump_state:
             playstim.pump_switch(self.pump_state, self.ser, self.log_file, turn_on=False)
         if self.shock_state:
             playstim.shock_switch(self.shock_state, self.ser, self.log_file, turn_on=False)
+        if self.trigger_train and self.trigger_train['running']:
+            self.trigger_train_controller('trig:off')
         if self.air_state:
             playstim.valve_switch('air', self.air_state, self.ser, self.log_file, turn_on=False)
         if self.odor_a_state:
             playstim.valve_switch('odor_a', self.odor_a_state, self.ser, self.log_file, turn_on=False)
         if self.odor_b_state:
             playstim.valve_switch('odor_b', self.odor_b_state, self.ser, self.log_file, turn_on=False)
-            
-        cv2.destroyAllWindows()
-        if self.ser: self.ser.close()
-        print('Sessions terminated.')
-        if os.path.exists(self.protocol_saveas): print(f'Current protocol was saved as: {self.protocol_saveas}')
         return 0
     
     def deliver_video_command(self, key_input='v'):
@@ -788,6 +1229,7 @@ class StimController:
             real_fps, interval, t_play, t_end = playstim.play_video(
                 self.frms, self.read_fps, self.window_video, retention_time=self.video_retention
             )
+            session_file.log_frames(self.log_file, t_play, interval, self.stimulus)
             playstim.write_video_log(
                 self.log_file, real_fps, self.read_fps, self.stimulus, t_play, t_end, self.LED_state, duration=np.sum(interval) / 1000
             )
@@ -796,7 +1238,7 @@ class StimController:
         elif key_input.startswith('v') and key_input[1:].isnumeric():  # Video series delivery
             loop_times = int(key_input[1:])
             print(f'stimulus series: {loop_times} times')
-            with open(self.log_file, 'a') as log:
+            with log_writer.open_log(self.log_file) as log:
                 log.write(f'stimulus series: {loop_times} times\n\n')
             for i in range(loop_times):
                 print(f'Playing video {i + 1}/{loop_times}')
@@ -812,53 +1254,95 @@ class StimController:
         if stim_new in self.valid_stim:
             self.stimulus = stim_new
             self.frms, self.read_fps = self.video_dict[self.stimulus]
+            log_writer.set_context(self.log_file, stimulus=self.stimulus)
+            log_writer.log_event(self.log_file, 'stimulus', self.stim_name, self.stimulus)
             print(f'{self.stim_name} is reset to {self.stimulus}.')
             return 0
         else:
             print(f'Input stimulus name not available, please input a valid {self.stim_name} value in {self.valid_stim}.')
             return
     
-    def LED_controller(self, key_input = 'r'):
-        '''control the LED; switch on/off or set the ON time'''
+    def LED_channel(self, name=None):
+        '''mirrored state of the LED channel, the first one of LED_channels by default'''
+        return self.led_channels[name or self.LED_channels[0]]
+
+    def LED_target(self, led):
+        '''keyword arguments addressing the LED channel in the LED helpers of stimfunc, tagging its log lines if there are several channels'''
+        return {'channel': led.index, 'name': led.name if len(self.led_channels) > 1 else ''}
+
+    def split_LED_channel(self, command):
+        '''
+        Split an LED command addressed to a channel by name, e.g. "r:green5", "r:green", "p:red", "pulse:green:on"
+        
+        Returns:
+            tuple: (command without the channel, e.g. "r5", "r", "p", "pulse:on"; channel name), name None for other commands
+        '''
+        match = re.fullmatch(r'(r|p|pulse):([A-Za-z_]+)(.*)', command)
+        if match is None or match.group(2) not in self.led_channels:
+            return command, None
+        return match.group(1) + match.group(3), match.group(2)
+
+    def LED_channel_controller(self, key_input):
+        '''run an LED command addressed to a channel, e.g. "r:green5"'''
+        command, channel = self.split_LED_channel(key_input)
+        if command == 'p':
+            return self.LED_pulse_controller(channel)
+        elif command.startswith('pulse'):
+            return self.continuous_pulse_controller(command, channel)
+        return self.LED_controller(command, channel)
+
+    def reset_LED_channels(self):
+        '''mirror all LED channels as off, after the board was reset or its watchdog tripped'''
+        for led in self.led_channels.values():
+            led.LED_state = 0
+            led.led_mode = 'off'
+            led.continuous_pulse_state = False
+
+    def LED_controller(self, key_input = 'r', channel=None):
+        '''control the LED of the channel (the first one by default); switch on/off or set the ON time'''
+        led = self.LED_channel(channel)
+        target = self.LED_target(led)
         # Check if another LED mode is active and deactivate it
-        if self.led_mode == 'pulse' or self.led_mode == 'continuous':
-            print(f"\n\033[33mDeactivating {self.led_mode} mode before switching to static LED mode\033[0m")
-            if self.led_mode == 'pulse':
+        if led.led_mode == 'pulse' or led.led_mode == 'continuous':
+            print(f"\n\033[33mDeactivating {led.led_mode} mode before switching to static LED mode\033[0m")
+            if led.led_mode == 'pulse':
                 # No need to do anything as pulse mode ends automatically
                 pass
-            elif self.led_mode == 'continuous':
+            elif led.led_mode == 'continuous':
                 # Turn off continuous pulse
-                self.continuous_pulse_state = playstim.continuous_pulse_switch(
-                    self.continuous_pulse_state, self.ser, self.log_file, turn_on=False)
+                led.continuous_pulse_state = playstim.continuous_pulse_switch(
+                    led.continuous_pulse_state, self.ser, self.log_file, turn_on=False, **target)
         
         if key_input == 'r': # turn on/off the LED
-            self.LED_state = playstim.LED_switch(self.LED_state, self.ser, self.log_file)
-            if self.LED_state:
-                self.led_mode = 'static'
+            led.LED_state = playstim.LED_switch(led.LED_state, self.ser, self.log_file, **target)
+            if led.LED_state:
+                led.led_mode = 'static'
             else:
-                self.led_mode = 'off'
+                led.led_mode = 'off'
         elif key_input[1:].replace('.','').isnumeric(): # set the LED ON time if the LED is off
             LED_t = float(key_input[1:])
-            result = playstim.LED_timer(self.LED_state, self.ser, self.log_file, timer=LED_t)
+            result = playstim.LED_timer(led.LED_state, self.ser, self.log_file, timer=LED_t, **target)
             if result == 0:
-                self.led_mode = 'static'  # Temporarily in static mode
+                led.led_mode = 'static'  # Temporarily in static mode
         else:
             print('Invalid input. "r" should be followed by a number to specify the LED ON time (s).')
             return 1
         return 0
     
-    def LED_pulse_controller(self):
-        '''control LED pulsing, including setting the pulsing span (s, float), frequency (Hz, float) and pulse width (ms, int)'''
+    def LED_pulse_controller(self, channel=None):
+        '''control LED pulsing of the channel, including setting the pulsing span (s, float), frequency (Hz, float) and pulse width (ms, int)'''
+        led = self.LED_channel(channel)
+        target = self.LED_target(led)
         # Check if another LED mode is active and deactivate it
-        if self.led_mode == 'continuous':
+        if led.led_mode == 'continuous':
             print(f"\n\033[33mDeactivating continuous pulse mode before switching to timed pulse mode\033[0m")
-            self.continuous_pulse_state = playstim.continuous_pulse_switch(
-                self.continuous_pulse_state, self.ser, self.log_file, turn_on=False)
-        elif self.led_mode == 'static' and self.LED_state:
+            led.continuous_pulse_state = playstim.continuous_pulse_switch(
+                led.continuous_pulse_state, self.ser, self.log_file, turn_on=False, **target)
+        elif led.led_mode == 'static' and led.LED_state:
             print(f"\n\033[33mTurning off static LED before switching to timed pulse mode\033[0m")
-            self.LED_state = playstim.LED_switch(self.LED_state, self.ser, self.log_file, turn_on=False)
+            led.LED_state = playstim.LED_switch(led.LED_state, self.ser, self.log_file, turn_on=False, **target)
         
-        if playstim.LED_check(self.LED_state, self.ser) != 0: return
+        if playstim.LED_check(led.LED_state, self.ser) != 0: return
         
         if self.update_pulse:
             d_input = input('Please input the pulsing span (s): ')
@@ -875,9 +1359,9 @@ class StimController:
                 print('Invalid input. Valid numbers are required!')
                 return 1
                 
-        playstim.LED_pulse(self.LED_state, self.ser, self.log_file, duration=self.pulse_span, 
-                          frequency=self.pulse_frequency, pulse_width=self.pulse_width)
-        self.led_mode = 'pulse'  # Set mode to pulse
+        playstim.LED_pulse(led.LED_state, self.ser, self.log_file, duration=self.pulse_span, 
+                          frequency=self.pulse_frequency, pulse_width=self.pulse_width, **target)
+        led.led_mode = 'pulse'  # Set mode to pulse
         return 0
     
     def videoLED_coordination(self):
@@ -911,36 +1395,222 @@ class StimController:
         if not self.ser:
             return
         lineNum = 0
+        for fb in playstim.pop_deferred_feedback(self.ser): # ends of timed actions received while waiting for other commands
+            self.process_feedback(fb)
         while self.ser.inWaiting() > 0:
             fb = self.ser.readline().decode()[:-1]
             lineNum += 1
-            
-            # Process important messages before clearing
-            if fb.startswith("Warning:"):
-                print(f'\033[33m{fb}\033[0m')
-                if "Cannot open valve - Pump is OFF" in fb and hasattr(self, 'last_valve_attempted'):
-                    setattr(self, self.last_valve_attempted + "_state", False)
-            elif "valve OPEN" in fb:
-                valve_name = fb.split(" ")[0].lower()
-                if hasattr(self, f"{valve_name}_state"):
-                    setattr(self, f"{valve_name}_state", True)
-            elif "valve CLOSED" in fb or "All valves CLOSED" in fb:
-                if "All valves CLOSED" in fb:
-                    self.air_state = self.odor_a_state = self.odor_b_state = False
-                else:
-                    valve_name = fb.split(" ")[0].lower()
-                    if hasattr(self, f"{valve_name}_state"):
-                        setattr(self, f"{valve_name}_state", False)
-            elif "Pump ON" in fb:
-                self.pump_state = True
-            elif "Pump OFF" in fb:
-                self.pump_state = self.air_state = self.odor_a_state = self.odor_b_state = False
-            elif print_flag:
+            if not self.process_feedback(fb) and print_flag:
                 print(f'\033[30mCleared serial buffer -- line {lineNum}: {fb}\033[0m')
         
         if lineNum == 0 and print_flag:
             print('No info in serial buffer.')
         return 0
+    
+    def process_feedback(self, fb):
+        '''
+        Process important messages of the board before clearing them
+        
+        Returns:
+            bool: whether the line was recognized
+        '''
+        event = playstim.output_feedback(fb)
+        playstim.log_scheduled_feedback(self.ser, fb) # the event of a "<command>@<seconds>" run by the board
+        if fb.startswith("Warning:"):
+            print(f'\033[33m{fb}\033[0m')
+            if "Cannot open valve - Pump is OFF" in fb and hasattr(self, 'last_valve_attempted'):
+                setattr(self, self.last_valve_attempted + "_state", False)
+        elif event is not None and event[0] == 'valve': # "Odor A valve OPEN", the label of the valve is not its name
+            setattr(self, f"{event[1]}_state", event[2] == 'on')
+        elif "All valves CLOSED" in fb:
+            self.air_state = self.odor_a_state = self.odor_b_state = False
+        elif "Pump ON" in fb:
+            self.pump_state = True
+        elif "Pump OFF" in fb:
+            self.pump_state = self.air_state = self.odor_a_state = self.odor_b_state = False
+        elif fb.startswith("Watchdog tripped"): # the board heard nothing from the host for watchdog_window and switched everything off
+            print(f'\033[31m{fb}\033[0m')
+            self.reset_LED_channels()
+            self.pump_state = self.air_state = self.odor_a_state = self.odor_b_state = self.shock_state = False
+            playstim.forget_scheduled(self.ser) # safeState() of the firmware drops the scheduled commands
+            if self.trigger_train:
+                self.trigger_train['running'] = False
+            log_writer.log_event(self.log_file, 'watchdog', 'outputs', 'off')
+            with log_writer.open_log(self.log_file) as log:
+                log.write(f'{fb} at {EventTime.now()}\n')
+                log.write('\n')
+        elif fb.startswith("Shock pulses"): # ON, OFF (n pulses) or done (n pulses) after shock_pulse_count pulses
+            self.shock_state = fb == "Shock pulses ON"
+            if fb.startswith("Shock pulses done"):
+                print(fb)
+        elif fb.startswith("Trigger train done"): # after trigger_pulse_count pulses
+            print(fb.split(' at')[0])
+            if self.trigger_train:
+                self.trigger_train['pulses'] = int(re.search(r'\((\d+) pulses\)', fb).group(1))
+                self.trigger_train['running'] = False
+                log_writer.log_event(self.log_file, 'trigger train', 'trigger', f'done ({self.trigger_train["pulses"]} pulses)')
+                playstim.log_trigger_frames(self.log_file, self.trigger_train)
+        else:
+            return False
+        return True
+    
+    def reconcile_state(self, print_flag=False):
+        '''
+        Update all mirrored hardware states at once from a single "status" snapshot of the board
+        States that had drifted from the board are reported and written to the log file.
+        '''
+        if not self.ser or not self.status_supported:
+            return 1
+        status, other_lines = playstim.query_status(self.ser)
+        for fb in playstim.pop_deferred_feedback(self.ser) + other_lines: # feedback of earlier commands arriving before the snapshot
+            self.process_feedback(fb)
+        self.t_last_status = time.time()
+        if status is None:
+            self.status_supported = False
+            print('\033[33mThe firmware does not support "status", please update it to arduino_communication_6. State reconciling is disabled.\033[0m')
+            return 1
+        
+        new_state = {
+            'pump_state': bool(status['pump']),
+            'pump_value': status['pwm'],
+            'air_state': bool(status['air']),
+            'odor_a_state': bool(status['odor_a']),
+            'odor_b_state': bool(status['odor_b']),
+            'shock_state': bool(status['shock']),
+        }
+        led_state = {name: self.LED_channel_status(status['leds'][led.index])
+                     for name, led in self.led_channels.items() if led.index < len(status['leds'])}
+        with self.state_lock:
+            changes = {attr: (getattr(self, attr), value) for attr, value in new_state.items() if getattr(self, attr) != value}
+            for attr, value in new_state.items():
+                setattr(self, attr, value)
+            for name, state in led_state.items():
+                led = self.led_channels[name]
+                prefix = f'{name} ' if len(self.led_channels) > 1 else ''
+                changes.update({prefix + attr: (getattr(led, attr), value) for attr, value in state.items()
+                                if getattr(led, attr) != value and attr != 'led_mode'})
+                for attr, value in state.items():
+                    setattr(led, attr, value)
+            self.board_status = status
+        
+        if changes:
+            t_status = EventTime.now()
+            corrections = ', '.join(f'{attr} {old} -> {new}' for attr, (old, new) in changes.items())
+            print(f'\033[33mState of board {self.board_id} corrected from its status: {corrections}\033[0m')
+            with log_writer.open_log(self.log_file) as log:
+                log.write(f'State corrected from board status at {t_status}: {corrections}\n')
+                log.write('\n')
+        if print_flag:
+            print(f'\nStatus of board {self.board_id} at {status["t"]/1000:.3f} s since reset:')
+            print(f'  operation: {status["op"]}' + (f' ({status["rem"]/1000:.3f} s left)' if status['rem'] else ''))
+            print(f'  LED={status["led"]} trigger={status["trig"]} continuous pulse={status["pulse"]}')
+            for name, led in self.led_channels.items():
+                if 0 < led.index < len(status['leds']):
+                    channel = status['leds'][led.index]
+                    print(f'  {name} LED: operation {channel["op"]}' + (f' ({channel["rem"]/1000:.3f} s left)' if channel['rem'] else '') +
+                          f', LED={channel["led"]} continuous pulse={channel["pulse"]}')
+            print(f'  pump={status["pump"]} (PWM {status["pwm"]}) air={status["air"]} odor_a={status["odor_a"]} odor_b={status["odor_b"]}')
+            print(f'  shock={status["shock"]} (output {status["shock_pin"]}) trigger train={status.get("train", 0)}')
+        return 0
+    
+    def pull_board_events(self, print_flag=False):
+        '''pull the output changes recorded by the board since the last pull and write them to the log file'''
+        if not self.ser or not self.events_supported:
+            return 1
+        events, lost = playstim.read_events(self.ser)
+        if events is None:
+            self.events_supported = False
+            print('\033[33mThe firmware does not record output events, please update it to arduino_communication_6. Event logging is disabled.\033[0m')
+            return 1
+        if events or lost:
+            playstim.log_events(self.log_file, events, lost)
+        if lost:
+            print(f'\033[33m{lost} output events of board {self.board_id} were lost as its ring buffer was full, pull them more often with "events"\033[0m')
+        if print_flag:
+            print(f'{len(events)} output events of board {self.board_id} written to {self.log_file}')
+            for t_event, pin, value, t_pc in events[-10:]:
+                print(f'  {playstim.OUTPUT_PINS.get(pin, f"pin {pin}")} {"ON" if value == 1 else "OFF" if value == 0 else f"PWM {value}"} '
+                      f'at {t_pc.strftime("%H:%M:%S.%f")} (board {t_event} us)')
+        return 0
+
+    def replay_controller(self, key_input):
+        '''replay the last session of a record on this controller, or dry ("replay:<record>:dry"), see replay.py'''
+        record = key_input[len('replay:'):]
+        dry = record.endswith(':dry')
+        if dry:
+            record = record[:-len(':dry')]
+        if not os.path.exists(record):
+            record = os.path.join(self.save_path, record)
+        if not os.path.exists(record):
+            print(f'Record not found: {record}')
+            return 1
+        if record == self.log_file or record.startswith(self.log_file[:-len('_log.txt')] + '_'):
+            log_writer.flush(self.log_file) # the events queued so far are part of the record
+        session_replay = replay.Replay(replay.read_commands(record), None if dry else self)
+        if not session_replay.commands:
+            print(f'No command to replay in {record}')
+            return 1
+        span = (session_replay.commands[-1]['t_ns'] - session_replay.commands[0]['t_ns']) / 1e9
+        print(f'Replaying {len(session_replay.commands)} commands over {span:.1f} s' + (' (dry run)' if dry else '') + '...')
+        rows = session_replay.run()
+        replay.print_report(rows)
+        report = self.log_file[:-len('_log.txt')] + f'_replay_{datetime.now().strftime("%H%M%S")}.csv'
+        replay.write_report(report, rows)
+        print(f'Replay report saved to {report}')
+        with log_writer.open_log(self.log_file) as log:
+            log.write(f'Replay of {record} ({len(rows)} commands{", dry run" if dry else ""}) done at {EventTime.now()}, report: {report}\n\n')
+        return 0 if all(row['result'] == 0 for row in rows) else 1
+
+    def last_event(self, key_input):
+        '''print the latest event of a type recorded in the event store of the session, e.g. "last:LED:on"'''
+        store = log_writer.event_log(self.log_file)
+        if store is None:
+            print('\033[33mThe events of this session are not stored, set log_event_store = True\033[0m')
+            return 1
+        event_type, _, value = key_input[len('last:'):].partition(':')
+        event = store.last(event_type, value=value or None)
+        if event is None:
+            print(f'No "{key_input[len("last:"):]}" event in this session')
+            return 0
+        count = len(store.query(event_type, value=value or None))
+        print(f"Last {event['type']} event ({count} in the session): {event['target']} {event['value']} "
+              f"at {event['wall'].strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]} (command {event['command']}, {self.stim_name} = {event['stimulus']})")
+        return 0
+
+    @staticmethod
+    def LED_channel_status(channel):
+        '''mirrored state of an LED channel from its entry {'op', 'rem', 'led', 'pulse'} in the status of the board'''
+        # the static LED is the LED held by "on" (or "pin:"), not by a timer or a pulsing operation
+        static_LED = channel['led'] if channel['op'] not in ['r', 'p'] and not channel['pulse'] else 0
+        if channel['pulse']:
+            led_mode = 'continuous'
+        elif channel['op'] == 'p':
+            led_mode = 'pulse'
+        elif static_LED or channel['op'] == 'r':
+            led_mode = 'static'
+        else:
+            led_mode = 'off'
+        return {'LED_state': static_LED, 'continuous_pulse_state': bool(channel['pulse']), 'led_mode': led_mode}
+
+    def reconcile_state_if_due(self):
+        '''reconcile the mirrored hardware states if status_interval has passed since the last snapshot'''
+        if self.status_interval > 0 and time.time() - self.t_last_status >= self.status_interval:
+            return self.reconcile_state()
+        return 0
+
+    def log_segments(self):
+        '''segment_size and segment_interval of the log writers'''
+        return {'segment_size': int(self.log_segment_size * 1e6), 'segment_interval': self.log_segment_interval * 3600}
+
+    def start_session_container(self, log_file, ser):
+        '''start the HDF5 session container of a log file if session_container is set, with the settings of the controller'''
+        if not self.session_container:
+            return None
+        config = {field.name: getattr(self, field.name) for field in fields(self)
+                  if isinstance(getattr(self, field.name), (str, int, float, bool, list, tuple, dict, type(None)))}
+        container = session_file.start(log_file, config, self.log_flush_interval, self.log_fsync_interval)
+        session_file.trace(log_file, ser)
+        return container
 
     def write_protocols(self, key_input, skip_isi = False):
         '''write current command to local protocol file'''
@@ -952,7 +1622,7 @@ class StimController:
             self.t_last_stim = self.t_stim_end
             cmd_write = f'ISI {t_interval:.3f}'
             cmt_write = f'inter-stimulus interval: {t_interval:.3f} s'
-            with open(self.protocol_saveas,'a') as f:
+            with log_writer.open_log(self.protocol_saveas) as f:
                 f.write(cmd_write + ' '*(40-len(cmd_write)) + ' # ' + cmt_write + '\n\n')
         else:
             self.t_last_stim = time.time()
@@ -968,12 +1638,28 @@ class StimController:
         elif key_input == 'bell':
             cmd_write = 'Bell'
             cmt_write = 'play a bell sound reminder'
+        elif '@' in key_input:
+            command, delay = key_input.split('@', 1)
+            cmd_write = key_input
+            cmt_write = f'{command} run by the board {delay} s later'
         elif key_input == 'v':
             cmd_write = 'Play ' + str(self.play_times)
             cmt_write = 'playing video for ' + str(self.play_times) + ' times'
         elif key_input == 'stim' or key_input == self.stim_name:
             cmd_write = f'{self.stim_name} ' + str(self.stimulus)
             cmt_write = f'set {self.stim_name} to {self.stimulus}'
+        elif self.split_LED_channel(key_input)[1] is not None:
+            base, channel = self.split_LED_channel(key_input)
+            led = self.LED_channel(channel)
+            cmd_write = key_input
+            if base == 'r':
+                cmt_write = f'{channel} LED ' + ('ON' if led.LED_state else 'OFF')
+            elif base[0] == 'r':
+                cmt_write = f'{channel} LED ON for {base[1:]} s'
+            elif base == 'p':
+                cmt_write = f'{channel} LED pulsing for {self.pulse_span} s at {self.pulse_frequency} Hz with {self.pulse_width} ms pulse width'
+            else:
+                cmt_write = f'{channel} continuous pulse ' + ('ON' if led.continuous_pulse_state else 'OFF')
         elif key_input[0] == 'r' and key_input != 'run':
             if key_input == 'r':
                 cmd_write = 'LED'
@@ -994,6 +1680,14 @@ class StimController:
         elif key_input == 'trig':
             cmd_write = 'Trigger'
             cmt_write = 'send a 100ms trigger signal on the trigger_pin'
+        elif key_input in playstim.TRIGGER_TRAIN_COMMANDS:
+            cmd_write = 'Trigger_train ' + key_input[5:]
+            if key_input == 'trig:on':
+                cmt_write = f'start the frame trigger train at {self.trigger_frequency} Hz with {self.trigger_pulse_width} ms pulse width'
+            elif key_input == 'trig:off':
+                cmt_write = 'stop the frame trigger train'
+            else:  # trig:count
+                cmt_write = 'read the pulse count of the frame trigger train'
         elif key_input.lower().startswith('isi'):
             t_interval = float(key_input[3:])
             cmd_write = f'ISI {t_interval:.3f}'
@@ -1007,6 +1701,8 @@ class StimController:
                 cmt_write = 'turn pump ON'
             elif key_input == 'pump:off':
                 cmt_write = 'turn pump OFF'
+            elif self.is_output_timer(key_input):
+                cmt_write = f'run pump for {key_input[6:]} s, then close all valves'
             else:  # pump:value:XXX
                 value = key_input.split(':')[2]
                 cmt_write = f'set pump value to {value}/255'
@@ -1026,6 +1722,8 @@ class StimController:
                 cmt_write = 'toggle air valve'
             elif key_input == 'air:on':
                 cmt_write = 'open air valve'
+            elif self.is_output_timer(key_input):
+                cmt_write = f'open air valve for {key_input[5:]} s'
             else:  # air:off
                 cmt_write = 'close air valve'
         elif key_input == 'odor_a' or key_input.startswith('odor_a:'):
@@ -1034,6 +1732,8 @@ class StimController:
                 cmt_write = 'toggle odor A valve'
             elif key_input == 'odor_a:on':
                 cmt_write = 'open odor A valve'
+            elif self.is_output_timer(key_input):
+                cmt_write = f'open odor A valve for {key_input[8:]} s'
             else:  # odor_a:off
                 cmt_write = 'close odor A valve'
         elif key_input == 'odor_b' or key_input.startswith('odor_b:'):
@@ -1042,8 +1742,13 @@ class StimController:
                 cmt_write = 'toggle odor B valve'
             elif key_input == 'odor_b:on':
                 cmt_write = 'open odor B valve'
+            elif self.is_output_timer(key_input):
+                cmt_write = f'open odor B valve for {key_input[8:]} s'
             else:  # odor_b:off
                 cmt_write = 'close odor B valve'
+        elif key_input.startswith('wave:'):
+            cmd_write = key_input
+            cmt_write = 'stop the waveform' if key_input == 'wave:stop' else f'play the {key_input.split(":")[1]} waveform on the board'
         elif key_input == 'stop':
             cmd_write = 'Stop'
             cmt_write = 'send quit command to Arduino to terminate all operations'
@@ -1067,10 +1772,10 @@ class StimController:
             
         # Only write if we have valid command and comment
         if cmd_write and cmt_write:
-            with open(self.protocol_saveas,'a') as f:
+            with log_writer.open_log(self.protocol_saveas) as f:
                 f.write(cmd_write + ' '*(40-len(cmd_write)) + ' # ' + cmt_write + '\n\n')
             # write to log
-            with open(self.log_file, 'a') as log:
+            with log_writer.open_log(self.log_file) as log:
                 log.write(f'Executed: {cmd_write} # {cmt_write}\n\n')
         
         return 0
@@ -1080,7 +1785,8 @@ class StimController:
         if os.path.exists(self.protocol_dir) == False:
             print('Not found the protocol folder. Please create one first.')
             return
-        protocol_files = [file for file in os.listdir(self.protocol_dir) if file.endswith('.txt')]
+        protocol_files = [file for file in os.listdir(self.protocol_dir) if file.endswith('.txt')
+                          and not re.search(r'\.\d{4}\.txt$', file)] # not the closed segments of an autosaved protocol
         protocol_files.sort()
         protocol_files = list(reversed(protocol_files))
         if len(protocol_files) == 0:
@@ -1094,8 +1800,7 @@ class StimController:
             protocol_input = int(protocol_input)
             if protocol_input in range(1,len(protocol_files)+1):
                 protocol_file = protocol_files[protocol_input-1]
-                with open(os.path.join(self.protocol_dir,protocol_file),'r') as f:
-                    protocol = f.readlines()
+                protocol = list(log_writer.read_lines(os.path.join(self.protocol_dir,protocol_file))) # with its closed segments
                 for line in protocol:
                     line = line[:-1] # remove the '\n' at the end of each line
                     if len(line) > 1 and line[0] != '#':
@@ -1143,11 +1848,13 @@ class StimController:
                         self.update_mutable_attr(''.join(cmd[1:]))
                     elif cmd[0].lower() == 'trigger':
                         self.send_trigger()
+                    elif cmd[0].lower() == 'trigger_train' and cmdlen == 2:
+                        self.trigger_train_controller(f'trig:{cmd[1]}')
                     # Add handling for new commands in protocol parser
                     elif cmd[0].lower() == 'pump':
                         if cmdlen == 1:
                             self.pump_controller('pump')
-                        elif cmdlen == 2 and cmd[1] in ['on', 'off']:
+                        elif cmdlen == 2 and (cmd[1] in ['on', 'off'] or self.is_output_timer(f'pump:{cmd[1]}')):
                             self.pump_controller(f'pump:{cmd[1]}')
                         elif cmdlen == 3 and cmd[1] == 'value':
                             self.pump_controller(f'pump:value:{cmd[2]}')
@@ -1159,17 +1866,17 @@ class StimController:
                     elif cmd[0].lower() == 'air':
                         if cmdlen == 1:
                             self.valve_controller('air')
-                        elif cmdlen == 2 and cmd[1] in ['on', 'off']:
+                        elif cmdlen == 2 and (cmd[1] in ['on', 'off'] or self.is_output_timer(f'air:{cmd[1]}')):
                             self.valve_controller(f'air:{cmd[1]}')
                     elif cmd[0].lower() == 'odor_a':
                         if cmdlen == 1:
                             self.valve_controller('odor_a')
-                        elif cmdlen == 2 and cmd[1] in ['on', 'off']:
+                        elif cmdlen == 2 and (cmd[1] in ['on', 'off'] or self.is_output_timer(f'odor_a:{cmd[1]}')):
                             self.valve_controller(f'odor_a:{cmd[1]}')
                     elif cmd[0].lower() == 'odor_b':
                         if cmdlen == 1:
                             self.valve_controller('odor_b')
-                        elif cmdlen == 2 and cmd[1] in ['on', 'off']:
+                        elif cmdlen == 2 and (cmd[1] in ['on', 'off'] or self.is_output_timer(f'odor_b:{cmd[1]}')):
                             self.valve_controller(f'odor_b:{cmd[1]}')
                     elif cmd[0].lower() == 'stop':
                         self.stop_arduino()
@@ -1191,20 +1898,29 @@ class StimController:
         key_input = key_input[3:]
         if key_input.replace('.','').isnumeric():
             seconds = float(key_input)
+            log_writer.log_event(self.log_file, 'isi', '', seconds)
             t_start = time.time()
             t_wait = seconds
             t_elapsed = 0
-            print_interval = 0.1  # How often to update the display (in seconds)
-            last_print_time = t_start
-            while t_elapsed < t_wait:
-                t_elapsed = time.time()-t_start
-                current_time = time.time()
-                if current_time - last_print_time >= print_interval:
-                    total_left_time = self.estimated_total_time - (time.time() - self.execution_start)
-                    print(f'\rInter-stimulus interval left: {t_wait-t_elapsed:.1f} s. Total left: {total_left_time:.1f} s. (Press <Ctrl+C>) to interrupt)', end='    ')
-                    last_print_time = current_time
-            # Print final 0.0 seconds when loop complete
-            print(f'\rInter-stimulus interval left time: 0.0 s', end ='                                                                                              \n')
+            t_status = self.hardware_latency('status') # a status round trip started later would delay the end of the ISI
+            # the countdown is rendered by the status thread, this loop only keeps the time
+            status_renderer.show(lambda: f'Inter-stimulus interval left: {max(t_wait - (time.time() - t_start), 0):.1f} s. '
+                                         f'Total left: {self.estimated_total_time - (time.time() - self.execution_start):.1f} s. '
+                                         '(Press <Ctrl+C>) to interrupt)')
+            try:
+                while t_elapsed < t_wait:
+                    if self.abort_event.is_set():
+                        status_renderer.clear()
+                        print()
+                        return 1
+                    if t_wait - t_elapsed > t_status:
+                        self.reconcile_state_if_due()
+                    t_elapsed = time.time()-t_start
+                # Print final 0.0 seconds when loop complete
+                status_renderer.clear('Inter-stimulus interval left time: 0.0 s')
+            finally:
+                status_renderer.clear()
+            print()
             return 0
         else:
             print('Invalid input. Please input a number.')
@@ -1246,6 +1962,9 @@ class StimController:
                 "pulse_frequency: float or int, unit: Hz, precision: 0.001 Hz",
                 "pulse_width: int, unit: ms",
                 "stimulus: int, should be in the candidate list, unit: ms",
+                "shock_frequency: float or int, unit: Hz, precision: 0.001 Hz",
+                "shock_pulse_width: int, unit: ms, shorter than the shock period",
+                "shock_pulse_count: int, number of pulses after 'shock:on', 0 for no limit",
             ],
             
             "show": [
@@ -1265,6 +1984,8 @@ class StimController:
                 "switch on/off red LED, an LED timer can be set by 'r[number]'",
                 "e.g. 'r' for switching on/off the LED",
                 "e.g. 'r5' for 5 seconds; 'r2.5' for 2.5 seconds",
+                f"LED channels {', '.join(self.LED_channels)} (LED_channels): 'r:<channel>' and 'r:<channel>X' address a channel, e.g. 'r:green5'",
+                "    every channel runs its own timer and pulse trains on the board, its log lines are tagged with its name",
             ],
             
             "t": [
@@ -1285,12 +2006,15 @@ class StimController:
                 "pulse_frequency: the frequency of the pulse train, unit: Hz (float, precision: 0.001 Hz)",
                 "pulse_width: the width of the pulse, unit: ms (int)",
                 "alternatively, you can use 'set:pulse_span = number' in sec to set the pulse_span, and so on, even when update_pulse = False",
+                "'p:<channel>' pulses the LED of a channel, e.g. 'p:green'",
             ],
             
             "pulse": [
                 '\033[32mpulse\033[0m: Toggle continuous pulse ON/OFF (uses pulse_frequency and pulse_width, but ignores pulse_span)',
                 '\033[32mpulse:on\033[0m: Turn continuous pulse ON',
                 '\033[32mpulse:off\033[0m: Turn continuous pulse OFF',
+                '\033[32mpulse:<channel>\033[0m, \033[32mpulse:<channel>:on/off\033[0m: the same for an LED channel, e.g. pulse:green:on;'
+                ' the continuous pulses of all channels run at the same time',
             ],
             
             "load": [
@@ -1309,8 +2033,15 @@ class StimController:
             "run":
                 "to run or not to run, that is the question.",
             
-            "trig": 
+            "trig": [
                 "send a 10-ms trigger signal on the trigger_pin of the Arduino",
+                f"usage: 'trig:on' to start a frame trigger train for the cameras ({self.trigger_frequency} Hz, {self.trigger_pulse_width} ms pulse width, "
+                f"{self.trigger_pulse_count if self.trigger_pulse_count else 'no limit of'} pulses), timed in microseconds by the board",
+                "usage: 'trig:count' to read the number of pulses so far with the board clock, which refines the frame times",
+                "usage: 'trig:off' to stop the train, the board reports the number of delivered pulses",
+                "set the train by 'set:trigger_frequency=X' (Hz), 'set:trigger_pulse_width=X' (ms) and 'set:trigger_pulse_count=X' (0 for no limit),",
+                "the PC time of frame k is written to the log file as '<time of frame 1> + (k-1) x <period>'",
+            ],
             
             "isi": [
                 "wait for the Inter-Stimulus Interval(ISI) in seconds",
@@ -1326,14 +2057,18 @@ class StimController:
                 "usage: 'pump:on' to turn on the pump",
                 "usage: 'pump:off' to turn off the pump",
                 "usage: 'pump:value:XXX' to set pump power value (0-255)",
+                "usage: 'pump:tX' to run the pump for X seconds, then the board closes all valves",
                 "e.g., 'pump:value:200' sets the pump to 200/255 power"
             ],
             
             "shock": [
-                "control the shock pulses (0.2 Hz, 1.25s pulse width)",
+                f"control the shock pulses ({self.shock_frequency} Hz, {self.shock_pulse_width} ms pulse width, "
+                f"{self.shock_pulse_count if self.shock_pulse_count else 'no limit of'} pulses)",
                 "usage: 'shock' to toggle shock pulses on/off",
                 "usage: 'shock:on' to start shock pulses",
-                "usage: 'shock:off' to stop shock pulses"
+                "usage: 'shock:off' to stop shock pulses, the board reports the number of delivered pulses",
+                "set the pulse train by 'set:shock_frequency=X' (Hz), 'set:shock_pulse_width=X' (ms) and 'set:shock_pulse_count=X' (0 for no limit),",
+                "    sent to the board at once, so the parameters can be changed between flies without reflashing"
             ],
             
             "air": [
@@ -1341,6 +2076,7 @@ class StimController:
                 "usage: 'air' to toggle air valve open/closed",
                 "usage: 'air:on' to open air valve",
                 "usage: 'air:off' to close air valve",
+                "usage: 'air:tX' to open air valve for X seconds, closed by the board without blocking the next commands",
                 "Note: Pump must be on to open valves"
             ],
             
@@ -1349,6 +2085,7 @@ class StimController:
                 "usage: 'odor_a' to toggle odor A valve open/closed",
                 "usage: 'odor_a:on' to open odor A valve",
                 "usage: 'odor_a:off' to close odor A valve",
+                "usage: 'odor_a:tX' to open odor A valve for X seconds, closed by the board without blocking the next commands",
                 "Note: Pump must be on to open valves"
             ],
             
@@ -1357,6 +2094,7 @@ class StimController:
                 "usage: 'odor_b' to toggle odor B valve open/closed",
                 "usage: 'odor_b:on' to open odor B valve",
                 "usage: 'odor_b:off' to close odor B valve",
+                "usage: 'odor_b:tX' to open odor B valve for X seconds, closed by the board without blocking the next commands",
                 "Note: Pump must be on to open valves"
             ],
             
@@ -1376,6 +2114,71 @@ class StimController:
                 "it may be unstable to set a digital pin to a value of 2-255, so please 0/1 for digital pins",
             ],
             
+            "wave": [
+                "upload a waveform table to the board and play it with microsecond timing, the board reports its start and end",
+                "usage: 'wave:<kind>:<name>=<value>,...' with the kinds",
+                "    'burst' (pin, bursts, pulses, frequency Hz, width ms, interval s)",
+                "    'ramp' (PWM pin, duration s, start, end, steps)",
+                "    'random' (pin, duration s, rate Hz, width ms, refractory ms, seed)",
+                "e.g. 'wave:burst:pin=5,bursts=3,pulses=5,frequency=20,width=10,interval=1'",
+                f"usage: 'wave:stop' to stop the waveform; a table holds at most {waveform.MAX_EVENTS} pin changes",
+            ],
+            
+            "bench": [
+                "measure the round-trip latency of every hardware command type on the connected board (or emulator)",
+                "usage: 'bench' for 20 round trips per command, 'bench:N' for N round trips",
+                "'bench:stress' ('bench:stress:S' for S seconds, default 5) floods the board with commands, including partial lines,",
+                "    during a continuous LED pulse (pulse_frequency, pulse_width) and checks the pulse timing (emulator) and the feedback",
+                "'bench:sim' runs the firmware model on a virtual clock (no board needed): checks the pulse widths, periods, delays",
+                "    and order of p, pulse, shock, trigger and scheduled commands, and the commands/s the loop absorbs at baud_rate",
+                "p50/p95/max latencies are saved per board in serial_latency.json and loaded at startup",
+                "the measured latencies replace the default 30 ms per command when estimating the duration of command series",
+                "\033[33mAll outputs (LED, pump, valves, shock) are toggled during the benchmark, please remove the flies first\033[0m",
+            ],
+            
+            "status": [
+                "query the board for all its outputs and the current operation in one round trip",
+                "the mirrored states of the controller (LED, pump, valves, shock, continuous pulse) are corrected from it",
+                f"done automatically before each command series and every {self.status_interval} s while idle (status_interval, 0 to disable)",
+            ],
+            
+            "events": [
+                "pull the output changes recorded by the board since the last pull and write them to the log file",
+                "each change (LED, trigger, pump, valves, shock, pulse edges) is logged with its board micros() time",
+                "the board keeps the last 48 changes and sends them in compact binary, without printing a line per edge",
+                "done automatically after each command series and at the end of the session (log_board_events)",
+            ],
+            
+            "last": [
+                "print the latest event of a type recorded in the event store of the session, and the number of such events",
+                "usage: 'last:<type>' or 'last:<type>:<value>', e.g. 'last:LED:on', 'last:valve:off', 'last:command', 'last:board'",
+                "the types and values are those of the CSV event file, the store is read without scanning the log (log_event_store)",
+            ],
+            
+            "replay": [
+                "replay the commands of a recorded session at their recorded times and report how late each one was issued",
+                "usage: 'replay:<record>', the CSV event file, event store, session container or log file of the session,",
+                "    a file name is looked up in save_path; 'replay:<record>:dry' keeps the schedule without running the commands",
+                "the commands run on this controller (board or emulator), the ISIs are the gaps of the schedule",
+                "the deviation and duration of each command are saved to '<date>_<name>_replay_<time>.csv' next to the log file",
+            ],
+            
+            "cmd@X": [
+                "let the board run a hardware command X seconds later on its own clock, without waiting for it",
+                "works with 'trig', 'pump:on/off', 'shock:on/off', 'air/odor_a/odor_b:on/off', the ':tX' timers and 'pin:' commands",
+                "e.g. 'air:on@0.5' opens the air valve 0.5 s after the board received the command",
+                "in a command series, such a command following an 'isi' is pre-armed this way during the ISI (prearm, default True)",
+            ],
+            
+            "boards": [
+                "list the connected boards, set multi_board=True in StimController to connect to all boards of board_type",
+                "address a command or a command series to boards by '@<board> <command>', boards run concurrently",
+                "e.g. '@2 r5' for board 2; '@1,3 pump:on > isi5 > pump:off' for boards 1 and 3; '@all shock:on' for all boards",
+                "boards can also be addressed by their USB serial number, e.g. '@75834353035351F0B0A1 trig'",
+                "commands without '@<board>' are executed on board 1",
+                "video commands are not board specific and cannot be addressed; settings (set:) are shared by all boards",
+            ],
+            
             "\033[33mcombined commands\033[0m": [
                 "You can combine multiple commands with '>'",
                 "e.g. r5>isi5>set:pulse_span=10>p",
@@ -1451,17 +2254,24 @@ class StimController:
         while True:
             try:
                 execute_state = None
+                for view in self.board_views.values(): # the boards are idle while waiting for input
+                    view.reconcile_state_if_due()
                 key_input = input(self.prompt)
                 self.ClearSerialBuffer()
                 
                 # Log the original input command with a timestamp
                 if self.log_file:
-                    with open(self.log_file, 'a') as log:
+                    with log_writer.open_log(self.log_file) as log:
                         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                         log.write(f"[{timestamp}] Input: {key_input}\n")
                 
+                # Check for commands addressed to boards, e.g. "@2 r5" or "@all pump:on"
+                if key_input.startswith('@'):
+                    execute_state = self.board_command(key_input)
+                    continue
+                
                 # Check for shortcut creation syntax
-                if '<-' in key_input:
+                elif '<-' in key_input:
                     parts = key_input.split('<-', 1)
                     shortcut_name = parts[0].strip()
                     command_series = parts[1].strip()
@@ -1486,9 +2296,13 @@ class StimController:
                     elif execute_state == 0: # Write the command to the protocol file
                         log_cmd = key_input if key_input in self.shortcuts else validated_cmd
                         self.write_protocols(log_cmd, skip_isi=log_cmd.lower().startswith('isi'))
+            except serial_link.SerialReconnected as e:
+                # the board came back and its outputs were restored, but the command waiting for feedback is lost
+                print(f'\n\033[33m{str(e)}, the last command was interrupted. Please check and repeat it.\033[0m')
+                continue
             except KeyboardInterrupt:
                 print('\n\033[33mKeyboard Interrupt detected!\033[0m')
-                self.stop_arduino()
+                self.stop_all_boards()
                 go_on = input('\033[33mDo you want to Continue(Y) or Terminate(n) the program? (Y/n): \033[0m')
                 if go_on.lower() == 'y':
                     print('Continuing the program...')
@@ -1500,7 +2314,7 @@ class StimController:
                 # Print traceback for better debugging
                 import traceback
                 traceback.print_exc()
-                self.stop_arduino()
+                self.stop_all_boards()
                 break
                 
             #     # Validate single command
@@ -1597,7 +2411,7 @@ class StimController:
         
         t_timeout = 5  # timeout in seconds
         self.ser.write(b'trigger\n')
-        t_trigger = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        t_trigger = EventTime.now()
         print('Sending trigger signal...')
         
         # Wait for feedback from Arduino
@@ -1609,18 +2423,23 @@ class StimController:
             if self.ser.inWaiting() > 0:
                 fb = self.ser.readline().decode()[:-1]
                 if fb == 'Trigger ON':
-                    t_trigger_on = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                    t_trigger_on = EventTime.now()
                     # print(fb)
                 elif fb == 'Trigger OFF':
-                    t_trigger_off = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                    t_trigger_off = EventTime.now()
                     # print(fb)
                     print('Trigger signal sent successfully.')
                     break
-                else:
+                elif fb.startswith('Error:'): # e.g. the frame trigger train holds the trigger output
+                    print(f'\033[31m{fb}\033[0m')
+                    return 1
+                elif not playstim.defer_feedback(self.ser, fb):
                     raise ValueError(f'Wrong feedback from Arduino: {fb}')
         
         # Log the trigger event
-        with open(self.log_file, 'a') as log:
+        log_writer.log_event(self.log_file, 'trigger', 'trigger', 'on', t_trigger_on)
+        log_writer.log_event(self.log_file, 'trigger', 'trigger', 'off', t_trigger_off)
+        with log_writer.open_log(self.log_file) as log:
             log.write('Trigger sent at {}\n'.format(t_trigger))
             log.write('Feedback Trigger ON at {}\n'.format(t_trigger_on))
             log.write('Feedback Trigger OFF at {}\n'.format(t_trigger_off))
@@ -1638,7 +2457,7 @@ class StimController:
         commands = expanded_cmd_series.split('>')
         validated_commands = []
         
-        # Hardware communication delay constant (seconds)
+        # Hardware communication delay (seconds) of commands that have not been benchmarked, see "bench"
         HARDWARE_DELAY = 0.03  # Estimated average delay per hardware command
         
         # First, validate all commands in the series
@@ -1663,10 +2482,11 @@ class StimController:
         expected_durations = {}  # Dictionary to store expected duration for each command
         pulse_span_changed = None
         for i, cmd in enumerate(validated_commands):
-            if cmd.startswith('r') and cmd != 'run' and len(cmd) > 1:
-                # LED command with duration (e.g., 'r5')
+            led_cmd, _ = self.split_LED_channel(cmd) # the same duration on every LED channel
+            if led_cmd.startswith('r') and led_cmd != 'run' and len(led_cmd) > 1:
+                # LED command with duration (e.g., 'r5', 'r:green5')
                 try:
-                    duration = float(cmd[1:])
+                    duration = float(led_cmd[1:])
                     total_command_time += duration
                     expected_durations[i] = duration
                 except ValueError:
@@ -1675,7 +2495,7 @@ class StimController:
             elif cmd.startswith('set:pulse_span'):
                 span_str = cmd.split('=')[1].strip()
                 pulse_span_changed = float(span_str)
-            elif cmd == 'p':
+            elif led_cmd == 'p':
                 # Pulse command uses pulse_span
                 if pulse_span_changed is not None:
                     total_command_time += pulse_span_changed
@@ -1702,22 +2522,28 @@ class StimController:
                 # Bell command, no duration
                 total_command_time += 2.4
                 expected_durations[i] = 2.4
+            elif cmd.startswith('wave:') and cmd != 'wave:stop':
+                # Waveform played by the board, waited for until its end
+                kind, params = waveform.parse_pattern(cmd[5:])
+                duration = waveform.duration(waveform.compile_pattern(kind, **params))
+                total_command_time += duration
+                expected_durations[i] = duration
             else:
                 # Other commands
                 total_command_time += 0
                 expected_durations[i] = 0
         
         # Calculate total hardware overhead time - excluding ISI commands which don't require hardware communication
-        # Calculate total hardware overhead - only count commands after the last ISI
+        # Calculate total hardware overhead - only count commands after the last ISI, using the measured latency of each command
         if isi_indices:
             # Find the index of the last ISI command
             last_isi_index = max(isi_indices)
             # Count commands after the last ISI
-            commands_after_last_isi = len(validated_commands) - last_isi_index - 1
-            residue_hardware_overhead = commands_after_last_isi * HARDWARE_DELAY
+            commands_after_last_isi = validated_commands[last_isi_index+1:]
         else:
             # If no ISI commands exist, count all commands
-            residue_hardware_overhead = len(validated_commands) * HARDWARE_DELAY
+            commands_after_last_isi = validated_commands
+        residue_hardware_overhead = sum(self.hardware_latency(cmd, default=HARDWARE_DELAY) for cmd in commands_after_last_isi)
             
         self.estimated_total_time = sum(expected_durations.values()) + residue_hardware_overhead
         # Copy commands without pre-adjusting ISI durations
@@ -1729,9 +2555,11 @@ class StimController:
             print(f"Found {len(isi_indices)} ISI commands that will be dynamically adjusted during execution")
             
         # Now execute the validated commands
+        self.reconcile_state() # start the series from the actual state of the board
         print(f"Executing command series: {' > '.join(validated_commands)}")
         # write to log
-        with open(self.log_file, 'a') as log:
+        log_writer.log_event(self.log_file, 'series', '', 'start')
+        with log_writer.open_log(self.log_file) as log:
             log.write(f"Executing command series: {' > '.join(validated_commands)}\n")
         results = []
         
@@ -1742,8 +2570,14 @@ class StimController:
         
         # Record the start time once for the whole series
         self.t_last_stim = time.time()
+        prearmed = None # index of the command scheduled on the board during the preceding ISI
         
         for i, cmd in enumerate(adjusted_commands):
+            if self.abort_event.is_set(): # interrupted while running on several boards
+                print(f"Command series on board {self.board_id} aborted at command {i+1}: '{cmd}'")
+                results.append(1)
+                break
+            
             # Record command start time
             command_start_times[i] = time.time()
             
@@ -1758,16 +2592,35 @@ class StimController:
                 # If accumulated_drift is positive, we're ahead of schedule, so increase ISI
                 # If accumulated_drift is negative, we're behind schedule, so decrease ISI
                 # adjusted_duration = max(0.1, original_duration + accumulated_drift)
-                adjusted_duration = max(0, original_duration + accumulated_drift)
+                # End the ISI earlier by the one-way latency of the next command (measured by "bench"), so the board executes it on schedule
+                next_latency = self.hardware_latency(adjusted_commands[i+1], default=0) / 2 if i+1 < len(adjusted_commands) else 0
+                adjusted_duration = max(0, original_duration + accumulated_drift - next_latency)
+                
+                # Pre-arm the next hardware command: the board runs it at the end of the ISI on its own clock,
+                # so its onset does not depend on when the PC wakes up and on the jitter of the USB latency
+                next_form = self.schedulable(adjusted_commands[i+1]) if i+1 < len(adjusted_commands) and self.prearm else None
+                if next_form is not None:
+                    t_schedule = time.time()
+                    if playstim.schedule_command(self.ser, self.log_file, next_form[0], adjusted_duration):
+                        prearmed = i + 1
+                        print(f"Pre-armed '{adjusted_commands[i+1]}' on the board in {adjusted_duration:.3f}s")
+                        adjusted_duration = max(0, adjusted_duration - (time.time() - t_schedule))
+                    else:
+                        self.prearm = False # firmware without scheduling, send the commands on time instead
                 
                 if abs(accumulated_drift) > 0.001:  # Only report if drift is significant
                     drift_direction = "ahead of" if accumulated_drift > 0 else "behind"
                     print(f"Timing drift: {abs(accumulated_drift):.3f}s {drift_direction} schedule")
-                    print(f"Adjusting ISI from {original_duration:.3f}s to {adjusted_duration:.3f}s")
+                if abs(accumulated_drift) > 0.001 or next_latency > 0.001:
+                    print(f"Adjusting ISI from {original_duration:.3f}s to {adjusted_duration:.3f}s" + (f" (leading the next command by {next_latency:.3f}s)" if next_latency > 0.001 else ""))
                 
                 # Create a new ISI command with adjusted time
                 adjusted_isi = f"isi{adjusted_duration:.3f}"
                 result = self.process_command(adjusted_isi)
+            elif i == prearmed:
+                self.record_command(cmd) # run by the board at the end of the ISI, recorded for the replays
+                result = self.complete_prearmed(cmd)
+                prearmed = None
             else:
                 result = self.process_command(cmd)
                 
@@ -1779,7 +2632,7 @@ class StimController:
                 self.write_protocols(original_cmd, skip_isi=True)
             else:
                 # write to log
-                with open(self.log_file, 'a') as log:
+                with log_writer.open_log(self.log_file) as log:
                     log.write(f"Command {i+1} failed: {cmd}\n")
             
             # Calculate actual time taken for this command
@@ -1800,6 +2653,9 @@ class StimController:
                 print(f"Command series stopped at command {i+1}: '{cmd}'")
                 break
         
+        if prearmed is not None: # stopped before the pre-armed command was due
+            playstim.cancel_scheduled(self.ser, self.log_file)
+        
         # Report actual execution time and timing accuracy
         self.execution_time = time.time() - self.execution_start
         
@@ -1812,10 +2668,20 @@ class StimController:
             else:
                 print("Timing accuracy: Excellent (within 30 ms)")
         
+        log_writer.log_event(self.log_file, 'series', '', 'end')
+        if self.log_board_events: # the exact edges of the series, recorded by the board
+            self.pull_board_events()
         return 0 if all(r == 0 for r in results) else 1
 
+    def record_command(self, command):
+        """count a command of the session and record its 'command' event"""
+        self.command_index += 1
+        log_writer.set_context(self.log_file, command=self.command_index)
+        log_writer.log_event(self.log_file, 'command', '', command)
+
     def process_command(self, command):
         """Process a single command and return execution status"""
+        self.record_command(command)
         # Check if command is a shortcut
         if command in self.shortcuts:
             return self.execute_shortcut(command)
@@ -1828,6 +2694,12 @@ class StimController:
             return self.deliver_video_command(command)
         elif command == 'stim' or command == self.stim_name:
             return self.reset_stimulus()
+        elif command.startswith('replay:'):
+            return self.replay_controller(command)
+        elif '@' in command:
+            return self.scheduled_command_controller(command)
+        elif self.split_LED_channel(command)[1] is not None:
+            return self.LED_channel_controller(command)
         elif command[0] == 'r' and command != 'run':
             return self.LED_controller(command)
         elif command == 'p':
@@ -1844,6 +2716,8 @@ class StimController:
             return self.show_attr(command) or 0  # Ensure it returns 0 for success
         elif command == 'trig':
             return self.send_trigger()
+        elif command.startswith('trig:'):
+            return self.trigger_train_controller(command)
         elif command.lower().startswith('isi'):
             return self.wait_ISI(command)
         # Add new command handlers
@@ -1857,8 +2731,20 @@ class StimController:
             return self.valve_controller(command)
         elif command.startswith('odor_b:'):
             return self.valve_controller(command)
+        elif command.startswith('wave:'):
+            return self.waveform_controller(command)
         elif command == 'stop':
             return self.stop_arduino()
+        elif command == 'bench' or command.startswith('bench:'):
+            return self.benchmark_controller(command)
+        elif command == 'boards':
+            return self.list_boards()
+        elif command == 'status':
+            return self.reconcile_state(print_flag=True)
+        elif command == 'events':
+            return self.pull_board_events(print_flag=True)
+        elif command.startswith('last:'):
+            return self.last_event(command)
         # Existing commands
         elif command == 'h' or command.startswith('help'):
             return self.show_help(command)
@@ -1909,10 +2795,21 @@ class StimController:
            command == 'stim' or command.startswith('help') or \
            command == 'pump' or command == 'shock' or command == 'air' or \
            command == 'odor_a' or command == 'odor_b' or command == 'stop' or \
-           command == 'shortcuts' or command == 'pulse' or command == 'bell':
+           command == 'shortcuts' or command == 'pulse' or command == 'bell' or \
+           command == 'bench' or command == 'boards' or command == 'status' or command == 'events':
             return command
     
         # Commands with parameters
+        if '@' in command:
+            # Hardware command run later by the board, e.g. 'air:on@0.5'
+            return command if self.is_scheduled_command(command) else None
+        base, channel = self.split_LED_channel(command)
+        if channel is not None:
+            # LED command addressed to a channel, e.g. 'r:green5', 'p:red', 'pulse:green:on'
+            return command if self.validate_command(base) is not None else None
+        if command.startswith('replay:'):
+            # Replay of a recorded session, e.g. 'replay:20240501_fly1_events.csv' or 'replay:<record>:dry'
+            return command if len(command) > len('replay:') else None
         if command.startswith('v'):
             # Validate v[number] commands
             if len(command) > 1 and command[1:].isnumeric():
@@ -1954,6 +2851,8 @@ class StimController:
                 return None
             return command
         # New command validations
+        elif self.is_output_timer(command):
+            return command
         elif command.startswith('pump:'):
             if command in ['pump:on', 'pump:off'] or command.startswith('pump:value:'):
                 if command.startswith('pump:value:'):
@@ -1964,9 +2863,23 @@ class StimController:
         elif command.startswith('shock:'):
             if command in ['shock:on', 'shock:off']:
                 return command
+        elif command.startswith('trig:'):
+            if command in playstim.TRIGGER_TRAIN_COMMANDS:
+                return command
         elif command.startswith('pulse:'):
             if command in ['pulse:on', 'pulse:off']:
                 return command
+        elif command == 'bench:sim':
+            return command
+        elif command.startswith('bench:stress'):
+            if command == 'bench:stress' or (command.startswith('bench:stress:') and command[13:].replace('.','',1).isnumeric()):
+                return command
+        elif command.startswith('bench:'):
+            if command[6:].isnumeric() and int(command[6:]) > 0:
+                return command
+        elif command.startswith('last:'):
+            if len(command) > 5:
+                return command
         elif command.startswith('air:'):
             if command in ['air:on', 'air:off']:
                 return command
@@ -1976,6 +2889,9 @@ class StimController:
         elif command.startswith('odor_b:'):
             if command in ['odor_b:on', 'odor_b:off']:
                 return command
+        elif command.startswith('wave:'):
+            if self.is_waveform_valid(command, print_flag=True):
+                return command
         elif command.startswith('pin:'):
             # Validate pin commands
             parts = command.split(':')
@@ -2009,6 +2925,9 @@ class StimController:
             self.pump_state = playstim.pump_switch(self.pump_state, self.ser, self.log_file, turn_on=True)
         elif key_input == 'pump:off':  # Turn off pump
             self.pump_state = playstim.pump_switch(self.pump_state, self.ser, self.log_file, turn_on=False)
+        elif self.is_output_timer(key_input):  # Run the pump for given time
+            if playstim.output_timer('pump', self.ser, self.log_file, float(key_input[6:])):
+                self.pump_state = True
         elif key_input.startswith('pump:value:'):  # Set pump value
             value_str = key_input[11:]
             if value_str.isnumeric():
@@ -2029,8 +2948,48 @@ class StimController:
         
         return result
 
+    def trigger_train_controller(self, key_input='trig:on'):
+        '''Control the frame trigger train: start it, read its pulse count or stop it, and log the frame times'''
+        if key_input == 'trig:on':
+            if self.trigger_frequency <= 0 or self.trigger_pulse_width >= 1000 / self.trigger_frequency:
+                print(f'\033[31mTrigger train not started: the pulse width ({self.trigger_pulse_width} ms) must be shorter than the period\033[0m')
+                return 1
+            train = playstim.start_trigger_train(self.ser, self.log_file, self.trigger_frequency,
+                                                 self.trigger_pulse_width, self.trigger_pulse_count)
+            if train is None:
+                return 1
+            self.trigger_train = train
+            return 0
+        sample = playstim.sample_trigger_train(self.ser, self.log_file, stop=key_input == 'trig:off')
+        if sample is None:
+            return 1
+        pulses, t_board, t_pc = sample
+        self.ClearSerialBuffer() # "Trigger train done" of a train that ended before this sample
+        if self.trigger_train is None: # nothing to map, e.g. "trig:off" before any "trig:on"
+            print(f'Trigger train: {pulses} pulses')
+            return 0
+        if self.trigger_train['running']:
+            self.trigger_train['samples'].append((t_board, t_pc))
+            self.trigger_train['pulses'] = pulses
+        self.trigger_train['running'] = self.trigger_train['running'] and key_input != 'trig:off'
+        playstim.log_trigger_frames(self.log_file, self.trigger_train)
+        t_first, scale = playstim.trigger_clock_fit(self.trigger_train)
+        print(f'Trigger train {"running" if self.trigger_train["running"] else "stopped"}: {pulses} pulses, '
+              f'frame 1 at {t_first.strftime("%H:%M:%S.%f")[:-3]}, {1e6 / self.trigger_train["period"] / scale:.4f} Hz on the PC clock')
+        return 0
+
+    def trigger_frame_time(self, frame):
+        '''PC time (EventTime) of the trigger pulse of a frame of the last trigger train, 1 for the first frame'''
+        if self.trigger_train is None:
+            return None
+        return playstim.trigger_frame_times(self.trigger_train, [frame])[0]
+
     def shock_controller(self, key_input='shock'):
         '''Control shock pulses: turn on/off'''
+        if key_input in ['shock', 'shock:on'] and not self.shock_state and not self.shock_synced:
+            if self.apply_shock_parameters() != 0: # never start a train the board would run with other parameters
+                print('\033[31mShock pulses not started, please fix the shock parameters first\033[0m')
+                return 1
         if key_input == 'shock':  # Toggle shock state
             self.shock_state = playstim.shock_switch(self.shock_state, self.ser, self.log_file)
             return 0
@@ -2044,12 +3003,44 @@ class StimController:
             print('Invalid shock command')
             return 1
 
+    def is_waveform_valid(self, command, print_flag=False):
+        '''whether a "wave:stop" or "wave:<kind>:<name>=<value>,..." command compiles into a table the board can hold'''
+        if command == 'wave:stop':
+            return True
+        try:
+            kind, params = waveform.parse_pattern(command[5:])
+            waveform.compile_pattern(kind, **params)
+        except (ValueError, TypeError) as e:
+            if print_flag:
+                print(f'Invalid waveform: {e}')
+            return False
+        return True
+
+    def waveform_controller(self, key_input):
+        '''compile a waveform, upload its table to the board and play it, or stop it by "wave:stop"'''
+        if self.ser == '':
+            print('\nSerial communication is unavailable. Waveform cannot be played.\n')
+            return 1
+        if key_input == 'wave:stop':
+            return playstim.stop_waveform(self.ser, self.log_file)
+        try:
+            kind, params = waveform.parse_pattern(key_input[5:])
+            events = waveform.compile_pattern(kind, **params)
+        except (ValueError, TypeError) as e:
+            print(f'Invalid waveform: {e}')
+            return 1
+        commands = waveform.encode_commands(events)
+        print(f'Waveform {kind}: {len(events)} events, {waveform.duration(events):.3f} s, uploaded in {len(commands)} lines')
+        if playstim.upload_waveform(self.ser, self.log_file, commands) != 0:
+            return 1
+        return playstim.play_waveform(self.ser, self.log_file, waveform.duration(events))
+
     def valve_controller(self, key_input):
         '''Control air/odor valves: turn on/off'''
         valve_name = key_input.split(':')[0] if ':' in key_input else key_input
         self.last_valve_attempted = valve_name  # Track the last valve for error handling
         
-        if valve_name in ['air', 'odor_a', 'odor_b'] and ':on' in key_input and not self.pump_state:
+        if valve_name in ['air', 'odor_a', 'odor_b'] and (':on' in key_input or self.is_output_timer(key_input)) and not self.pump_state:
             print('\033[33mWarning: Cannot open valve - Pump is OFF\033[0m')
             return 1
         
@@ -2072,7 +3063,87 @@ class StimController:
             return playstim.valve_switch(valve_name, current_state, self.ser, self.log_file, turn_on=True)
         elif key_input == f'{valve_name}:off':
             return playstim.valve_switch(valve_name, current_state, self.ser, self.log_file, turn_on=False)
+        elif self.is_output_timer(key_input): # closed by the firmware when the time is up
+            duration = float(key_input.split(':t')[1])
+            return True if playstim.output_timer(valve_name, self.ser, self.log_file, duration) else current_state
         return current_state
+    
+    def schedulable(self, command):
+        '''
+        Firmware form of a hardware command that the board can run on its own clock
+        
+        Returns:
+            tuple: (firmware command, prefix of its feedback or None for "pin:" without feedback), None if the command cannot be scheduled
+        '''
+        if command == 'trig':
+            return 'trigger', 'Trigger ON'
+        if command in ['pump:on', 'pump:off']:
+            return command, 'Pump ' + command[5:].upper()
+        if command in ['shock:on', 'shock:off']: # sent on time otherwise, so the check of the shock parameters applies
+            return (command, 'Shock pulses ' + command[6:].upper()) if self.shock_synced else None
+        output = command.split(':')[0]
+        if output in playstim.VALVE_LABELS and command in [f'{output}:on', f'{output}:off']:
+            return command, playstim.VALVE_LABELS[output] + (' valve OPEN' if command.endswith(':on') else ' valve CLOSED')
+        if self.is_output_timer(command):
+            output, duration = command.split(':t')
+            return f'{output}:t{int(float(duration)*1000)}', 'Pump ON' if output == 'pump' else playstim.VALVE_LABELS[output] + ' valve OPEN'
+        if command.startswith('pin:') and self.validate_command(command):
+            return command, None
+        return None
+    
+    def is_scheduled_command(self, command):
+        '''whether the command is a schedulable hardware command followed by "@<seconds>"'''
+        command, _, delay = command.partition('@')
+        return self.schedulable(command) is not None and delay.replace('.', '', 1).isnumeric()
+    
+    def scheduled_command_controller(self, key_input):
+        '''send a hardware command "<command>@<seconds>" that the board runs after the delay, without waiting for it'''
+        command, delay = key_input.split('@', 1)
+        if self.ser == '':
+            print('\nSerial communication is unavailable. Command cannot be scheduled.\n')
+            return 1
+        firmware_command, feedback = self.schedulable(command)
+        if not playstim.schedule_command(self.ser, self.log_file, firmware_command, float(delay), feedback=feedback):
+            return 1
+        print(f'{command} will be run by the board in {float(delay):.3f} s') # the states follow its feedback
+        return 0
+    
+    def complete_prearmed(self, command, timeout=1):
+        '''
+        Wait for the feedback of a command that was scheduled on the board during the preceding ISI
+        
+        Returns:
+            int: 0 if the board ran the command, 1 otherwise
+        '''
+        _, expected = self.schedulable(command)
+        if expected is None: # "pin:" commands have no feedback
+            return 0
+        t_arduino = time.time()
+        while time.time() - t_arduino < timeout:
+            if self.ser.inWaiting() > 0:
+                fb = self.ser.readline().decode()[:-1]
+                self.process_feedback(fb)
+                if fb.startswith(expected): # the state was updated by process_feedback()
+                    t_fb = EventTime.now()
+                    with log_writer.open_log(self.log_file) as log:
+                        log.write(f'Feedback {fb} at {t_fb}\n')
+                        log.write('\n')
+                    event_type, output, value = playstim.output_feedback(fb)
+                    if self.is_output_timer(command):
+                        value += f' {command.split(":t")[1]} s' # like playstim.output_timer()
+                    log_writer.log_event(self.log_file, event_type, output, value, t_fb)
+                    print(fb)
+                    return 0
+                elif fb.startswith('Warning:') or fb.startswith('Error:'):
+                    return 1
+        print(f'\033[33mNo feedback from the board for the pre-armed command "{command}"\033[0m')
+        return 1
+    
+    @staticmethod
+    def is_output_timer(command):
+        '''whether the command opens a valve or runs the pump for given time: "<air|odor_a|odor_b|pump>:t<seconds>"'''
+        output, _, duration = command.partition(':t')
+        return output in ['air', 'odor_a', 'odor_b', 'pump'] and duration.replace('.', '', 1).isnumeric()
 
     def stop_arduino(self):
         """Send quit command to Arduino to terminate all operations"""
@@ -2083,7 +3154,8 @@ class StimController:
         result = playstim.quit_all_operations(self.ser, self.log_file)
         
         # Reset all state tracking variables related to Arduino operations
-        self.LED_state = 0
+        for led in self.led_channels.values():
+            led.LED_state = 0
         self.pump_state = False
         self.shock_state = False
         self.air_state = False
@@ -2107,17 +3179,19 @@ class StimController:
         print("\nUse a shortcut by typing its name")
         return 0
 
-    def continuous_pulse_controller(self, key_input='pulse'):
-        """Control the continuous pulse (toggle or explicit on/off)"""
+    def continuous_pulse_controller(self, key_input='pulse', channel=None):
+        """Control the continuous pulse of the LED channel (toggle or explicit on/off)"""
+        led = self.LED_channel(channel)
+        target = self.LED_target(led)
         if self.ser == '':
             print('\033[33mSerial port not available. Cannot control continuous pulse.\033[0m')
             return 1
         
         # Check if another LED mode is active and deactivate it
-        if key_input != 'pulse:off' and not (self.led_mode == 'continuous' and self.continuous_pulse_state):
-            if self.led_mode == 'static' and self.LED_state:
+        if key_input != 'pulse:off' and not (led.led_mode == 'continuous' and led.continuous_pulse_state):
+            if led.led_mode == 'static' and led.LED_state:
                 print(f"\n\033[33mTurning off static LED before switching to continuous pulse mode\033[0m")
-                self.LED_state = playstim.LED_switch(self.LED_state, self.ser, self.log_file, turn_on=False)
+                led.LED_state = playstim.LED_switch(led.LED_state, self.ser, self.log_file, turn_on=False, **target)
         
         # Set frequency and pulse width
         frequency = self.pulse_frequency
@@ -2126,37 +3200,40 @@ class StimController:
         try:
             if key_input == 'pulse':
                 # Toggle pulse state with current parameters
-                self.continuous_pulse_state = playstim.continuous_pulse_switch(
-                    self.continuous_pulse_state, 
+                led.continuous_pulse_state = playstim.continuous_pulse_switch(
+                    led.continuous_pulse_state, 
                     self.ser, 
                     self.log_file,
                     frequency=frequency,
-                    pulse_width=pulse_width
+                    pulse_width=pulse_width,
+                    **target
                 )
             elif key_input == 'pulse:on':
                 # Explicitly turn on with current parameters
-                self.continuous_pulse_state = playstim.continuous_pulse_switch(
-                    self.continuous_pulse_state, 
+                led.continuous_pulse_state = playstim.continuous_pulse_switch(
+                    led.continuous_pulse_state, 
                     self.ser, 
                     self.log_file, 
                     turn_on=True,
                     frequency=frequency,
-                    pulse_width=pulse_width
+                    pulse_width=pulse_width,
+                    **target
                 )
             elif key_input == 'pulse:off':
                 # Explicitly turn off
-                self.continuous_pulse_state = playstim.continuous_pulse_switch(
-                    self.continuous_pulse_state, 
+                led.continuous_pulse_state = playstim.continuous_pulse_switch(
+                    led.continuous_pulse_state, 
                     self.ser, 
                     self.log_file, 
-                    turn_on=False
+                    turn_on=False,
+                    **target
                 )
                 
             # Update the LED mode based on the new state
-            if self.continuous_pulse_state:
-                self.led_mode = 'continuous'
+            if led.continuous_pulse_state:
+                led.led_mode = 'continuous'
             else:
-                self.led_mode = 'off'
+                led.led_mode = 'off'
                 
         except Exception as e:
             print(f"\033[31mError controlling pulse: {str(e)}\033[0m")
@@ -2185,6 +3262,103 @@ class StimController:
             print(f'Error processing pin command: {str(e)}')
             return 1
         
+    def benchmark_controller(self, key_input='bench'):
+        '''measure the round-trip latency of each command type and save it as the latency model of the board'''
+        if key_input == 'bench:sim':
+            return self.simulation_controller()
+        if self.ser == '':
+            print('\nSerial communication is unavailable. Cannot benchmark the board.\n')
+            return 1
+        if key_input.startswith('bench:stress'):
+            return self.stress_test_controller(key_input)
+        repeats = int(key_input[6:]) if key_input.startswith('bench:') else 20
+        answer = input('\033[33mAll outputs (LED, pump, valves, shock) will be toggled. Continue? (Y/n): \033[0m')
+        if answer.lower() != 'y':
+            print('Benchmark cancelled.')
+            return 1
+        self.stop_arduino()
+        self.latency_model = serial_benchmark.benchmark_latency(self.ser, repeats=repeats)
+        serial_benchmark.save_latency_model(self.latency_file, self.board_id, self.latency_model, baud_rate=self.baud_rate)
+        self.stop_arduino() # the benchmark ends with all outputs off
+        print(f'Latency model of board {self.board_id} saved to {self.latency_file}')
+        with log_writer.open_log(self.log_file) as log:
+            log.write(f'Latency benchmark of board {self.board_id} ({repeats} round trips per command) at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\n')
+            for cmd_type, stats in self.latency_model.items():
+                log.write(f'{cmd_type}: p50 {stats["p50"]*1000:.2f} ms, p95 {stats["p95"]*1000:.2f} ms, max {stats["max"]*1000:.2f} ms\n')
+            log.write('\n')
+        return 0
+
+    def stress_test_controller(self, key_input='bench:stress'):
+        '''flood the board with commands during a continuous LED pulse and check the pulse timing, see serial_benchmark.stress_test()'''
+        duration = float(key_input[13:]) if key_input.startswith('bench:stress:') else 5
+        answer = input('\033[33mThe LED will pulse during the stress test. Continue? (Y/n): \033[0m')
+        if answer.lower() != 'y':
+            print('Stress test cancelled.')
+            return 1
+        self.stop_arduino()
+        results = serial_benchmark.stress_test(self.ser, duration=duration, frequency=self.pulse_frequency, pulse_width=self.pulse_width)
+        self.stop_arduino()
+        with log_writer.open_log(self.log_file) as log:
+            log.write(f'Stress test of board {self.board_id} ({duration} s) at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: ')
+            log.write(', '.join(f'{k} {v}' for k, v in results.items()) + '\n')
+            log.write('\n')
+        return 0 if results['passed'] is not False else 1
+
+    def simulation_controller(self):
+        '''check the pulse timing of the firmware model on a virtual clock and benchmark its command rate, see firmware_sim'''
+        print('\nPulse timing of the firmware on a virtual clock:')
+        results = firmware_sim.run_regression(baudrate=self.baud_rate)
+        print('\nCommand rate of the firmware loop:')
+        rates = firmware_sim.benchmark(baudrate=self.baud_rate)
+        failed = [name for name, errors in results.items() if errors]
+        with log_writer.open_log(self.log_file) as log:
+            log.write(f'Firmware simulation ({self.baud_rate} baud) at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}: ')
+            log.write(f'{len(results) - len(failed)}/{len(results)} timing cases passed' + (f' (failed: {", ".join(failed)})' if failed else ''))
+            log.write(f', up to {rates["lossless_rate"]:.0f} commands/s without loss\n\n')
+        return 0 if not failed else 1
+
+    def hardware_latency(self, command, default=0.03):
+        '''
+        Expected round-trip latency (s) of the serial communication of a command
+
+        Parameters:
+            command (str): validated command
+            default (float): latency used for hardware commands when the board has not been benchmarked
+
+        Returns:
+            float: p50 latency from the latency model of the board, default if not measured, 0 for commands without hardware communication
+        '''
+        command = self.split_LED_channel(command)[0]
+        if command == 'p' or command == 't' or (command[:1] == 'r' and command != 'run'):
+            cmd_type = 'led'
+        elif command.startswith('pump:value:'):
+            cmd_type = 'pump_value'
+        elif command == 'pump' or command.startswith('pump:'):
+            cmd_type = 'pump'
+        elif command.split(':')[0] in ['air', 'odor_a', 'odor_b']:
+            cmd_type = 'valve'
+        elif command == 'shock' or command.startswith('shock:'):
+            cmd_type = 'shock'
+        elif command == 'trig' or command.startswith('trig:'):
+            cmd_type = 'trigger'
+        elif command == 'pulse' or command.startswith('pulse:'):
+            cmd_type = 'pulse'
+        elif command == 'stop':
+            cmd_type = 'quit'
+        elif command == 'status':
+            cmd_type = 'status'
+        elif command.startswith('wave:') and command != 'wave:stop':
+            # "wave:clear", the "wave:add:" lines of the table and "wave:play", each waiting for its feedback
+            kind, params = waveform.parse_pattern(command[5:])
+            return default * (len(waveform.encode_commands(waveform.compile_pattern(kind, **params))) + 2)
+        elif command == 'wave:stop':
+            return default
+        else: # no feedback is awaited for "pin:", other commands do not communicate with the board
+            return 0
+        if cmd_type in self.latency_model:
+            return self.latency_model[cmd_type]['p50']
+        return default
+
     def bell_controller(self):
         """Play a bell sound as an audible reminder"""
         import stimfunc as playstim
@@ -2,10 +2,31 @@
 //* receiving command from PC to switch ON/OFF the LED or deliver pulses
 
 //* Note: for the "pulse" ("p") mode, pulse on is set at the start of the period.
+//* Note: timed actions (LED timer and pulse train, trigger, timed valves and pump) live in a table of timers serviced
+//*       every loop(), so actions on different outputs overlap instead of overwriting one another.
+//* Note: any command followed by "@<ms>" (e.g. "air:on@250") is kept and run <ms> later on the board clock, so its
+//*       onset does not depend on when the PC wakes up and on the USB latency.
+//* Note: waveform tables of (time, pin, value) events are uploaded by "wave:add:" lines and played on the micros()
+//*       clock by "wave:play", see waveform.py.
+//* Note: the LED channels (red on pin 5, green on pin 6) run their own operations, timers and pulse trains at the same
+//*       time; "ch<k>:" addresses channel k (e.g. "ch1:r5000"), which prefixes its feedback the same way. Plain LED
+//*       commands go to channel 0.
+//* Note: commands are read byte by byte into a fixed buffer and parsed in place, so loop() never waits for the rest
+//*       of a line and no String is allocated on the heap (the 2 KB SRAM of the Uno does not fragment).
+//* Note: "wd:<ms>" arms a watchdog that switches all outputs off when no line has come from the host for <ms>
+//*       (hung process or lost USB link), the host sends "hb" heartbeats while idle. The AVR watchdog resets the
+//*       board if loop() itself hangs.
+//* Note: every change of an output (but the indicator), including the edges of pulse trains, is recorded with its
+//*       micros() time in a ring buffer, pulled by the host in compact binary chunks with "events".
+//* Note: "trig:f<frequency x1000>w<us>n<count>" runs a train of frame trigger pulses for the cameras on the micros()
+//*       clock, alongside the other operations; "trig:count" reports the pulses so far, "trig:off" stops the train.
+//* Note: the feedback and command literals are kept in flash (F(), compared with strcmp_P()), the 2 KB SRAM of the Uno
+//*       holds the buffers and tables; the tables are sized to leave about 500 bytes to the stack.
 
-int pin_LED = 5; //* the pin_LED to control relay
-int pin_trigger = A0; //* the pin_LED to send trigger signal out
-int pin_indicator = 13; //* indicator for LED, coordiated with "pin_LED" and "pin_trigger"
+#include <avr/wdt.h>
+
+int pin_trigger = A0; //* the pin to send trigger signal out
+int pin_indicator = 13; //* indicator for LED, coordiated with the LED channels and "pin_trigger"
 
 int pin_air = 10; //* the pin_air to control relay for air passage
 int pin_odor_A = 11; //* the pin_odor_A to control relay for odor A 
@@ -16,30 +37,93 @@ int pin_pump = 3; //* the pin_pump to parse PWM signal to the air pump
 int pump_value = 200; //* the value to control the pump, 0-255
 
 const long baudRate = 9600;
-String light_switch; //* read command from serial
-
-//* parameters for pulsing at given frequency and duty cycle
-double frequency   = 0, //* pulsing frequency in 'p' mode
-       duty_cycle  = 0, //* not currently used, replaced by pulse_width
-       period      = 0; //* pulsing period in 'p' mode, calculated from frequency
-long   pulse_width = 0; //* specified pulse width
-unsigned long t_period  = 0, //* elapsed time of the current period
-              t0_period = 0, //* start time of a period
-              t_pulse   = 0; //* elapsed time of the current pulse
-boolean fpul = false; //* true: is in peak (pulse-on) phase; false: is in trough (pulse-off) phase
-long t_span = 0, //* time of pulse span, in ms
-     t_delay = 0; //* 
-int d_pos = 0,
-    f_pos = 0,
-    w_pos = 0,
-    len   = 0;
-
-//* State tracking variables for non-blocking operation
-String currentOperation = "none"; //* Current operation mode
-unsigned long operationStartTime = 0; //* When the operation started
-unsigned long operationEndTime = 0; //* When the operation should end
-unsigned long delayEndTime = 0; //* When the delay should end
-boolean isDelayed = false; //* If the operation is currently in delay
+const byte CMD_BUFFER_SIZE = 64; //* longest command + 1, longer lines are rejected
+char light_switch[CMD_BUFFER_SIZE]; //* command to run, null-terminated
+char rxBuffer[CMD_BUFFER_SIZE]; //* command being received from serial
+byte cmdLength = 0; //* number of bytes of the command received so far
+boolean cmdOverflow = false; //* the command being received is longer than the buffer
+
+unsigned long watchdogWindow = 0; //* ms of host silence before all outputs are switched off, 0 disables the watchdog
+unsigned long lastHostTime = 0; //* time of the last line received from the host
+boolean watchdogTripped = false; //* the outputs were switched off by the watchdog, until the host sends a line again
+
+//* LED channels, each with its own operation and continuous pulse
+const byte LED_CHANNELS = 2;
+struct LedChannel {
+  int pin;                      //* the pin to control the LED relay
+  const char* tag;              //* prefix of the feedback of the channel, "ch<k>:" or empty for channel 0
+  const char* operation;        //* current operation, one of "none", "on", "off", "r", "p"
+  boolean level;                //* whether the LED is on
+  double frequency;             //* pulsing frequency in 'p' mode and of the continuous pulse
+  long pulseWidth;              //* specified pulse width in ms
+  boolean pulseState;           //* whether the continuous pulse is on
+  boolean pulseIsOn;            //* whether the pulse of the continuous pulse is currently on
+  unsigned long lastPulseTime;  //* last time a continuous pulse cycle started
+  unsigned long pulseStartTime; //* when the current pulse started
+  unsigned long pulsePeriod;    //* continuous pulse period in ms (calculated from frequency)
+};
+LedChannel leds[LED_CHANNELS] = {
+  {5, "", "none"},     //* red
+  {6, "ch1:", "none"}, //* green
+};
+
+//* Timed actions, each on its own output with its own start, end and period
+const byte MAX_TIMERS = 8;
+struct TimedAction {
+  boolean active;
+  int pin;                 //* output switched by the action
+  unsigned long start;     //* when the output is switched on, later than the command for a delayed action
+  unsigned long end;       //* when the output is switched off and the action ends
+  unsigned long period;    //* period of a pulse train in ms, 0 to hold the output on until the end
+  unsigned long width;     //* pulse width of a pulse train in ms
+  unsigned long t0_period; //* start time of the current period
+  boolean started;         //* whether the output has been switched on at start
+  boolean high;            //* whether the pulse of the current period is on
+  const char* tag;         //* prefix of the feedback, the tag of the LED channel of the output
+  const __FlashStringHelper* onMessage;  //* feedback when the output is switched on at start
+  const __FlashStringHelper* offMessage; //* feedback when the action ends
+};
+TimedAction timers[MAX_TIMERS];
+
+//* Commands scheduled with "@<ms>", run when their time has come
+const byte MAX_SCHEDULED = 4;
+const byte SCHEDULED_COMMAND_SIZE = 24; //* longest scheduled command + 1, the hardware commands are short
+struct ScheduledCommand {
+  boolean active;
+  unsigned long due;                     //* when the command runs
+  char command[SCHEDULED_COMMAND_SIZE];  //* command without the "@<ms>" suffix
+};
+ScheduledCommand scheduled[MAX_SCHEDULED];
+
+//* Waveform table, events sorted by time
+const byte MAX_WAVE_EVENTS = 64;
+struct WaveEvent {
+  unsigned long t; //* time from the start of the waveform in us
+  byte pin;
+  byte value;      //* 0/1 for digitalWrite, 2-255 for analogWrite
+};
+WaveEvent wave[MAX_WAVE_EVENTS];
+
+//* Ring buffer of the output changes, the oldest ones are overwritten when it is full
+const byte MAX_OUTPUT_EVENTS = 48;
+const byte EVENT_DUMP_CHUNK = 5; //* records per "events" reply, the longest header and the records fit the 64-byte transmit buffer
+const byte NUM_PINS = 20;
+struct OutputEvent {
+  unsigned long t; //* micros() of the change
+  byte pin;
+  byte value;      //* 0/1 for digitalWrite, 2-255 for analogWrite
+};
+OutputEvent outputEvents[MAX_OUTPUT_EVENTS];
+byte eventHead = 0;          //* index of the oldest event
+byte eventCount = 0;         //* number of events in the buffer
+unsigned int eventsLost = 0; //* events overwritten since the buffer was last emptied
+byte pinValue[NUM_PINS];     //* last value written to each pin, only changes are recorded
+byte waveCount = 0;            //* number of events in the table
+byte waveIndex = 0;            //* next event to play
+boolean wavePlaying = false;
+unsigned long waveStart = 0;   //* micros() at the start of the current play
+unsigned long wavePeriod = 0;  //* time in us from the start of a play to the start of the next one
+unsigned long wavePlays = 0;   //* number of plays left after the current one
 
 //* New state tracking variables for pump, shock, air, and odor controls
 boolean pumpState = false;       //* Pump state (on/off)
@@ -48,66 +132,611 @@ boolean airState = false;        //* Air state (on/off)
 boolean odorAState = false;      //* Odor A state (on/off)
 boolean odorBState = false;      //* Odor B state (on/off)
 
-//* Shock pulse parameters
-const float shockFrequency = 0.2;  //* Shock frequency in Hz
-const long shockPulseWidth = 1250; //* Shock pulse width in ms (1.25s)
-unsigned long shockPeriod = 5000;  //* Shock period in ms (5s = 1/0.2Hz)
+//* Shock pulse parameters, set by "shock:f<frequency x1000>w<ms>n<count>"
+double shockFrequency = 0.2;          //* Shock frequency in Hz
+unsigned long shockPulseWidth = 1250; //* Shock pulse width in ms (1.25s)
+unsigned long shockPeriod = 5000;     //* Shock period in ms (5s = 1/0.2Hz)
+unsigned long shockPulseLimit = 0;    //* Number of pulses of a train started by "shock:on", 0 for no limit
+unsigned long shockPulseCount = 0;    //* Number of pulses delivered since "shock:on"
 unsigned long lastShockTime = 0;   //* Last time shock was triggered
 boolean shockPulseOn = false;      //* Whether shock pulse is currently on
 unsigned long shockPulseStart = 0; //* When current shock pulse started
 
-//* Continuous pulse parameters
-boolean continuousPulseState = false;  //* Whether continuous pulse mode is on
-unsigned long lastPulseTime = 0;       //* Last time pulse cycle started  
-boolean pulseIsOn = false;             //* Whether pulse is currently on
-unsigned long pulseStartTime = 0;      //* When current pulse started
-unsigned long pulsePeriod = 0;         //* Pulse period in ms (calculated from frequency)
+//* Frame trigger train on pin_trigger, timed in us so that frame rates like 30 Hz keep their exact period
+boolean trainState = false;      //* Whether the train is running
+boolean trainHigh = false;       //* Whether the trigger pulse is currently on
+unsigned long trainPeriod = 0;   //* us between the rises of two pulses
+unsigned long trainWidth = 0;    //* us of each pulse
+unsigned long trainLimit = 0;    //* Number of pulses of the train, 0 for no limit
+unsigned long trainCount = 0;    //* Number of pulses delivered since the train started
+unsigned long trainRise = 0;     //* micros() of the rise of the current pulse, advanced by whole periods
 
-void ResetPulse()
+//* Whether the current operation of the LED channel is the given one
+boolean operationIs(byte ch, const char* operation)
 {
-  digitalWrite(pin_LED, HIGH);
-  digitalWrite(pin_indicator,HIGH);
-  fpul = true;
-  t_period    = 0;
-  t0_period = millis();
-  t_pulse   = 0;
+  return strcmp(leds[ch].operation, operation) == 0;
 }
 
-//* Function to quit all operations
-void quitAllOperations() {
-  //* Turn off LED operations
-  currentOperation = "none";
-  digitalWrite(pin_LED, LOW);
-  digitalWrite(pin_indicator, LOW);
-  digitalWrite(pin_trigger, LOW);
-  fpul = false;
+//* Whether the command is the given literal, kept in flash: commandIs(light_switch, F("quit"))
+boolean commandIs(const char* command, const __FlashStringHelper* literal)
+{
+  return strcmp_P(command, (PGM_P)literal) == 0;
+}
+
+//* Whether the command starts with the given prefix, kept in flash: startsWith(light_switch, F("pump:"))
+boolean startsWith(const char* command, const __FlashStringHelper* prefix)
+{
+  return strncmp_P(command, (PGM_P)prefix, strlen_P((PGM_P)prefix)) == 0;
+}
+
+//* Integer following the first occurrence of key in the command (String.toInt() rules), 0 if key is missing
+long valueAfter(const char* command, char key)
+{
+  const char* pos = strchr(command, key);
+  return pos ? atol(pos + 1) : 0;
+}
+
+//* Move the received bytes into rxBuffer without waiting; true when a complete line is ready in light_switch
+boolean readCommand()
+{
+  while (Serial.available() > 0) {
+    char c = Serial.read();
+    if (c == '\n') {
+      lastHostTime = millis(); //* every line of the host, heartbeat or command, feeds the watchdog
+      watchdogTripped = false;
+      rxBuffer[cmdLength] = '\0';
+      boolean complete = !cmdOverflow;
+      if (cmdOverflow) {
+        Serial.print(F("Error: Command too long\n"));
+      }
+      else {
+        memcpy(light_switch, rxBuffer, cmdLength + 1);
+      }
+      cmdLength = 0;
+      cmdOverflow = false;
+      return complete; //* one command per pass, the remaining bytes are read in the next pass
+    }
+    if (c == '\r') {
+      continue;
+    }
+    if (cmdLength < CMD_BUFFER_SIZE - 1) {
+      rxBuffer[cmdLength++] = c;
+    }
+    else {
+      cmdOverflow = true;
+    }
+  }
+  return false;
+}
+
+//* Record a change of an output in the ring buffer, the indicator only follows the other outputs
+//* the edges of the trigger train are not recorded, they lie on the grid reported by "trig:" and would flood the buffer
+void recordEvent(int pin, byte value)
+{
+  if (pin < 0 || pin >= NUM_PINS || pin == pin_indicator || pinValue[pin] == value || (pin == pin_trigger && trainState)) {
+    return;
+  }
+  pinValue[pin] = value;
+  byte i = (eventHead + eventCount) % MAX_OUTPUT_EVENTS;
+  if (eventCount == MAX_OUTPUT_EVENTS) {
+    eventHead = (eventHead + 1) % MAX_OUTPUT_EVENTS;
+    eventsLost++;
+  }
+  else {
+    eventCount++;
+  }
+  outputEvents[i].t = micros();
+  outputEvents[i].pin = pin;
+  outputEvents[i].value = value;
+}
+
+void outputDigital(int pin, int value)
+{
+  digitalWrite(pin, value);
+  recordEvent(pin, value == HIGH ? 1 : 0);
+}
+
+void outputAnalog(int pin, int value)
+{
+  analogWrite(pin, value);
+  recordEvent(pin, value);
+}
+
+//* Send the oldest recorded events and remove them from the buffer:
+//* "Events <n> <left> <lost> <micros>\n" followed by n records of 4-byte micros (little-endian), 1-byte pin and
+//* 1-byte value; <left> events remain for the next "events", <lost> were overwritten since the buffer was last emptied
+void dumpEvents()
+{
+  byte n = eventCount < EVENT_DUMP_CHUNK ? eventCount : EVENT_DUMP_CHUNK;
+  Serial.print(F("Events "));
+  Serial.print(n);
+  Serial.print(' ');
+  Serial.print(eventCount - n);
+  Serial.print(' ');
+  Serial.print(eventsLost);
+  Serial.print(' ');
+  Serial.print(micros());
+  Serial.print('\n');
+  for (byte k = 0; k < n; k++) {
+    OutputEvent &event = outputEvents[eventHead];
+    Serial.write((const uint8_t*)&event.t, 4); //* the AVR is little-endian
+    Serial.write(event.pin);
+    Serial.write(event.value);
+    eventHead = (eventHead + 1) % MAX_OUTPUT_EVENTS;
+  }
+  eventCount -= n;
+  if (eventCount == 0) {
+    eventsLost = 0;
+  }
+}
+
+//* Keep the command in light_switch to run it delayTime later
+void scheduleCommand(unsigned long currentTime, unsigned long delayTime)
+{
+  if (strlen(light_switch) >= SCHEDULED_COMMAND_SIZE) {
+    Serial.print(F("Error: Scheduled command too long\n"));
+    return;
+  }
+  for (int i = 0; i < MAX_SCHEDULED; i++) {
+    if (!scheduled[i].active) {
+      scheduled[i].active = true;
+      scheduled[i].due = currentTime + delayTime;
+      strcpy(scheduled[i].command, light_switch);
+      Serial.print(F("Scheduled "));
+      Serial.print(light_switch);
+      Serial.print(F("\n"));
+      return;
+    }
+  }
+  Serial.print(F("Error: No free slot for scheduled command\n"));
+}
+
+//* Drop all scheduled commands
+void cancelScheduled()
+{
+  for (int i = 0; i < MAX_SCHEDULED; i++) {
+    scheduled[i].active = false;
+  }
+}
+
+//* Put the next command to run into light_switch: a scheduled command whose time has come, else a received line
+boolean nextCommand(unsigned long currentTime)
+{
+  for (int i = 0; i < MAX_SCHEDULED; i++) {
+    if (scheduled[i].active && (long)(currentTime - scheduled[i].due) >= 0) {
+      scheduled[i].active = false;
+      strcpy(light_switch, scheduled[i].command);
+      return true;
+    }
+  }
+  return readCommand();
+}
+
+//* Index of the LED channel driven by the pin, -1 if the pin is not an LED
+int ledChannel(int pin)
+{
+  for (byte ch = 0; ch < LED_CHANNELS; ch++) {
+    if (leds[ch].pin == pin) {
+      return ch;
+    }
+  }
+  return -1;
+}
+
+//* The indicator is on while any LED channel or the trigger is on
+void updateIndicator()
+{
+  boolean on = digitalRead(pin_trigger) == HIGH;
+  for (byte ch = 0; ch < LED_CHANNELS; ch++) {
+    on = on || leds[ch].level;
+  }
+  outputDigital(pin_indicator, on ? HIGH : LOW);
+}
+
+//* Switch the LED of a channel
+void setLed(byte ch, boolean on)
+{
+  outputDigital(leds[ch].pin, on ? HIGH : LOW);
+  leds[ch].level = on;
+  updateIndicator();
+}
+
+//* Print a feedback line of an LED channel, prefixed with its tag
+void printLed(byte ch, const __FlashStringHelper* message)
+{
+  Serial.print(leds[ch].tag);
+  Serial.print(message);
+}
+
+//* Switch an output; the pump is driven by PWM, the indicator follows the LEDs and the trigger
+void setOutput(int pin, boolean on)
+{
+  if (pin == pin_pump) {
+    outputAnalog(pin_pump, on ? pump_value : 0);
+    pumpState = on;
+    return;
+  }
+  int ch = ledChannel(pin);
+  if (ch >= 0) {
+    setLed(ch, on);
+    return;
+  }
+  outputDigital(pin, on ? HIGH : LOW);
+  if (pin == pin_air) airState = on;
+  else if (pin == pin_odor_A) odorAState = on;
+  else if (pin == pin_odor_B) odorBState = on;
+  else if (pin == pin_trigger) updateIndicator();
+}
+
+//* Start the continuous pulse of an LED channel at its frequency and pulse width
+void startContinuousPulse(byte ch, unsigned long currentTime)
+{
+  LedChannel &led = leds[ch];
+  led.pulseState = true;
+  led.pulsePeriod = (unsigned long)(1000.0 / led.frequency);
+  led.lastPulseTime = currentTime;
+  led.pulseIsOn = true;
+  led.pulseStartTime = currentTime;
+  setLed(ch, true);
+  Serial.print(led.tag);
+  Serial.print(F("Continuous Pulse ON ("));
+  Serial.print(led.frequency);
+  Serial.print(F(" Hz, "));
+  Serial.print(led.pulseWidth);
+  Serial.print(F(" ms pulse width)\n"));
+}
+
+//* Stop the continuous pulse of an LED channel
+void stopContinuousPulse(byte ch)
+{
+  leds[ch].pulseState = false;
+  leds[ch].pulseIsOn = false;
+  setLed(ch, false);
+  printLed(ch, F("Continuous Pulse OFF\n"));
+}
+
+//* Write a waveform value to its pin, the indicator follows the LEDs and the trigger
+void writeWave(byte pin, byte value)
+{
+  if (value > 1) {
+    outputAnalog(pin, value);
+    if (ledChannel(pin) >= 0 || pin == pin_trigger) {
+      outputDigital(pin_indicator, HIGH);
+    }
+  }
+  else {
+    setOutput(pin, value == 1);
+  }
+}
+
+//* Append the events of "wave:add:<dt>,<pin>,<value>;..." to the waveform table, dt in us from the previous event
+void addWave(const char* items)
+{
+  char* end;
+  while (*items != '\0') {
+    if (waveCount >= MAX_WAVE_EVENTS) {
+      Serial.print(F("Error: Wave table full\n"));
+      return;
+    }
+    unsigned long dt = strtoul(items, &end, 10);
+    if (*end != ',') break;
+    byte pin = (byte)strtol(end + 1, &end, 10);
+    if (*end != ',') break;
+    byte value = (byte)strtol(end + 1, &end, 10);
+    wave[waveCount].t = (waveCount > 0 ? wave[waveCount - 1].t : 0) + dt;
+    wave[waveCount].pin = pin;
+    wave[waveCount].value = value;
+    pinMode(pin, OUTPUT);
+    waveCount++;
+    items = (*end == ';') ? end + 1 : end;
+  }
+  if (*items != '\0') {
+    Serial.print(F("Error: Invalid wave event\n"));
+    return;
+  }
+  Serial.print(F("Wave "));
+  Serial.print(waveCount);
+  Serial.print(F(" events\n"));
+}
+
+//* Stop the waveform and switch off its pins
+void stopWave()
+{
+  wavePlaying = false;
+  for (byte i = 0; i < waveCount; i++) {
+    writeWave(wave[i].pin, 0);
+  }
+}
+
+//* Play the events of the waveform whose time has come
+void serviceWave()
+{
+  if (!wavePlaying) {
+    return;
+  }
+  while (waveIndex < waveCount && micros() - waveStart >= wave[waveIndex].t) {
+    writeWave(wave[waveIndex].pin, wave[waveIndex].value);
+    waveIndex++;
+  }
+  if (waveIndex >= waveCount) {
+    if (wavePlays > 0) { //* next play, without accumulating the loop delay
+      wavePlays--;
+      waveStart += wavePeriod;
+      waveIndex = 0;
+    }
+    else {
+      wavePlaying = false;
+      Serial.print(F("Wave done at "));
+      Serial.print(micros());
+      Serial.print(F("\n"));
+    }
+  }
+}
+
+//* Print the pulses delivered by the trigger train with the current board time
+void printTrainCount(const __FlashStringHelper* message)
+{
+  Serial.print(message);
+  Serial.print(trainCount);
+  Serial.print(F(" pulses) at "));
+  Serial.print(micros());
+  Serial.print(F("\n"));
+}
+
+//* Stop the trigger train, the trigger is left off
+void stopTrain()
+{
+  trainState = false;
+  trainHigh = false;
+  outputDigital(pin_trigger, LOW);
+  updateIndicator();
+}
+
+//* Rise and fall of the trigger train, each rise a whole number of periods after the first one
+void serviceTrain()
+{
+  if (!trainState) {
+    return;
+  }
+  unsigned long now = micros();
+  if (trainHigh && now - trainRise >= trainWidth) {
+    outputDigital(pin_trigger, LOW);
+    trainHigh = false;
+    updateIndicator();
+    if (trainLimit > 0 && trainCount >= trainLimit) {
+      stopTrain();
+      printTrainCount(F("Trigger train done ("));
+    }
+  }
+  else if (!trainHigh && now - trainRise >= trainPeriod) {
+    trainRise += trainPeriod;
+    outputDigital(pin_trigger, HIGH);
+    trainHigh = true;
+    trainCount++;
+    updateIndicator();
+  }
+}
+
+//* Index of the active timer of the output, -1 if it has none
+int findTimer(int pin)
+{
+  for (int i = 0; i < MAX_TIMERS; i++) {
+    if (timers[i].active && timers[i].pin == pin) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+//* Cancel the timer of the output, the output is left as it is
+void cancelTimer(int pin)
+{
+  int i = findTimer(pin);
+  if (i >= 0) {
+    timers[i].active = false;
+  }
+}
+
+//* Close the valves when the pump stops, to avoid overheating
+void closeValves()
+{
+  cancelTimer(pin_air);
+  cancelTimer(pin_odor_A);
+  cancelTimer(pin_odor_B);
+  setOutput(pin_air, false);
+  setOutput(pin_odor_A, false);
+  setOutput(pin_odor_B, false);
+}
+
+//* Switch on, pulse and switch off the output of a timer when its time has come
+void serviceTimer(TimedAction &timer, unsigned long currentTime)
+{
+  if (!timer.started) {
+    if ((long)(currentTime - timer.start) < 0) { //* still delayed
+      return;
+    }
+    timer.started = true;
+    timer.high = true;
+    timer.t0_period = timer.start;
+    setOutput(timer.pin, true);
+    Serial.print(timer.tag);
+    Serial.print(timer.onMessage);
+  }
+  if ((long)(currentTime - timer.end) >= 0) {
+    timer.active = false;
+    setOutput(timer.pin, false);
+    int ch = ledChannel(timer.pin);
+    if (ch >= 0) {
+      leds[ch].operation = "none";
+    }
+    else if (timer.pin == pin_pump) {
+      closeValves();
+    }
+    Serial.print(timer.tag);
+    Serial.print(timer.offMessage);
+    return;
+  }
+  if (timer.period > 0) {
+    if (currentTime - timer.t0_period >= timer.period) { //* start next period, without accumulating the loop delay
+      timer.t0_period += timer.period;
+      timer.high = true;
+      setOutput(timer.pin, true);
+    }
+    else if (timer.high && currentTime - timer.t0_period >= timer.width) { //* enter the pulse-off phase
+      timer.high = false;
+      setOutput(timer.pin, false);
+    }
+  }
+}
+
+//* Start a timed action on an output, replacing the one running on it; false if all timers are busy
+boolean startTimer(int pin, unsigned long currentTime, unsigned long delayTime, unsigned long duration,
+                   unsigned long period, unsigned long width, const __FlashStringHelper* onMessage,
+                   const __FlashStringHelper* offMessage)
+{
+  int slot = findTimer(pin);
+  for (int i = 0; slot < 0 && i < MAX_TIMERS; i++) {
+    if (!timers[i].active) {
+      slot = i;
+    }
+  }
+  if (slot < 0) {
+    Serial.print(F("Error: No free timer\n"));
+    return false;
+  }
+  TimedAction &timer = timers[slot];
+  timer.active = true;
+  timer.pin = pin;
+  timer.start = currentTime + delayTime;
+  timer.end = timer.start + duration;
+  timer.period = period;
+  timer.width = width;
+  timer.started = false;
+  timer.high = false;
+  int ch = ledChannel(pin);
+  timer.tag = ch >= 0 ? leds[ch].tag : "";
+  timer.onMessage = onMessage;
+  timer.offMessage = offMessage;
+  serviceTimer(timer, currentTime); //* an action without delay starts right away
+  return true;
+}
+
+//* Switch all outputs off and stop every operation
+void safeState() {
+  //* Turn off the operations and continuous pulses of all LED channels
+  for (byte ch = 0; ch < LED_CHANNELS; ch++) {
+    leds[ch].operation = "none";
+    leds[ch].pulseState = false;
+    leds[ch].pulseIsOn = false;
+    outputDigital(leds[ch].pin, LOW);
+    leds[ch].level = false;
+  }
+  outputDigital(pin_indicator, LOW);
+  trainState = false;
+  trainHigh = false;
+  outputDigital(pin_trigger, LOW);
   
-  //* Turn off continuous pulse mode
-  continuousPulseState = false;
-  pulseIsOn = false;
+  //* Stop all timed actions, scheduled commands and the waveform
+  for (int i = 0; i < MAX_TIMERS; i++) {
+    timers[i].active = false;
+  }
+  cancelScheduled();
+  if (wavePlaying) {
+    stopWave();
+  }
   
   //* Turn off pump and related operations
-  analogWrite(pin_pump, 0);
+  outputAnalog(pin_pump, 0);
   pumpState = false;
   
   //* Turn off all solenoids (air, odor, shock)
-  digitalWrite(pin_air, LOW);
-  digitalWrite(pin_odor_A, LOW);
-  digitalWrite(pin_odor_B, LOW);
-  digitalWrite(pin_shock, LOW);
+  outputDigital(pin_air, LOW);
+  outputDigital(pin_odor_A, LOW);
+  outputDigital(pin_odor_B, LOW);
+  outputDigital(pin_shock, LOW);
   airState = false;
   odorAState = false;
   odorBState = false;
   shockState = false;
   shockPulseOn = false;
-  
-  Serial.print("All operations terminated\n");
+}
+
+//* Function to quit all operations
+void quitAllOperations() {
+  safeState();
+  Serial.print(F("All operations terminated\n"));
+}
+
+//* Time left of the timer running the LED of a channel, 0 without timer
+unsigned long ledRemaining(byte ch, unsigned long currentTime)
+{
+  int i = findTimer(leds[ch].pin);
+  if (i >= 0 && (long)(timers[i].end - currentTime) > 0) {
+    return timers[i].end - currentTime;
+  }
+  return 0;
+}
+
+//* Report all outputs and the current operation in one line, parsed by the host to reconcile its mirrored state
+//* kept short as every byte takes ~1 ms at 9600 baud; format: "Status <ms> <operation> <ms left> <flags> <pump value>"
+//* flags: one digit (0/1) each for LED, trigger, pump, air, odor A, odor B, shock, shock output, continuous pulse,
+//* trigger train
+//* the operation, ms left, LED and continuous pulse are those of channel 0, followed by
+//* " <operation>,<ms left>,<LED><continuous pulse>" for each other LED channel
+void printStatus(unsigned long currentTime) {
+  Serial.print(F("Status "));
+  Serial.print(currentTime);
+  Serial.print(F(" "));
+  Serial.print(leds[0].operation);
+  Serial.print(F(" "));
+  Serial.print(ledRemaining(0, currentTime));
+  Serial.print(F(" "));
+  Serial.print(leds[0].level);
+  Serial.print(digitalRead(pin_trigger));
+  Serial.print(pumpState);
+  Serial.print(airState);
+  Serial.print(odorAState);
+  Serial.print(odorBState);
+  Serial.print(shockState);
+  Serial.print(digitalRead(pin_shock));
+  Serial.print(leds[0].pulseState);
+  Serial.print(trainState);
+  Serial.print(F(" "));
+  Serial.print(pump_value);
+  for (byte ch = 1; ch < LED_CHANNELS; ch++) {
+    Serial.print(F(" "));
+    Serial.print(leds[ch].operation);
+    Serial.print(F(","));
+    Serial.print(ledRemaining(ch, currentTime));
+    Serial.print(F(","));
+    Serial.print(leds[ch].level);
+    Serial.print(leds[ch].pulseState);
+  }
+  Serial.print(F("\n"));
+}
+
+//* Take the "ch<k>:" prefix off the command; the LED channel k, 0 without prefix, LED_CHANNELS if k is unknown
+byte takeChannel()
+{
+  if (!startsWith(light_switch, F("ch")) || !isDigit(light_switch[2]) || light_switch[3] != ':') {
+    return 0;
+  }
+  byte ch = light_switch[2] - '0';
+  memmove(light_switch, light_switch + 4, strlen(light_switch + 4) + 1);
+  return ch < LED_CHANNELS ? ch : LED_CHANNELS;
+}
+
+//* Whether the command is one of the LED commands that can be addressed to a channel
+boolean isLedCommand(const char* command)
+{
+  return commandIs(command, F("on")) || commandIs(command, F("off")) || command[0] == 'r' ||
+         startsWith(command, F("pulse")) || (command[0] == 'p' && isDigit(command[1]));
 }
 
 //* Define validateValveOperation function to check if pump is on before opening valves
 boolean validateValveOperation() {
   if (!pumpState) {
-    Serial.print("Warning: Cannot open valve - Pump is OFF\n");
+    Serial.print(F("Warning: Cannot open valve - Pump is OFF\n"));
     return false;
   }
   return true;
@@ -116,7 +745,9 @@ boolean validateValveOperation() {
 void setup()
 {
   Serial.begin(baudRate);
-  pinMode(pin_LED,OUTPUT);
+  for (byte ch = 0; ch < LED_CHANNELS; ch++) {
+    pinMode(leds[ch].pin, OUTPUT);
+  }
   pinMode(pin_indicator,OUTPUT);
   pinMode(pin_trigger,OUTPUT);
   
@@ -128,142 +759,208 @@ void setup()
   pinMode(pin_pump, OUTPUT);
   
   //* Initialize all outputs to LOW
-  digitalWrite(pin_air, LOW);
-  digitalWrite(pin_odor_A, LOW);
-  digitalWrite(pin_odor_B, LOW);
-  analogWrite(pin_pump, 0);
+  outputDigital(pin_air, LOW);
+  outputDigital(pin_odor_A, LOW);
+  outputDigital(pin_odor_B, LOW);
+  outputAnalog(pin_pump, 0);
   
   //* Calculate shock period from frequency
   shockPeriod = (unsigned long)(1000.0 / shockFrequency);
+  
+  //* Reset the board if loop() stops running
+  wdt_enable(WDTO_2S);
+  
+  //* Tell the host that the board has finished resetting
+  Serial.println(F("READY"));
 }
 
 void loop()
 {
   unsigned long currentTime = millis();
+  wdt_reset();
   
-  //* Check for new commands
-  if (Serial.available() > 0) 
+  //* Check for new commands and scheduled commands that are due
+  if (nextCommand(currentTime)) 
   {
-    light_switch = Serial.readStringUntil('\n'); //* read command from the connected PC
-    
+    char* at = strchr(light_switch, '@');
+    byte ch = (at == NULL) ? takeChannel() : 0; //* LED channel addressed by "ch<k>:", kept with a scheduled command
+    LedChannel &led = leds[ch < LED_CHANNELS ? ch : 0];
+    if (at != NULL) 
+    { //* run the command later, "<command>@<ms>"
+      *at = '\0';
+      scheduleCommand(currentTime, atol(at + 1));
+    }
+    else if (ch >= LED_CHANNELS) {
+      Serial.print(F("Error: Invalid LED channel\n"));
+    }
+    else if (ch > 0 && !isLedCommand(light_switch)) {
+      Serial.print(F("Error: Not an LED command\n"));
+    }
     //* Quit command takes precedence over all operations
-    if (light_switch == "quit") {
+    else if (commandIs(light_switch, F("quit"))) {
       quitAllOperations();
     }
-    else if (light_switch == "on") 
+    else if (commandIs(light_switch, F("cancel"))) 
+    { //* drop the scheduled commands, the running operations go on
+      cancelScheduled();
+      Serial.print(F("Scheduled commands cancelled\n"));
+    }
+    else if (commandIs(light_switch, F("status"))) 
+    { //* snapshot of all outputs, does not change any state
+      printStatus(currentTime);
+    }
+    else if (commandIs(light_switch, F("events"))) 
+    { //* next chunk of the recorded output changes, in binary
+      dumpEvents();
+    }
+    else if (commandIs(light_switch, F("hb"))) 
+    { //* heartbeat of the host, it only feeds the watchdog and prints nothing
+    }
+    else if (startsWith(light_switch, F("wd:"))) 
+    { //* "wd:<ms>" sets the watchdog window, "wd:0" disables the watchdog
+      watchdogWindow = atol(light_switch + 3);
+      watchdogTripped = false;
+      Serial.print(F("Watchdog window set to "));
+      Serial.print(watchdogWindow);
+      Serial.print(F(" ms\n"));
+    }
+    else if (commandIs(light_switch, F("on"))) 
     { //* turn on the LED
-      digitalWrite(pin_LED, HIGH);
-      digitalWrite(pin_indicator, HIGH);
-      currentOperation = "on";
-      Serial.print("Light ON\n");
+      cancelTimer(led.pin);
+      setLed(ch, true);
+      led.operation = "on";
+      printLed(ch, F("Light ON\n"));
     }
-    else if (light_switch == "off")
+    else if (commandIs(light_switch, F("off")))
     { //* turn off the LED
-      digitalWrite(pin_LED, LOW);
-      digitalWrite(pin_indicator, LOW);
-      currentOperation = "off";
-      Serial.print("Light OFF\n");
-    }
-    else if (light_switch == "trigger")
-    { //* send a 100ms trigger signal
-      digitalWrite(pin_trigger, HIGH);
-      digitalWrite(pin_indicator, HIGH);
-      currentOperation = "trigger";
-      operationStartTime = currentTime;
-      operationEndTime = currentTime + 10; //* 10 ms trigger
-      Serial.print("Trigger ON\n");
-    }
-    else if (light_switch.charAt(0) == 'r') //* 'r' mode, constant LED
+      cancelTimer(led.pin);
+      setLed(ch, false);
+      led.operation = "off";
+      printLed(ch, F("Light OFF\n"));
+    }
+    else if (commandIs(light_switch, F("trigger")))
+    { //* send a 10 ms trigger signal, runs alongside the LED operations
+      if (trainState) {
+        Serial.print(F("Error: Cannot send a trigger while the trigger train is running\n"));
+      }
+      else {
+        startTimer(pin_trigger, currentTime, 0, 10, 0, 0, F("Trigger ON\n"), F("Trigger OFF\n"));
+      }
+    }
+    //* Frame trigger train commands
+    else if (startsWith(light_switch, F("trig:"))) {
+      if (startsWith(light_switch, F("trig:f"))) { //* "trig:f<frequency x1000>w<us>n<count>", the count 'n' is optional
+        long frequency_x1000 = valueAfter(light_switch, 'f');
+        long width = valueAfter(light_switch, 'w');
+        long limit = valueAfter(light_switch, 'n');
+        unsigned long period = frequency_x1000 > 0 ? (unsigned long)(1000000000.0 / frequency_x1000) : 0;
+        if (frequency_x1000 <= 0 || width <= 0 || limit < 0 || (unsigned long)width >= period) {
+          Serial.print(F("Error: Invalid trigger train parameters, the pulse width must be shorter than the period\n"));
+        }
+        else { //* a running train restarts with the new parameters
+          cancelTimer(pin_trigger);
+          trainPeriod = period;
+          trainWidth = width;
+          trainLimit = limit;
+          trainCount = 1;
+          trainState = true;
+          outputDigital(pin_trigger, HIGH);
+          trainRise = micros();
+          trainHigh = true;
+          updateIndicator();
+          Serial.print(F("Trigger train ON at "));
+          Serial.print(trainRise);
+          Serial.print(F(" ("));
+          Serial.print(trainPeriod);
+          Serial.print(F(" us period, "));
+          Serial.print(trainWidth);
+          Serial.print(F(" us pulse width)\n"));
+        }
+      }
+      else if (commandIs(light_switch, F("trig:count"))) {
+        printTrainCount(F("Trigger train count ("));
+      }
+      else if (commandIs(light_switch, F("trig:off"))) {
+        if (trainState) {
+          stopTrain();
+        }
+        printTrainCount(F("Trigger train OFF ("));
+      }
+      else {
+        Serial.print(F("Invalid Request\n"));
+      }
+    }
+    else if (light_switch[0] == 'r') //* 'r' mode, constant LED
     {
-      //* Mutually exclusive with 'p' mode
-      if (currentOperation == "p") {
-        Serial.print("Error: Cannot start 'r' mode while in 'p' mode\n");
+      //* Mutually exclusive with 'p' mode of the same channel
+      if (operationIs(ch, "p")) {
+        printLed(ch, F("Error: Cannot start 'r' mode while in 'p' mode\n"));
       } 
       else {
-        d_pos = light_switch.indexOf('d'); //* delay time after 'd'
-        len = light_switch.length();
-        if (d_pos > -1)
-        { //* if the turn-on command will be delayed for given time
-          String span_str = "", d_str = "";
-          for (int i=1; i<d_pos; i++) span_str += String(light_switch[i]);
-          for (int i=d_pos+1; i<len; i++) d_str += String(light_switch[i]);
-          t_delay = d_str.toInt();
-          t_span = span_str.toInt();
-          isDelayed = true;
-          delayEndTime = currentTime + t_delay;
-          currentOperation = "r";
-          operationEndTime = delayEndTime + t_span;
-        }
-        else
-        {
-          light_switch.remove(0,1);
-          t_span = light_switch.toInt();
-          currentOperation = "r";
-          operationStartTime = currentTime;
-          operationEndTime = currentTime + t_span;
-          digitalWrite(pin_LED, HIGH);
-          digitalWrite(pin_indicator, HIGH);
-          Serial.print("Light ON\n");
+        long t_span = atol(light_switch + 1); //* stops at the 'd' of a delayed command
+        long t_delay = valueAfter(light_switch, 'd'); //* the turn-on is delayed for given time, 0 without 'd'
+        if (startTimer(led.pin, currentTime, t_delay, t_span, 0, 0, F("Light ON\n"), F("Light OFF\n"))) {
+          led.operation = "r";
         }
       }
     }
     //* Pump commands
-    else if (light_switch.startsWith("pump:")) {
-      if (light_switch == "pump:on") {
-        analogWrite(pin_pump, pump_value);
+    else if (startsWith(light_switch, F("pump:"))) {
+      if (commandIs(light_switch, F("pump:on"))) {
+        cancelTimer(pin_pump);
+        outputAnalog(pin_pump, pump_value);
         pumpState = true;
-        Serial.print("Pump ON\n");
+        Serial.print(F("Pump ON\n"));
       }
-      else if (light_switch == "pump:off") {
-        analogWrite(pin_pump, 0);
+      else if (commandIs(light_switch, F("pump:off"))) {
+        cancelTimer(pin_pump);
+        outputAnalog(pin_pump, 0);
         pumpState = false;
         
         //* Turn off valves when pump is off to avoid overheating
-        digitalWrite(pin_air, LOW);
-        digitalWrite(pin_odor_A, LOW);
-        digitalWrite(pin_odor_B, LOW);
-        airState = false;
-        odorAState = false;
-        odorBState = false;
+        closeValves();
 
-        Serial.print("Pump OFF and all valves are CLOSED\n");
+        Serial.print(F("Pump OFF and all valves are CLOSED\n"));
       }
-      else if (light_switch.startsWith("pump:value:")) {
-        String value_str = light_switch.substring(11);
-        int new_value = value_str.toInt();
+      else if (startsWith(light_switch, F("pump:value:"))) {
+        long new_value = atol(light_switch + 11);
         if (new_value >= 0 && new_value <= 255) {
           pump_value = new_value;
           if (pumpState) {
-            analogWrite(pin_pump, pump_value);
+            outputAnalog(pin_pump, pump_value);
           }
-          Serial.print("Pump value set to ");
+          Serial.print(F("Pump value set to "));
           Serial.print(pump_value);
-          Serial.print("\n");
+          Serial.print(F("\n"));
         } else {
-          Serial.print("Invalid pump value. Must be between 0-255\n");
+          Serial.print(F("Invalid pump value. Must be between 0-255\n"));
         }
       }
+      else if (startsWith(light_switch, F("pump:t"))) { //* run the pump for given time, then close the valves
+        startTimer(pin_pump, currentTime, 0, atol(light_switch + 6), 0, 0,
+                   F("Pump ON\n"), F("Pump OFF and all valves are CLOSED\n"));
+      }
     }
     //* Direct pin control commands
-    else if (light_switch.startsWith("pin:")) {
+    else if (startsWith(light_switch, F("pin:"))) {
       //* Parse pin index and value from command (format: pin:pin_index:value)
-      int firstColon = light_switch.indexOf(':');
-      int secondColon = light_switch.indexOf(':', firstColon + 1);
+      char* firstColon = light_switch + 3;
+      char* secondColon = strchr(firstColon + 1, ':');
       
-      if (firstColon > 0 && secondColon > firstColon) {
-        String pinIndexStr = light_switch.substring(firstColon + 1, secondColon);
-        String valueStr = light_switch.substring(secondColon + 1);
+      if (secondColon != NULL && secondColon > firstColon + 1) {
+        const char* valueStr = secondColon + 1;
         
-        int pinIndex = pinIndexStr.toInt();
+        int pinIndex = atoi(firstColon + 1);
+        int ledCh = ledChannel(pinIndex);
         int value;
         
         // Handle text values for HIGH/LOW
-        if (valueStr.equalsIgnoreCase("HIGH")) {
+        if (strcasecmp_P(valueStr, PSTR("HIGH")) == 0) {
           value = 1;
-        } else if (valueStr.equalsIgnoreCase("LOW")) {
+        } else if (strcasecmp_P(valueStr, PSTR("LOW")) == 0) {
           value = 0;
         } else {
-          value = valueStr.toInt();
+          value = atoi(valueStr);
         }
         
         //* Basic validation - adjust these bounds based on your Arduino board
@@ -271,315 +968,313 @@ void loop()
           //* Check if it's a PWM capable pin for analog values
           if (value > 1 && value <= 255) {
             //* PWM value between 2-255, use analogWrite
-            analogWrite(pinIndex, value);
+            outputAnalog(pinIndex, value);
           } else {
             //* Digital value (0 or 1), use digitalWrite
             pinMode(pinIndex, OUTPUT);  //* Ensure pin is set as output
-            digitalWrite(pinIndex, value == 1 ? HIGH : LOW);
+            if (ledCh >= 0) {
+              setLed(ledCh, value == 1); //* the status reports the LED
+            }
+            else {
+              outputDigital(pinIndex, value == 1 ? HIGH : LOW);
+            }
           }
           
           //* No feedback sent, as requested
         }
       }
     }
+    //* Waveform commands
+    else if (startsWith(light_switch, F("wave:"))) {
+      if (commandIs(light_switch, F("wave:clear"))) {
+        if (wavePlaying) {
+          stopWave();
+        }
+        waveCount = 0;
+        Serial.print(F("Wave cleared\n"));
+      }
+      else if (startsWith(light_switch, F("wave:add:"))) {
+        if (wavePlaying) {
+          Serial.print(F("Error: Wave is playing\n"));
+        }
+        else {
+          addWave(light_switch + 9);
+        }
+      }
+      else if (startsWith(light_switch, F("wave:play"))) { //* "wave:play[:<plays>[:<period in us>]]"
+        if (waveCount == 0) {
+          Serial.print(F("Error: Wave table is empty\n"));
+        }
+        else {
+          char* end = light_switch + 9;
+          unsigned long plays = (*end == ':') ? strtoul(end + 1, &end, 10) : 1;
+          wavePeriod = (*end == ':') ? strtoul(end + 1, &end, 10) : 0;
+          if (wavePeriod < wave[waveCount - 1].t) {
+            wavePeriod = wave[waveCount - 1].t;
+          }
+          wavePlays = plays > 0 ? plays - 1 : 0;
+          waveIndex = 0;
+          wavePlaying = true;
+          waveStart = micros();
+          Serial.print(F("Wave started at "));
+          Serial.print(waveStart);
+          Serial.print(F("\n"));
+          serviceWave(); //* events at time 0 start right away
+        }
+      }
+      else if (commandIs(light_switch, F("wave:stop"))) {
+        stopWave();
+        Serial.print(F("Wave stopped at "));
+        Serial.print(micros());
+        Serial.print(F("\n"));
+      }
+    }
     //* Continuous Pulse commands
-    else if (light_switch.startsWith("pulse")) {
+    else if (startsWith(light_switch, F("pulse"))) {
       //* Check if this is a parameter-passing command (format: "pulse:fXXXwYYY")
-      if (light_switch.indexOf('f') > 0 && light_switch.indexOf('w') > 0) {
+      if (strchr(light_switch, 'f') != NULL && strchr(light_switch, 'w') != NULL) {
         //* Parse frequency and pulse width
-        int f_pos = light_switch.indexOf('f');
-        int w_pos = light_switch.indexOf('w');
-        int len = light_switch.length();
-        
-        String f_str = "", w_str = "";
-        for (int i = f_pos+1; i < w_pos; i++) f_str += String(light_switch[i]);
-        for (int i = w_pos+1; i < len; i++) w_str += String(light_switch[i]);
-        
-        long frequency_x1000 = f_str.toInt();
-        pulse_width = w_str.toInt();
-        frequency = double(frequency_x1000) / 1000;
-        pulsePeriod = (unsigned long)(1000.0 / frequency);
-        
+        long frequency_x1000 = valueAfter(light_switch, 'f');
+        led.pulseWidth = valueAfter(light_switch, 'w');
+        led.frequency = double(frequency_x1000) / 1000;
         //* Start pulse mode
-        if (!continuousPulseState) {
-          if (currentOperation == "r" || currentOperation == "p") {
-            Serial.print("Error: Cannot start continuous pulse while in 'r' or 'p' mode\n");
+        if (!led.pulseState) {
+          if (operationIs(ch, "r") || operationIs(ch, "p")) {
+            printLed(ch, F("Error: Cannot start continuous pulse while in 'r' or 'p' mode\n"));
           } else {
-            continuousPulseState = true;
-            lastPulseTime = currentTime;
-            digitalWrite(pin_LED, HIGH);
-            digitalWrite(pin_indicator, HIGH);
-            pulseIsOn = true;
-            pulseStartTime = currentTime;
-            Serial.print("Continuous Pulse ON (");
-            Serial.print(frequency);
-            Serial.print(" Hz, ");
-            Serial.print(pulse_width);
-            Serial.print(" ms pulse width)\n");
+            startContinuousPulse(ch, currentTime);
           }
         } else {
           //* Update pulse parameters without toggling state
-          Serial.print("Pulse parameters updated (");
-          Serial.print(frequency);
-          Serial.print(" Hz, ");
-          Serial.print(pulse_width);
-          Serial.print(" ms pulse width)\n");
+          led.pulsePeriod = (unsigned long)(1000.0 / led.frequency);
+          Serial.print(led.tag);
+          Serial.print(F("Pulse parameters updated ("));
+          Serial.print(led.frequency);
+          Serial.print(F(" Hz, "));
+          Serial.print(led.pulseWidth);
+          Serial.print(F(" ms pulse width)\n"));
         }
       }
-      //* Regular on/off commands
-      else if (light_switch == "pulse:on") {
-        if (frequency <= 0) {
-          Serial.print("Error: Pulse frequency not set. Use 'p' command first to set parameters\n");
+      //* Regular on/off commands, "pulse" toggles the pulse state
+      else if (commandIs(light_switch, F("pulse:on")) || (commandIs(light_switch, F("pulse")) && !led.pulseState)) {
+        if (led.frequency <= 0) {
+          printLed(ch, F("Error: Pulse frequency not set. Use 'p' command first to set parameters\n"));
         }
-        else if (currentOperation == "r" || currentOperation == "p") {
-          Serial.print("Error: Cannot start continuous pulse while in 'r' or 'p' mode\n");
+        else if (operationIs(ch, "r") || operationIs(ch, "p")) {
+          printLed(ch, F("Error: Cannot start continuous pulse while in 'r' or 'p' mode\n"));
         }
         else {
-          continuousPulseState = true;
-          pulsePeriod = (unsigned long)(1000.0 / frequency);
-          lastPulseTime = currentTime;
-          digitalWrite(pin_LED, HIGH);
-          digitalWrite(pin_indicator, HIGH);
-          pulseIsOn = true;
-          pulseStartTime = currentTime;
-          Serial.print("Continuous Pulse ON (");
-          Serial.print(frequency);
-          Serial.print(" Hz, ");
-          Serial.print(pulse_width);
-          Serial.print(" ms pulse width)\n");
+          startContinuousPulse(ch, currentTime);
         }
       }
-      else if (light_switch == "pulse:off") {
-        continuousPulseState = false;
-        digitalWrite(pin_LED, LOW);
-        digitalWrite(pin_indicator, LOW);
-        pulseIsOn = false;
-        Serial.print("Continuous Pulse OFF\n");
-      }
-      else if (light_switch == "pulse") {
-        //* Toggle pulse state
-        if (!continuousPulseState) {
-          if (frequency <= 0) {
-            Serial.print("Error: Pulse frequency not set. Use 'p' command first to set parameters\n");
-          }
-          else if (currentOperation == "r" || currentOperation == "p") {
-            Serial.print("Error: Cannot start continuous pulse while in 'r' or 'p' mode\n");
-          }
-          else {
-            continuousPulseState = true;
-            pulsePeriod = (unsigned long)(1000.0 / frequency);
-            lastPulseTime = currentTime;
-            digitalWrite(pin_LED, HIGH);
-            digitalWrite(pin_indicator, HIGH);
-            pulseIsOn = true;
-            pulseStartTime = currentTime;
-            Serial.print("Continuous Pulse ON (");
-            Serial.print(frequency);
-            Serial.print(" Hz, ");
-            Serial.print(pulse_width);
-            Serial.print(" ms pulse width)\n");
-          }
-        }
-        else {
-          continuousPulseState = false;
-          digitalWrite(pin_LED, LOW);
-          digitalWrite(pin_indicator, LOW);
-          pulseIsOn = false;
-          Serial.print("Continuous Pulse OFF\n");
-        }
+      else if (commandIs(light_switch, F("pulse:off")) || commandIs(light_switch, F("pulse"))) {
+        stopContinuousPulse(ch);
       }
     }
     //* pulsing, 
-    else if (light_switch.charAt(0) == 'p') 
+    else if (light_switch[0] == 'p') 
     { //* 'p' mode, pulsing LED
-      //* Mutually exclusive with 'r' mode
-      if (currentOperation == "r") {
-        Serial.print("Error: Cannot start 'p' mode while in 'r' mode\n");
+      //* Mutually exclusive with 'r' mode of the same channel
+      if (operationIs(ch, "r")) {
+        printLed(ch, F("Error: Cannot start 'p' mode while in 'r' mode\n"));
       }
       else {
-        f_pos = light_switch.indexOf('f');
-        w_pos = light_switch.indexOf('w');
-        len = light_switch.length();
-        String f_str = "", w_str = "", t_str = "";
-        for (int i=1; i<f_pos; i++) t_str += String(light_switch[i]);
-        for (int i=f_pos+1; i<w_pos; i++) f_str += String(light_switch[i]);
-        for (int i=w_pos+1; i<len; i++) w_str += String(light_switch[i]);
-        t_span = t_str.toInt();
-        long frequency_x1000 = f_str.toInt();
-        pulse_width = w_str.toInt();
-        frequency = double(frequency_x1000) / 1000;
-        period = 1000.0 / frequency;
-
-        //* Set up pulse mode
-        currentOperation = "p";
-        operationStartTime = currentTime;
-        operationEndTime = currentTime + t_span;
-        Serial.print("Pulsing ON\n");
-        ResetPulse(); //* Start the first pulse
+        long t_span = atol(light_switch + 1); //* stops at the 'f'
+        long frequency_x1000 = valueAfter(light_switch, 'f');
+        led.pulseWidth = valueAfter(light_switch, 'w');
+        led.frequency = double(frequency_x1000) / 1000;
+        unsigned long period = led.frequency > 0 ? (unsigned long)(1000.0 / led.frequency) : 0;
+        //* Start the first pulse
+        if (startTimer(led.pin, currentTime, 0, t_span, period, led.pulseWidth, F("Pulsing ON\n"), F("Pulsing OFF\n"))) {
+          led.operation = "p";
+        }
       }
     }
     //* Shock commands
-    else if (light_switch.startsWith("shock:")) {
-      if (light_switch == "shock:on") {
+    else if (startsWith(light_switch, F("shock:"))) {
+      if (commandIs(light_switch, F("shock:on"))) {
         shockState = true;
-        digitalWrite(pin_shock, HIGH);
+        outputDigital(pin_shock, HIGH);
         shockPulseOn = true;
         shockPulseStart = currentTime;
         lastShockTime = currentTime;
-        Serial.print("Shock pulses ON\n");
+        shockPulseCount = 1;
+        Serial.print(F("Shock pulses ON\n"));
       }
-      else if (light_switch == "shock:off") {
+      else if (commandIs(light_switch, F("shock:off"))) {
         shockState = false;
-        digitalWrite(pin_shock, LOW);
+        outputDigital(pin_shock, LOW);
         shockPulseOn = false;
-        Serial.print("Shock pulses OFF\n");
+        Serial.print(F("Shock pulses OFF ("));
+        Serial.print(shockPulseCount);
+        Serial.print(F(" pulses)\n"));
+      }
+      else if (startsWith(light_switch, F("shock:f"))) { //* the pulse count 'n' is optional
+        double newFrequency = double(valueAfter(light_switch, 'f')) / 1000;
+        long newWidth = valueAfter(light_switch, 'w');
+        long newLimit = valueAfter(light_switch, 'n');
+        if (newFrequency <= 0 || newWidth <= 0 || newLimit < 0 || newWidth >= 1000.0 / newFrequency) {
+          Serial.print(F("Error: Invalid shock parameters, the pulse width must be shorter than the period\n"));
+        }
+        else { //* a running train goes on with the new parameters
+          shockFrequency = newFrequency;
+          shockPulseWidth = newWidth;
+          shockPulseLimit = newLimit;
+          shockPeriod = (unsigned long)(1000.0 / shockFrequency);
+          Serial.print(F("Shock parameters set ("));
+          Serial.print(shockFrequency);
+          Serial.print(F(" Hz, "));
+          Serial.print(shockPulseWidth);
+          Serial.print(F(" ms pulse width, "));
+          Serial.print(shockPulseLimit);
+          Serial.print(F(" pulses)\n"));
+        }
       }
     }
     //* Air valve commands
-    else if (light_switch.startsWith("air:")) {
-      if (light_switch == "air:on") {
+    else if (startsWith(light_switch, F("air:"))) {
+      if (commandIs(light_switch, F("air:on"))) {
+        cancelTimer(pin_air);
         if (validateValveOperation()) {  //* Keep this check to ensure pump is on
-          digitalWrite(pin_air, HIGH);
+          outputDigital(pin_air, HIGH);
           airState = true;
-          Serial.print("Air valve OPEN\n");
+          Serial.print(F("Air valve OPEN\n"));
         }
       }
-      else if (light_switch == "air:off") {
-        digitalWrite(pin_air, LOW);
+      else if (commandIs(light_switch, F("air:off"))) {
+        cancelTimer(pin_air);
+        outputDigital(pin_air, LOW);
         airState = false;
-        Serial.print("Air valve CLOSED\n");
+        Serial.print(F("Air valve CLOSED\n"));
         //* No validation call here since we're just closing the valve
       }
+      else if (startsWith(light_switch, F("air:t"))) { //* open the valve for given time
+        if (validateValveOperation()) {
+          startTimer(pin_air, currentTime, 0, atol(light_switch + 5), 0, 0,
+                     F("Air valve OPEN\n"), F("Air valve CLOSED\n"));
+        }
+      }
     }
     //* Odor A valve commands
-    else if (light_switch.startsWith("odor_a:")) {
-      if (light_switch == "odor_a:on") {
+    else if (startsWith(light_switch, F("odor_a:"))) {
+      if (commandIs(light_switch, F("odor_a:on"))) {
+        cancelTimer(pin_odor_A);
         if (validateValveOperation()) {  //* Keep this check to ensure pump is on
-          digitalWrite(pin_odor_A, HIGH);
+          outputDigital(pin_odor_A, HIGH);
           odorAState = true;
-          Serial.print("Odor A valve OPEN\n");
+          Serial.print(F("Odor A valve OPEN\n"));
         }
       }
-      else if (light_switch == "odor_a:off") {
-        digitalWrite(pin_odor_A, LOW);
+      else if (commandIs(light_switch, F("odor_a:off"))) {
+        cancelTimer(pin_odor_A);
+        outputDigital(pin_odor_A, LOW);
         odorAState = false;
-        Serial.print("Odor A valve CLOSED\n");
+        Serial.print(F("Odor A valve CLOSED\n"));
         //* No validation call here since we're just closing the valve
       }
+      else if (startsWith(light_switch, F("odor_a:t"))) { //* open the valve for given time
+        if (validateValveOperation()) {
+          startTimer(pin_odor_A, currentTime, 0, atol(light_switch + 8), 0, 0,
+                     F("Odor A valve OPEN\n"), F("Odor A valve CLOSED\n"));
+        }
+      }
     }
     //* Odor B valve commands
-    else if (light_switch.startsWith("odor_b:")) {
-      if (light_switch == "odor_b:on") {
+    else if (startsWith(light_switch, F("odor_b:"))) {
+      if (commandIs(light_switch, F("odor_b:on"))) {
+        cancelTimer(pin_odor_B);
         if (validateValveOperation()) {  //* Keep this check to ensure pump is on
-          digitalWrite(pin_odor_B, HIGH);
+          outputDigital(pin_odor_B, HIGH);
           odorBState = true;
-          Serial.print("Odor B valve OPEN\n");
+          Serial.print(F("Odor B valve OPEN\n"));
         }
       }
-      else if (light_switch == "odor_b:off") {
-        digitalWrite(pin_odor_B, LOW);
+      else if (commandIs(light_switch, F("odor_b:off"))) {
+        cancelTimer(pin_odor_B);
+        outputDigital(pin_odor_B, LOW);
         odorBState = false;
-        Serial.print("Odor B valve CLOSED\n");
+        Serial.print(F("Odor B valve CLOSED\n"));
         //* No validation call here since we're just closing the valve
       }
+      else if (startsWith(light_switch, F("odor_b:t"))) { //* open the valve for given time
+        if (validateValveOperation()) {
+          startTimer(pin_odor_B, currentTime, 0, atol(light_switch + 8), 0, 0,
+                     F("Odor B valve OPEN\n"), F("Odor B valve CLOSED\n"));
+        }
+      }
     }
     //* other input
     else
     {
-      digitalWrite(13, HIGH); //* if received unknown command, turn on the pin13 indicator
-      Serial.print("Invalid Request\n");
+      outputDigital(pin_indicator, HIGH); //* if received unknown command, turn on the pin13 indicator
+      Serial.print(F("Invalid Request\n"));
     }
   }
   
-  //* Handle ongoing operations - LED related
-  if (currentOperation == "trigger") {
-    if (currentTime >= operationEndTime) {
-      digitalWrite(pin_trigger, LOW);
-      digitalWrite(pin_indicator, LOW);
-      Serial.print("Trigger OFF\n");
-      currentOperation = "none";
-    }
-  }
-  else if (currentOperation == "r") {
-    if (isDelayed) {
-      if (currentTime >= delayEndTime) {
-        isDelayed = false;
-        digitalWrite(pin_LED, HIGH);
-        digitalWrite(pin_indicator, HIGH);
-        Serial.print("Light ON\n");
-      }
-    }
-    else if (currentTime >= operationEndTime) {
-      digitalWrite(pin_LED, LOW);
-      digitalWrite(pin_indicator, LOW);
-      Serial.print("Light OFF\n");
-      currentOperation = "none";
-    }
-  }
-  else if (currentOperation == "p") {
-    if (currentTime >= operationEndTime) {
-      digitalWrite(pin_LED, LOW);
-      digitalWrite(pin_indicator, LOW);
-      Serial.print("Pulsing OFF\n");
-      currentOperation = "none";
-    }
-    else {
-      //* Update pulse timing
-      if (t_period < period) { //* In the current period
-        t_period = currentTime - t0_period;
-      }
-      else { //* Start next period
-        ResetPulse();
-      }
-      
-      if (fpul) { //* Pulse is on
-        if (t_pulse < pulse_width) {
-          t_pulse = currentTime - t0_period;
-        }
-        else { //* Shut off the pulse and enter the pulse-off phase of the current period
-          digitalWrite(pin_LED, LOW);
-          digitalWrite(pin_indicator, LOW);
-          fpul = false;
-          t_pulse = 0;
-        }
-      }
+  //* Switch all outputs off once when the host has been silent for the watchdog window
+  if (watchdogWindow > 0 && !watchdogTripped && currentTime - lastHostTime >= watchdogWindow) {
+    safeState();
+    watchdogTripped = true;
+    Serial.print(F("Watchdog tripped after "));
+    Serial.print(currentTime - lastHostTime);
+    Serial.print(F(" ms without heartbeat, all outputs off\n"));
+  }
+  
+  //* Handle timed actions - LED timer and pulses, trigger, timed valves and pump, each on its own output
+  for (int i = 0; i < MAX_TIMERS; i++) {
+    if (timers[i].active) {
+      serviceTimer(timers[i], currentTime);
     }
   }
   
+  //* Play the waveform and run the trigger train on the micros() clock
+  serviceWave();
+  serviceTrain();
+  
   //* Handle shock pulses - can run in parallel with other operations
   if (shockState) {
     if (!shockPulseOn && (currentTime - lastShockTime >= shockPeriod)) {
       //* Time to start a new shock pulse
-      digitalWrite(pin_shock, HIGH);
+      outputDigital(pin_shock, HIGH);
       shockPulseOn = true;
       shockPulseStart = currentTime;
       lastShockTime = currentTime;
+      shockPulseCount++;
     }
     else if (shockPulseOn && (currentTime - shockPulseStart >= shockPulseWidth)) {
       //* Time to end the current shock pulse
-      digitalWrite(pin_shock, LOW);
+      outputDigital(pin_shock, LOW);
       shockPulseOn = false;
+      if (shockPulseLimit > 0 && shockPulseCount >= shockPulseLimit) {
+        //* The train is complete
+        shockState = false;
+        Serial.print(F("Shock pulses done ("));
+        Serial.print(shockPulseCount);
+        Serial.print(F(" pulses)\n"));
+      }
     }
   }
   
-  //* Handle continuous pulse mode - can run in parallel with shock but not with other LED operations
-  if (continuousPulseState) {
-    if (pulseIsOn) {
+  //* Handle continuous pulses - each channel runs its own, in parallel with shock and the other channels
+  for (byte ch = 0; ch < LED_CHANNELS; ch++) {
+    LedChannel &led = leds[ch];
+    if (!led.pulseState) {
+      continue;
+    }
+    if (led.pulseIsOn) {
       //* Check if it's time to end the current pulse
-      if (currentTime - pulseStartTime >= pulse_width) {
-        digitalWrite(pin_LED, LOW);
-        digitalWrite(pin_indicator, LOW);
-        pulseIsOn = false;
+      if (currentTime - led.pulseStartTime >= (unsigned long)led.pulseWidth) {
+        setLed(ch, false);
+        led.pulseIsOn = false;
       }
     } 
     else {
       //* Check if it's time to start a new pulse
-      if (currentTime - lastPulseTime >= pulsePeriod) {
-        digitalWrite(pin_LED, HIGH);
-        digitalWrite(pin_indicator, HIGH);
-        pulseIsOn = true;
-        lastPulseTime = currentTime;
-        pulseStartTime = currentTime;
+      if (currentTime - led.lastPulseTime >= led.pulsePeriod) {
+        setLed(ch, true);
+        led.pulseIsOn = true;
+        led.lastPulseTime = currentTime;
+        led.pulseStartTime = currentTime;
       }
     }
   }
@@ -0,0 +1,996 @@
+'''
+Software emulator of the Arduino board running arduino_communication_6.ino
+
+ArduinoEmulator is an in-process stand-in for serial.Serial: StimController and the helpers in stimfunc talk to it
+through write(), readline(), inWaiting() and close() exactly as they do with a real board.
+The firmware logic is reimplemented in EmulatedFirmware and runs in a background thread with the serial line
+timing of the real board (bits per byte / baud rate) and a configurable USB latency with jitter. Like the firmware,
+the emulated board collects the received bytes of a command in a fixed buffer and never waits for the rest of a line,
+and runs its timed actions (LED timer and pulse train, trigger, timed valves and pump) from a table of timers.
+Commands suffixed with "@<ms>" are kept and run later on the board clock, and waveform tables are played on the
+micros() clock, as on the board. The LED channels run their own operations and pulse trains, addressed by "ch<k>:".
+"wd:<ms>" arms the watchdog of the firmware, which switches all outputs off when no line has come from the host for
+<ms>; "hb" heartbeats feed it. The output changes are kept in the ring buffer of the firmware and sent in binary
+chunks by "events".
+
+Usage:
+    player = StimController(board_type='Emulator', ...)
+    # or
+    ser = ArduinoEmulator(usb_latency=0.002, latency_jitter=0.001)
+'''
+import re
+import time
+import struct
+import random
+import threading
+from collections import deque
+import serial
+
+# pin assignment of arduino_communication_6.ino (Arduino Uno, A0 = 14)
+PIN_LED = 5 # LED channel 0 (red)
+PIN_LED_GREEN = 6 # LED channel 1
+PIN_TRIGGER = 14
+PIN_INDICATOR = 13
+PIN_AIR = 10
+PIN_ODOR_A = 11
+PIN_ODOR_B = 12
+PIN_SHOCK = 8
+PIN_PUMP = 3
+
+PIN_NAMES = {
+    PIN_LED: 'LED',
+    PIN_LED_GREEN: 'LED ch1',
+    PIN_TRIGGER: 'trigger',
+    PIN_INDICATOR: 'indicator',
+    PIN_AIR: 'air',
+    PIN_ODOR_A: 'odor_a',
+    PIN_ODOR_B: 'odor_b',
+    PIN_SHOCK: 'shock',
+    PIN_PUMP: 'pump',
+}
+
+BITS_PER_BYTE = 10 # 8N1: start bit + 8 data bits + stop bit
+CMD_BUFFER_SIZE = 64 # size of the command buffer of the firmware, including the terminating null
+MAX_TIMERS = 8 # size of the timer table of the firmware
+MAX_SCHEDULED = 4 # number of "@<ms>" commands the firmware can keep
+SCHEDULED_COMMAND_SIZE = 24 # size of the buffer of a scheduled command, including the terminating null
+MAX_WAVE_EVENTS = 64 # size of the waveform table of the firmware
+MAX_OUTPUT_EVENTS = 48 # size of the ring buffer of output changes of the firmware
+EVENT_DUMP_CHUNK = 5 # records sent per "events"
+EVENT_RECORD = struct.Struct('<IBB') # micros, pin, value of a record of "events"
+NUM_PINS = 20
+LED_PINS = [PIN_LED, PIN_LED_GREEN] # pins of the LED channels of the firmware
+VALVES = {
+    'air': (PIN_AIR, 'Air'),
+    'odor_a': (PIN_ODOR_A, 'Odor A'),
+    'odor_b': (PIN_ODOR_B, 'Odor B'),
+}
+
+
+def to_int(text):
+    '''mimic String.toInt() of Arduino: parse the leading integer, 0 if there is none'''
+    match = re.match(r'\s*([-+]?\d+)', text)
+    return int(match.group(1)) if match else 0
+
+
+def value_after(text, key):
+    '''mimic valueAfter() of the firmware: the integer following the first key, 0 if key is missing'''
+    pos = text.find(key)
+    return to_int(text[pos+1:]) if pos > -1 else 0
+
+
+def format_float(value):
+    '''mimic Serial.print(double), which prints 2 decimals'''
+    return f'{value:.2f}'
+
+
+class TimedAction:
+    '''entry of the timer table of the firmware, times in ms'''
+    __slots__ = ('active', 'pin', 'start', 'end', 'period', 'width', 't0_period', 'started', 'high',
+                 'tag', 'on_message', 'off_message')
+
+    def __init__(self):
+        self.active = False
+
+
+class LEDChannel:
+    '''LedChannel of the firmware: the operation and the continuous pulse of one LED, times in ms'''
+    __slots__ = ('pin', 'tag', 'operation', 'frequency', 'pulse_width', 'pulse_state', 'pulse_is_on',
+                 'last_pulse_time', 'pulse_start_time', 'pulse_period')
+
+    def __init__(self, pin, tag):
+        self.pin = pin
+        self.tag = tag # prefix of the feedback of the channel
+        self.operation = 'none'
+        self.frequency = 0.0
+        self.pulse_width = 0
+        self.pulse_state = False
+        self.pulse_is_on = False
+        self.last_pulse_time = 0
+        self.pulse_start_time = 0
+        self.pulse_period = 0
+
+
+class EmulatedFirmware:
+    '''
+    Python model of the loop() state machine of arduino_communication_6.ino
+
+    The model is driven by a clock returning microseconds, so the same code runs in real time (ArduinoEmulator)
+    or on a virtual clock. Every call of update() corresponds to one pass of loop() without a new command,
+    and receive_line() to the command branch of loop().
+
+    Parameters:
+        clock (callable): function returning the current board time in microseconds
+        record_transitions (bool): whether to record every output change as (micros, pin, value) in self.transitions
+    '''
+    def __init__(self, clock, record_transitions=False):
+        self.clock = clock
+        self.record_transitions = record_transitions
+        self.transitions = []
+        self.pins = {pin: 0 for pin in PIN_NAMES}
+        self.output = deque() # lines printed to the serial port, drained by the host side
+        self.setup()
+
+    # ---------------------------------------------------------------- Arduino API
+    def micros(self):
+        return int(self.clock())
+
+    def millis(self):
+        return int(self.clock()) // 1000
+
+    def digital_write(self, pin, value):
+        self.write_pin(pin, 1 if value else 0)
+
+    def analog_write(self, pin, value):
+        self.write_pin(pin, int(value))
+
+    def write_pin(self, pin, value):
+        if self.pins.get(pin) != value:
+            self.pins[pin] = value
+            if self.record_transitions:
+                self.transitions.append((self.micros(), pin, value))
+        self.record_event(pin, value)
+
+    def serial_print(self, text):
+        self.output.append(text)
+
+    def serial_write(self, data):
+        '''Serial.write() of binary data'''
+        self.output.append(bytes(data))
+
+    # ---------------------------------------------------------------- firmware
+    def setup(self):
+        self.pump_value = 200
+        # ring buffer of the output changes
+        self.output_events = deque(maxlen=MAX_OUTPUT_EVENTS) # (micros, pin, value)
+        self.events_lost = 0
+        self.pin_value = [0] * NUM_PINS
+        # watchdog on the lines of the host
+        self.watchdog_window = 0
+        self.last_host_time = 0
+        self.watchdog_tripped = False
+        # LED channels with their operations and continuous pulses, then the timed actions
+        self.leds = [LEDChannel(pin, f'ch{ch}:' if ch else '') for ch, pin in enumerate(LED_PINS)]
+        self.timers = [TimedAction() for _ in range(MAX_TIMERS)]
+        self.scheduled = [] # [due ms, command] of the "@<ms>" commands
+        # waveform table of (t_us, pin, value) events
+        self.wave = []
+        self.wave_index = 0
+        self.wave_playing = False
+        self.wave_start = 0
+        self.wave_period = 0
+        self.wave_plays = 0
+        # pump, shock, air and odors
+        self.pump_state = False
+        self.shock_state = False
+        self.air_state = False
+        self.odor_a_state = False
+        self.odor_b_state = False
+        # shock pulse parameters
+        self.shock_frequency = 0.2
+        self.shock_pulse_width = 1250
+        self.shock_period = int(1000.0 / self.shock_frequency)
+        self.shock_pulse_limit = 0
+        self.shock_pulse_count = 0
+        self.last_shock_time = 0
+        self.shock_pulse_on = False
+        self.shock_pulse_start = 0
+        # frame trigger train, timed in us
+        self.train_state = False
+        self.train_high = False
+        self.train_period = 0
+        self.train_width = 0
+        self.train_limit = 0
+        self.train_count = 0
+        self.train_rise = 0
+
+        for pin in (PIN_AIR, PIN_ODOR_A, PIN_ODOR_B):
+            self.digital_write(pin, 0)
+        self.analog_write(PIN_PUMP, 0)
+        self.serial_print('READY\r\n') # Serial.println() at the end of setup(), once the outputs are reset
+
+    def record_event(self, pin, value):
+        '''recordEvent() of the firmware: a change of an output but the indicator and the trigger train, the oldest event is overwritten'''
+        if not 0 <= pin < NUM_PINS or pin == PIN_INDICATOR or self.pin_value[pin] == value or \
+                (pin == PIN_TRIGGER and self.train_state):
+            return
+        self.pin_value[pin] = value
+        if len(self.output_events) == MAX_OUTPUT_EVENTS:
+            self.events_lost += 1
+        self.output_events.append((self.micros(), pin, value))
+
+    def dump_events(self):
+        '''dumpEvents() of the firmware: header line, then the oldest EVENT_DUMP_CHUNK records in binary'''
+        n = min(len(self.output_events), EVENT_DUMP_CHUNK)
+        self.serial_print(f'Events {n} {len(self.output_events) - n} {self.events_lost} {self.micros() & 0xFFFFFFFF}\n')
+        records = [self.output_events.popleft() for _ in range(n)]
+        if records:
+            self.serial_write(b''.join(EVENT_RECORD.pack(t & 0xFFFFFFFF, pin, value) for t, pin, value in records))
+        if not self.output_events:
+            self.events_lost = 0
+
+    def feed_watchdog(self):
+        '''every line of the host, heartbeat or command, feeds the watchdog (readCommand() of the firmware)'''
+        self.last_host_time = self.millis()
+        self.watchdog_tripped = False
+
+    def schedule_command(self, command, current_time, delay):
+        if len(command) >= SCHEDULED_COMMAND_SIZE:
+            self.serial_print('Error: Scheduled command too long\n')
+            return
+        if len(self.scheduled) >= MAX_SCHEDULED:
+            self.serial_print('Error: No free slot for scheduled command\n')
+            return
+        self.scheduled.append([current_time + delay, command])
+        self.serial_print(f'Scheduled {command}\n')
+
+    def due_command(self):
+        '''first scheduled command whose time has come, removed from the schedule; None if no command is due'''
+        current_time = self.millis()
+        for entry in self.scheduled:
+            if current_time >= entry[0]:
+                self.scheduled.remove(entry)
+                return entry[1]
+        return None
+
+    def update_indicator(self):
+        '''the indicator is on while any LED channel or the trigger is on'''
+        self.digital_write(PIN_INDICATOR, any(self.pins[pin] for pin in LED_PINS + [PIN_TRIGGER]))
+
+    def set_led(self, ch, on):
+        self.digital_write(self.leds[ch].pin, on)
+        self.update_indicator()
+
+    def print_led(self, ch, message):
+        self.serial_print(self.leds[ch].tag + message)
+
+    def set_output(self, pin, on):
+        '''setOutput() of the firmware: the pump is driven by PWM, the indicator follows the LEDs and the trigger'''
+        if pin == PIN_PUMP:
+            self.analog_write(PIN_PUMP, self.pump_value if on else 0)
+            self.pump_state = on
+            return
+        if pin in LED_PINS:
+            self.set_led(LED_PINS.index(pin), on)
+            return
+        self.digital_write(pin, on)
+        for valve, (valve_pin, _) in VALVES.items():
+            if pin == valve_pin:
+                setattr(self, f'{valve}_state', on)
+        if pin == PIN_TRIGGER:
+            self.update_indicator()
+
+    def start_continuous_pulse(self, ch, current_time):
+        led = self.leds[ch]
+        led.pulse_state = True
+        led.pulse_period = int(1000.0 / led.frequency)
+        led.last_pulse_time = current_time
+        led.pulse_is_on = True
+        led.pulse_start_time = current_time
+        self.set_led(ch, True)
+        self.print_led(ch, f'Continuous Pulse ON ({format_float(led.frequency)} Hz, {led.pulse_width} ms pulse width)\n')
+
+    def stop_continuous_pulse(self, ch):
+        self.leds[ch].pulse_state = False
+        self.leds[ch].pulse_is_on = False
+        self.set_led(ch, False)
+        self.print_led(ch, 'Continuous Pulse OFF\n')
+
+    def write_wave(self, pin, value):
+        if value > 1:
+            self.analog_write(pin, value)
+            if pin in LED_PINS + [PIN_TRIGGER]:
+                self.digital_write(PIN_INDICATOR, 1)
+        else:
+            self.set_output(pin, value == 1)
+
+    def add_wave(self, items):
+        '''addWave() of the firmware'''
+        for item in items.split(';') if items else []:
+            if len(self.wave) >= MAX_WAVE_EVENTS:
+                self.serial_print('Error: Wave table full\n')
+                return
+            fields = item.split(',')
+            if len(fields) != 3 or not all(re.fullmatch(r'-?\d+', field) for field in fields):
+                self.serial_print('Error: Invalid wave event\n')
+                return
+            dt, pin, value = (int(field) for field in fields)
+            t_last = self.wave[-1][0] if self.wave else 0
+            self.wave.append((t_last + dt, pin & 0xFF, value & 0xFF))
+            self.pins.setdefault(pin & 0xFF, 0)
+        self.serial_print(f'Wave {len(self.wave)} events\n')
+
+    def stop_wave(self):
+        self.wave_playing = False
+        for _, pin, _ in self.wave:
+            self.write_wave(pin, 0)
+
+    def service_wave(self):
+        '''serviceWave() of the firmware'''
+        if not self.wave_playing:
+            return
+        while self.wave_index < len(self.wave) and self.micros() - self.wave_start >= self.wave[self.wave_index][0]:
+            _, pin, value = self.wave[self.wave_index]
+            self.write_wave(pin, value)
+            self.wave_index += 1
+        if self.wave_index >= len(self.wave):
+            if self.wave_plays > 0:
+                self.wave_plays -= 1
+                self.wave_start += self.wave_period
+                self.wave_index = 0
+            else:
+                self.wave_playing = False
+                self.serial_print(f'Wave done at {self.micros()}\n')
+
+    def print_train_count(self, message):
+        self.serial_print(f'{message}{self.train_count} pulses) at {self.micros() & 0xFFFFFFFF}\n')
+
+    def stop_train(self):
+        self.train_state = self.train_high = False
+        self.digital_write(PIN_TRIGGER, 0)
+        self.update_indicator()
+
+    def service_train(self):
+        '''serviceTrain() of the firmware'''
+        if not self.train_state:
+            return
+        now = self.micros()
+        if self.train_high and now - self.train_rise >= self.train_width:
+            self.digital_write(PIN_TRIGGER, 0)
+            self.train_high = False
+            self.update_indicator()
+            if self.train_limit > 0 and self.train_count >= self.train_limit:
+                self.stop_train()
+                self.print_train_count('Trigger train done (')
+        elif not self.train_high and now - self.train_rise >= self.train_period:
+            self.train_rise += self.train_period
+            self.digital_write(PIN_TRIGGER, 1)
+            self.train_high = True
+            self.train_count += 1
+            self.update_indicator()
+
+    def find_timer(self, pin):
+        for timer in self.timers:
+            if timer.active and timer.pin == pin:
+                return timer
+        return None
+
+    def cancel_timer(self, pin):
+        timer = self.find_timer(pin)
+        if timer is not None:
+            timer.active = False
+
+    def close_valves(self):
+        for pin, _ in VALVES.values():
+            self.cancel_timer(pin)
+            self.set_output(pin, False)
+
+    def service_timer(self, timer, current_time):
+        '''serviceTimer() of the firmware'''
+        if not timer.started:
+            if current_time < timer.start: # still delayed
+                return
+            timer.started = True
+            timer.high = True
+            timer.t0_period = timer.start
+            self.set_output(timer.pin, True)
+            self.serial_print(timer.tag + timer.on_message)
+        if current_time >= timer.end:
+            timer.active = False
+            self.set_output(timer.pin, False)
+            if timer.pin in LED_PINS:
+                self.leds[LED_PINS.index(timer.pin)].operation = 'none'
+            elif timer.pin == PIN_PUMP:
+                self.close_valves()
+            self.serial_print(timer.tag + timer.off_message)
+            return
+        if timer.period > 0:
+            if current_time - timer.t0_period >= timer.period:
+                timer.t0_period += timer.period
+                timer.high = True
+                self.set_output(timer.pin, True)
+            elif timer.high and current_time - timer.t0_period >= timer.width:
+                timer.high = False
+                self.set_output(timer.pin, False)
+
+    def start_timer(self, pin, current_time, delay, duration, period, width, on_message, off_message):
+        '''startTimer() of the firmware, replaces the timer running on the pin'''
+        timer = self.find_timer(pin)
+        if timer is None:
+            timer = next((timer for timer in self.timers if not timer.active), None)
+        if timer is None:
+            self.serial_print('Error: No free timer\n')
+            return False
+        timer.active = True
+        timer.pin = pin
+        timer.start = current_time + delay
+        timer.end = timer.start + duration
+        timer.period = period
+        timer.width = width
+        timer.started = False
+        timer.high = False
+        timer.tag = self.leds[LED_PINS.index(pin)].tag if pin in LED_PINS else ''
+        timer.on_message = on_message
+        timer.off_message = off_message
+        self.service_timer(timer, current_time)
+        return True
+
+    def safe_state(self):
+        for led in self.leds:
+            led.operation = 'none'
+            led.pulse_state = led.pulse_is_on = False
+            self.digital_write(led.pin, 0)
+        self.digital_write(PIN_INDICATOR, 0)
+        self.train_state = self.train_high = False
+        self.digital_write(PIN_TRIGGER, 0)
+        for timer in self.timers:
+            timer.active = False
+        self.scheduled.clear()
+        if self.wave_playing:
+            self.stop_wave()
+        self.analog_write(PIN_PUMP, 0)
+        self.pump_state = False
+        for pin in (PIN_AIR, PIN_ODOR_A, PIN_ODOR_B, PIN_SHOCK):
+            self.digital_write(pin, 0)
+        self.air_state = self.odor_a_state = self.odor_b_state = False
+        self.shock_state = False
+        self.shock_pulse_on = False
+
+    def quit_all_operations(self):
+        self.safe_state()
+        self.serial_print('All operations terminated\n')
+
+    def led_remaining(self, ch, current_time):
+        timer = self.find_timer(self.leds[ch].pin)
+        return timer.end - current_time if timer is not None and timer.end > current_time else 0
+
+    def print_status(self, current_time):
+        flags = [self.pins[PIN_LED] > 0, self.pins[PIN_TRIGGER], self.pump_state, self.air_state, self.odor_a_state,
+                 self.odor_b_state, self.shock_state, self.pins[PIN_SHOCK], self.leds[0].pulse_state,
+                 self.train_state]
+        channels = ''.join(f' {led.operation},{self.led_remaining(ch, current_time)},{int(self.pins[led.pin] > 0)}{int(led.pulse_state)}'
+                           for ch, led in enumerate(self.leds) if ch > 0)
+        self.serial_print(f'Status {current_time} {self.leds[0].operation} {self.led_remaining(0, current_time)} '
+                          f'{"".join(str(int(flag)) for flag in flags)} {self.pump_value}{channels}\n')
+
+    def take_channel(self, command):
+        '''takeChannel() of the firmware: (LED channel, command without the "ch<k>:" prefix), len(LED_PINS) if k is unknown'''
+        match = re.match(r'ch(\d):', command)
+        if match is None:
+            return 0, command
+        ch = int(match.group(1))
+        return (ch if ch < len(LED_PINS) else len(LED_PINS)), command[4:]
+
+    @staticmethod
+    def is_led_command(command):
+        return command in ('on', 'off') or command[:1] == 'r' or command.startswith('pulse') or \
+               (command[:1] == 'p' and command[1:2].isdigit())
+
+    def validate_valve_operation(self):
+        if not self.pump_state:
+            self.serial_print('Warning: Cannot open valve - Pump is OFF\n')
+            return False
+        return True
+
+    def receive_line(self, command):
+        '''command branch of loop(), command is the line read from the serial port without the "\\n"'''
+        current_time = self.millis()
+        ch, command = self.take_channel(command) if '@' not in command else (0, command)
+        led = self.leds[ch if ch < len(self.leds) else 0]
+        if '@' in command:
+            command, delay = command.split('@', 1)
+            self.schedule_command(command, current_time, to_int(delay))
+        elif ch >= len(self.leds):
+            self.serial_print('Error: Invalid LED channel\n')
+        elif ch > 0 and not self.is_led_command(command):
+            self.serial_print('Error: Not an LED command\n')
+        elif command == 'quit':
+            self.quit_all_operations()
+        elif command == 'cancel':
+            self.scheduled.clear()
+            self.serial_print('Scheduled commands cancelled\n')
+        elif command == 'status':
+            self.print_status(current_time)
+        elif command == 'events':
+            self.dump_events()
+        elif command == 'hb':
+            pass
+        elif command.startswith('wd:'):
+            self.watchdog_window = to_int(command[3:])
+            self.watchdog_tripped = False
+            self.serial_print(f'Watchdog window set to {self.watchdog_window} ms\n')
+        elif command == 'on':
+            self.cancel_timer(led.pin)
+            self.set_led(ch, True)
+            led.operation = 'on'
+            self.print_led(ch, 'Light ON\n')
+        elif command == 'off':
+            self.cancel_timer(led.pin)
+            self.set_led(ch, False)
+            led.operation = 'off'
+            self.print_led(ch, 'Light OFF\n')
+        elif command == 'trigger':
+            if self.train_state:
+                self.serial_print('Error: Cannot send a trigger while the trigger train is running\n')
+            else:
+                self.start_timer(PIN_TRIGGER, current_time, 0, 10, 0, 0, 'Trigger ON\n', 'Trigger OFF\n')
+        elif command.startswith('trig:'):
+            if command.startswith('trig:f'):
+                frequency_x1000 = value_after(command, 'f')
+                width = value_after(command, 'w')
+                limit = value_after(command, 'n')
+                period = int(1000000000.0 / frequency_x1000) if frequency_x1000 > 0 else 0
+                if frequency_x1000 <= 0 or width <= 0 or limit < 0 or width >= period:
+                    self.serial_print('Error: Invalid trigger train parameters, the pulse width must be shorter than the period\n')
+                else:
+                    self.cancel_timer(PIN_TRIGGER)
+                    self.train_period, self.train_width, self.train_limit = period, width, limit
+                    self.train_count = 1
+                    self.train_state = True
+                    self.digital_write(PIN_TRIGGER, 1)
+                    self.train_rise = self.micros()
+                    self.train_high = True
+                    self.update_indicator()
+                    self.serial_print(f'Trigger train ON at {self.train_rise & 0xFFFFFFFF} ({period} us period, {width} us pulse width)\n')
+            elif command == 'trig:count':
+                self.print_train_count('Trigger train count (')
+            elif command == 'trig:off':
+                if self.train_state:
+                    self.stop_train()
+                self.print_train_count('Trigger train OFF (')
+            else:
+                self.serial_print('Invalid Request\n')
+        elif command[:1] == 'r':
+            if led.operation == 'p':
+                self.print_led(ch, "Error: Cannot start 'r' mode while in 'p' mode\n")
+            else:
+                t_span = to_int(command[1:]) # stops at the 'd'
+                t_delay = value_after(command, 'd')
+                if self.start_timer(led.pin, current_time, t_delay, t_span, 0, 0, 'Light ON\n', 'Light OFF\n'):
+                    led.operation = 'r'
+        elif command.startswith('pump:'):
+            if command == 'pump:on':
+                self.cancel_timer(PIN_PUMP)
+                self.analog_write(PIN_PUMP, self.pump_value)
+                self.pump_state = True
+                self.serial_print('Pump ON\n')
+            elif command == 'pump:off':
+                self.cancel_timer(PIN_PUMP)
+                self.analog_write(PIN_PUMP, 0)
+                self.pump_state = False
+                self.close_valves()
+                self.serial_print('Pump OFF and all valves are CLOSED\n')
+            elif command.startswith('pump:value:'):
+                new_value = to_int(command[11:])
+                if 0 <= new_value <= 255:
+                    self.pump_value = new_value
+                    if self.pump_state:
+                        self.analog_write(PIN_PUMP, self.pump_value)
+                    self.serial_print(f'Pump value set to {self.pump_value}\n')
+                else:
+                    self.serial_print('Invalid pump value. Must be between 0-255\n')
+            elif command.startswith('pump:t'):
+                self.start_timer(PIN_PUMP, current_time, 0, to_int(command[6:]), 0, 0,
+                                 'Pump ON\n', 'Pump OFF and all valves are CLOSED\n')
+        elif command.startswith('pin:'):
+            parts = command.split(':', 2)
+            if len(parts) == 3 and parts[1]:
+                pin_index = to_int(parts[1])
+                if parts[2].upper() == 'HIGH':
+                    value = 1
+                elif parts[2].upper() == 'LOW':
+                    value = 0
+                else:
+                    value = to_int(parts[2])
+                if 0 <= pin_index <= 53:
+                    if 1 < value <= 255:
+                        self.analog_write(pin_index, value)
+                    elif pin_index in LED_PINS:
+                        self.set_led(LED_PINS.index(pin_index), value == 1)
+                    else:
+                        self.digital_write(pin_index, value == 1)
+                # no feedback for pin commands
+        elif command.startswith('wave:'):
+            if command == 'wave:clear':
+                if self.wave_playing:
+                    self.stop_wave()
+                self.wave = []
+                self.serial_print('Wave cleared\n')
+            elif command.startswith('wave:add:'):
+                if self.wave_playing:
+                    self.serial_print('Error: Wave is playing\n')
+                else:
+                    self.add_wave(command[9:])
+            elif command.startswith('wave:play'):
+                if not self.wave:
+                    self.serial_print('Error: Wave table is empty\n')
+                else:
+                    args = command[10:].split(':') if command[9:10] == ':' else []
+                    plays = to_int(args[0]) if args else 1
+                    self.wave_period = max(to_int(args[1]) if len(args) > 1 else 0, self.wave[-1][0])
+                    self.wave_plays = plays - 1 if plays > 0 else 0
+                    self.wave_index = 0
+                    self.wave_playing = True
+                    self.wave_start = self.micros()
+                    self.serial_print(f'Wave started at {self.wave_start}\n')
+                    self.service_wave()
+            elif command == 'wave:stop':
+                self.stop_wave()
+                self.serial_print(f'Wave stopped at {self.micros()}\n')
+        elif command.startswith('pulse'):
+            if 'f' in command and 'w' in command:
+                led.pulse_width = value_after(command, 'w')
+                led.frequency = value_after(command, 'f') / 1000
+                if not led.pulse_state:
+                    if led.operation in ('r', 'p'):
+                        self.print_led(ch, "Error: Cannot start continuous pulse while in 'r' or 'p' mode\n")
+                    else:
+                        self.start_continuous_pulse(ch, current_time)
+                else:
+                    led.pulse_period = int(1000.0 / led.frequency) if led.frequency else 0
+                    self.print_led(ch, f'Pulse parameters updated ({format_float(led.frequency)} Hz, {led.pulse_width} ms pulse width)\n')
+            elif command == 'pulse:on' or (command == 'pulse' and not led.pulse_state):
+                if led.frequency <= 0:
+                    self.print_led(ch, "Error: Pulse frequency not set. Use 'p' command first to set parameters\n")
+                elif led.operation in ('r', 'p'):
+                    self.print_led(ch, "Error: Cannot start continuous pulse while in 'r' or 'p' mode\n")
+                else:
+                    self.start_continuous_pulse(ch, current_time)
+            elif command == 'pulse:off' or command == 'pulse':
+                self.stop_continuous_pulse(ch)
+        elif command[:1] == 'p':
+            if led.operation == 'r':
+                self.print_led(ch, "Error: Cannot start 'p' mode while in 'r' mode\n")
+            else:
+                t_span = to_int(command[1:]) # stops at the 'f'
+                led.frequency = value_after(command, 'f') / 1000
+                led.pulse_width = value_after(command, 'w')
+                period = int(1000.0 / led.frequency) if led.frequency > 0 else 0
+                if self.start_timer(led.pin, current_time, 0, t_span, period, led.pulse_width,
+                                    'Pulsing ON\n', 'Pulsing OFF\n'):
+                    led.operation = 'p'
+        elif command.startswith('shock:'):
+            if command == 'shock:on':
+                self.shock_state = True
+                self.digital_write(PIN_SHOCK, 1)
+                self.shock_pulse_on = True
+                self.shock_pulse_start = current_time
+                self.last_shock_time = current_time
+                self.shock_pulse_count = 1
+                self.serial_print('Shock pulses ON\n')
+            elif command == 'shock:off':
+                self.shock_state = False
+                self.digital_write(PIN_SHOCK, 0)
+                self.shock_pulse_on = False
+                self.serial_print(f'Shock pulses OFF ({self.shock_pulse_count} pulses)\n')
+            elif command.startswith('shock:f'):
+                frequency = value_after(command, 'f') / 1000
+                width = value_after(command, 'w')
+                limit = value_after(command, 'n')
+                if frequency <= 0 or width <= 0 or limit < 0 or width >= 1000.0 / frequency:
+                    self.serial_print('Error: Invalid shock parameters, the pulse width must be shorter than the period\n')
+                else:
+                    self.shock_frequency = frequency
+                    self.shock_pulse_width = width
+                    self.shock_pulse_limit = limit
+                    self.shock_period = int(1000.0 / frequency)
+                    self.serial_print(f'Shock parameters set ({format_float(frequency)} Hz, {width} ms pulse width, {limit} pulses)\n')
+        elif command.startswith('air:') or command.startswith('odor_a:') or command.startswith('odor_b:'):
+            valve, action = command.split(':', 1)
+            pin, label = VALVES[valve]
+            if action == 'on':
+                self.cancel_timer(pin)
+                if self.validate_valve_operation():
+                    self.digital_write(pin, 1)
+                    setattr(self, f'{valve}_state', True)
+                    self.serial_print(f'{label} valve OPEN\n')
+            elif action == 'off':
+                self.cancel_timer(pin)
+                self.digital_write(pin, 0)
+                setattr(self, f'{valve}_state', False)
+                self.serial_print(f'{label} valve CLOSED\n')
+            elif action.startswith('t'):
+                if self.validate_valve_operation():
+                    self.start_timer(pin, current_time, 0, to_int(action[1:]), 0, 0,
+                                     f'{label} valve OPEN\n', f'{label} valve CLOSED\n')
+        else:
+            self.digital_write(PIN_INDICATOR, 1)
+            self.serial_print('Invalid Request\n')
+
+    def update(self):
+        '''handling of the ongoing operations at the end of loop()'''
+        current_time = self.millis()
+        if self.watchdog_window > 0 and not self.watchdog_tripped and current_time - self.last_host_time >= self.watchdog_window:
+            self.safe_state()
+            self.watchdog_tripped = True
+            self.serial_print(f'Watchdog tripped after {current_time - self.last_host_time} ms without heartbeat, all outputs off\n')
+        for timer in self.timers:
+            if timer.active:
+                self.service_timer(timer, current_time)
+        self.service_wave()
+        self.service_train()
+
+        if self.shock_state:
+            if not self.shock_pulse_on and current_time - self.last_shock_time >= self.shock_period:
+                self.digital_write(PIN_SHOCK, 1)
+                self.shock_pulse_on = True
+                self.shock_pulse_start = current_time
+                self.last_shock_time = current_time
+                self.shock_pulse_count += 1
+            elif self.shock_pulse_on and current_time - self.shock_pulse_start >= self.shock_pulse_width:
+                self.digital_write(PIN_SHOCK, 0)
+                self.shock_pulse_on = False
+                if self.shock_pulse_limit > 0 and self.shock_pulse_count >= self.shock_pulse_limit:
+                    self.shock_state = False
+                    self.serial_print(f'Shock pulses done ({self.shock_pulse_count} pulses)\n')
+
+        for ch, led in enumerate(self.leds):
+            if not led.pulse_state:
+                continue
+            if led.pulse_is_on:
+                if current_time - led.pulse_start_time >= led.pulse_width:
+                    self.set_led(ch, False)
+                    led.pulse_is_on = False
+            elif current_time - led.last_pulse_time >= led.pulse_period:
+                self.set_led(ch, True)
+                led.pulse_is_on = True
+                led.last_pulse_time = current_time
+                led.pulse_start_time = current_time
+
+
+class ArduinoEmulator:
+    '''
+    In-process replacement of serial.Serial connected to an emulated Arduino board
+
+    Parameters:
+        port (str): name reported as the port of the emulated board
+        baudrate (int): baud rate, used to compute the transfer time of each byte in both directions
+        timeout (float): read timeout in seconds, None to block like serial.Serial does by default
+        usb_latency (float): one-way latency (s) of the USB-serial bridge, added to every transfer
+        latency_jitter (float): upper bound (s) of the uniform random jitter added to usb_latency
+        loop_period (float): time (s) of one pass of loop() on the board
+        reset_delay (float): time (s) the board needs to boot after the port is opened; bytes sent earlier are lost
+        serial_number (str): USB serial number reported by the emulated board
+        record_transitions (bool): record every output change of the board in self.firmware.transitions
+        seed (int): seed of the jitter generator, for reproducible timing
+    '''
+    def __init__(self, port='EMULATOR', baudrate=9600, timeout=None, usb_latency=0.001, latency_jitter=0.0005,
+                 loop_period=0.0002, reset_delay=0.0, serial_number='EMU0', record_transitions=False, seed=None, **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.usb_latency = usb_latency
+        self.latency_jitter = latency_jitter
+        self.loop_period = loop_period
+        self.reset_delay = reset_delay
+        self.serial_number = serial_number
+        self.record_transitions = record_transitions
+        self.random = random.Random(seed)
+        self.byte_time = BITS_PER_BYTE / baudrate
+        self.is_open = False
+        self.firmware = None
+        self._t_replug = 0
+        self.open()
+
+    # ---------------------------------------------------------------- timing
+    def _now(self):
+        return time.perf_counter()
+
+    def _board_micros(self):
+        return (self._now() - self._t_boot) * 1e6
+
+    def _latency(self):
+        return self.usb_latency + self.random.uniform(0, self.latency_jitter)
+
+    # ---------------------------------------------------------------- serial.Serial API
+    def open(self):
+        if self.is_open:
+            return
+        if self._now() < self._t_replug:
+            raise serial.SerialException(f'could not open port {self.port}: board is unplugged')
+        self._lock = threading.Condition()
+        self._rx_board = deque() # (arrival time, byte) from host to board
+        self._rx_host = deque() # (arrival time, byte) from board to host
+        self._t_host_line = 0 # time when the board->host line is free again
+        self._t_board_line = 0 # time when the host->board line is free again
+        self._t_boot = self._now() + self.reset_delay
+        self._partial = bytearray() # bytes read by the firmware but not yet terminated by '\n'
+        self._overflow = False
+        self.firmware = EmulatedFirmware(self._board_micros, record_transitions=self.record_transitions)
+        self.is_open = True
+        self._thread = threading.Thread(target=self._run, name=f'ArduinoEmulator-{self.port}', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self._lock:
+            self.is_open = False
+            self._lock.notify_all()
+        self._thread.join(timeout=1)
+
+    def unplug(self, duration=0.5):
+        '''simulate a USB disconnect: the port is gone for duration seconds and the board resets when reopened'''
+        self._t_replug = self._now() + duration
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        if isinstance(data, str):
+            raise TypeError('unicode strings are not supported, please encode to bytes')
+        data = bytes(data)
+        with self._lock:
+            t_arrive = max(self._now() + self._latency(), self._t_board_line)
+            for b in data:
+                t_arrive += self.byte_time
+                self._rx_board.append((t_arrive, b))
+            self._t_board_line = t_arrive
+        return len(data)
+
+    def _available(self):
+        now = self._now()
+        n = 0
+        for t_arrive, _ in self._rx_host:
+            if t_arrive > now:
+                break
+            n += 1
+        return n
+
+    @property
+    def in_waiting(self):
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        with self._lock:
+            return self._available()
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        '''read up to size bytes, blocking until they arrived or the timeout expired'''
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        data = bytearray()
+        t_end = None if self.timeout is None else self._now() + self.timeout
+        with self._lock:
+            while len(data) < size:
+                now = self._now()
+                if self._rx_host and self._rx_host[0][0] <= now:
+                    data.append(self._rx_host.popleft()[1])
+                    continue
+                if t_end is not None and now >= t_end:
+                    break
+                if not self.is_open:
+                    break
+                self._lock.wait(self._wait_time(now, t_end))
+        return bytes(data)
+
+    def readline(self):
+        '''read up to and including "\\n", or what arrived before the timeout expired'''
+        if not self.is_open:
+            raise serial.PortNotOpenError()
+        line = bytearray()
+        t_end = None if self.timeout is None else self._now() + self.timeout
+        with self._lock:
+            while True:
+                now = self._now()
+                if self._rx_host and self._rx_host[0][0] <= now:
+                    b = self._rx_host.popleft()[1]
+                    line.append(b)
+                    if b == ord('\n'):
+                        break
+                    continue
+                if t_end is not None and now >= t_end:
+                    break
+                if not self.is_open:
+                    break
+                self._lock.wait(self._wait_time(now, t_end))
+        return bytes(line)
+
+    def _wait_time(self, now, t_end):
+        wait = self._rx_host[0][0] - now if self._rx_host else self.loop_period * 10
+        if t_end is not None:
+            wait = min(wait, t_end - now)
+        return max(wait, 0)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._rx_host.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flush(self):
+        '''wait until all written bytes have been received by the board'''
+        while self.is_open and self._now() < self._t_board_line:
+            time.sleep(self.byte_time)
+
+    # ---------------------------------------------------------------- board side
+    def _run(self):
+        '''main loop of the emulated board'''
+        while self.is_open:
+            now = self._now()
+            if now < self._t_boot:
+                with self._lock: # the bootloader swallows everything sent before the sketch is running
+                    while self._rx_board and self._rx_board[0][0] <= now:
+                        self._rx_board.popleft()
+                time.sleep(self.loop_period)
+                continue
+            with self._lock:
+                command = self.firmware.due_command() # a due scheduled command is run before reading the next line
+                if command is None:
+                    command = self._read_command(now)
+                if command is not None:
+                    self.firmware.receive_line(command)
+                self.firmware.update()
+                self._transmit(now)
+            time.sleep(self.loop_period)
+
+    def _read_command(self, now):
+        '''
+        model of readCommand() of the firmware: the arrived bytes are moved into the command buffer without waiting,
+        at most one command is completed per pass of loop()
+
+        Returns:
+            str: complete command without the "\\n", None if no complete command has arrived
+        '''
+        while self._rx_board and self._rx_board[0][0] <= now:
+            b = self._rx_board.popleft()[1]
+            if b == ord('\n'):
+                self.firmware.feed_watchdog()
+                command = None if self._overflow else self._partial.decode(errors='replace')
+                if self._overflow:
+                    self.firmware.serial_print('Error: Command too long\n')
+                self._partial = bytearray()
+                self._overflow = False
+                return command
+            if b == ord('\r'):
+                continue
+            if len(self._partial) < CMD_BUFFER_SIZE - 1:
+                self._partial.append(b)
+            else:
+                self._overflow = True
+        return None
+
+    def _transmit(self, now):
+        '''move the printed lines of the firmware to the host receive buffer, one byte time per byte'''
+        if not self.firmware.output:
+            return
+        t_send = max(now, self._t_host_line)
+        t_last = self._rx_host[-1][0] if self._rx_host else 0
+        while self.firmware.output:
+            latency = self._latency()
+            line = self.firmware.output.popleft()
+            for b in line if isinstance(line, bytes) else line.encode():
+                t_send += self.byte_time
+                t_last = max(t_send + latency, t_last) # bytes never overtake each other
+                self._rx_host.append((t_last, b))
+        self._t_host_line = t_send
+        self._lock.notify_all()
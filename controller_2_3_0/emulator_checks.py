@@ -0,0 +1,200 @@
+'''
+Checks of the controller against the emulated board
+
+firmware_sim.py checks the firmware model alone on a virtual clock. These checks run the host side (StimController,
+stimfunc.py, serial_link.py) against the emulated board in real time (arduino_emulator.ArduinoEmulator, board_type
+'Emulator'), so the paths that only fail with the serial line in between are covered: the reconnect of the port, the
+feedback of the commands and the mirrored states of the outputs. Each check runs on a new controller logging into a
+temporary folder, and compares the states mirrored by the controller with the outputs of the emulated firmware.
+
+Usage:
+    results = emulator_checks.run_checks() # {check name: list of errors}
+    python emulator_checks.py [check name ...]
+'''
+import os
+import csv
+import sys
+import time
+import tempfile
+import threading
+import log_writer
+import serial_benchmark
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 10 # s, a command running longer is reported as hung
+
+
+def new_controller(save_path, **kwargs):
+    '''StimController on the emulated board, without the background window, logging into save_path'''
+    from StimulationAssistant import StimController # imported here, StimulationAssistant may import this module
+    settings = dict(video_dir=os.path.join(SCRIPT_PATH, 'looming_videos', 'small_test'), shut_backgroud=True,
+                    board_type='Emulator', log_name='checks', save_path=save_path,
+                    protocol_saveas=os.path.join(save_path, 'checks_protocol.txt'), update_pulse=False, update_timer=False)
+    settings.update(kwargs)
+    return StimController(**settings)
+
+def close(controller):
+    '''switch off the outputs and close the port and the log files of a controller, like terminate() without the windows'''
+    controller.switch_off_outputs()
+    controller.stop_watchdog()
+    controller.ser.close()
+    log_writer.stop(controller.log_file)
+    log_writer.stop(controller.protocol_saveas)
+
+def run_timed(function, *args, timeout=TIMEOUT, **kwargs):
+    '''run function(*args, **kwargs) in a thread, its return value, or raise TimeoutError if it still runs after timeout'''
+    result = []
+    thread = threading.Thread(target=lambda: result.append(function(*args, **kwargs)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        arguments = ', '.join(repr(arg) for arg in args if isinstance(arg, str)) # not the controllers
+        raise TimeoutError(f'{function.__name__}({arguments}) still running after {timeout} s')
+    return result[0] if result else None
+
+def state_errors(controller, expected):
+    '''mismatches of the outputs mirrored by the controller and of the emulated firmware with the expected ones'''
+    firmware = controller.ser.ser.firmware
+    errors = []
+    for output, state in expected.items():
+        if getattr(controller, f'{output}_state') != state:
+            errors.append(f'{output} mirrored {"ON" if not state else "OFF"} instead of {"ON" if state else "OFF"}')
+        if getattr(firmware, f'{output}_state') != state:
+            errors.append(f'{output} of the board {"ON" if not state else "OFF"} instead of {"ON" if state else "OFF"}')
+    return errors
+
+def logged_events(controller, event_type):
+    '''(target, value) of the events of a type logged by a controller so far, from its CSV event file'''
+    log_writer.flush(controller.log_file)
+    with open(log_writer.events_path(controller.log_file), newline='', encoding='utf-8') as file:
+        return [(row['target'], row['value']) for row in csv.DictReader(file) if row['type'] == event_type]
+
+
+def check_reconnect(controller):
+    '''
+    Unplug the board while the pump is on, the next command reconnects, resyncs the outputs (which writes to the
+    port) and is written again on the reset board
+    '''
+    controller.process_command('pump:on')
+    controller.ser.ser.unplug(0.3)
+    run_timed(controller.process_command, 'air:on')
+    return state_errors(controller, {'pump': True, 'air': True})
+
+def check_round_trip(controller):
+    '''switch each output on and off with the commands of the controller, the mirrored states follow the board'''
+    errors = []
+    controller.process_command('pump:on')
+    for output in ['air', 'odor_a', 'odor_b', 'shock']:
+        for state in (True, False):
+            command = f'{output}:{"on" if state else "off"}'
+            result = run_timed(controller.process_command, command)
+            errors += [f'{command}: {error}' for error in state_errors(controller, {output: state})]
+            if result != 0:
+                errors.append(f'{command} returned {result}')
+    run_timed(controller.process_command, 'pump:off')
+    return errors + state_errors(controller, {'pump': False})
+
+def check_flood(controller):
+    '''flood the board with whole and split lines while it pulses the LED, the pulse timing and feedback hold'''
+    # the emulator runs in real time, a loop stalled by a split line shows as a period error of at least split_delay
+    # (20 ms), while the threads of the host may delay the emulated loop by a few ms
+    results = run_timed(serial_benchmark.stress_test, controller.ser, duration=3, tolerance=0.01, print_flag=False,
+                        timeout=TIMEOUT + 5)
+    if results['passed']:
+        return []
+    errors = [f'{results["feedback_received"]}/{results["feedback_expected"]} feedback lines']
+    if results['period_error'] is not None:
+        errors.append(f'largest period error {results["period_error"]*1000:.2f} ms, width error {results["width_error"]*1000:.2f} ms')
+    return errors
+
+def check_prearmed_valve(controller):
+    '''a valve opened by the board at the end of an ISI (pre-armed) is mirrored and logged, so the next command closes it'''
+    controller.prearm = True
+    result = run_timed(controller.parse_combined_commands, 'pump:on > isi0.3 > odor_a:on > odor_a:off')
+    errors = [] if result == 0 else [f'command series returned {result}']
+    errors += state_errors(controller, {'pump': True, 'odor_a': False})
+    valve_events = logged_events(controller, 'valve')
+    if valve_events != [('odor_a', 'on'), ('odor_a', 'off')]:
+        errors.append(f'valve events {valve_events} instead of odor_a on and off')
+    return errors
+
+def check_prearm_cancel(controller):
+    '''a series stopped during an ISI cancels the command pre-armed for its end, the board does not run it later'''
+    controller.prearm = True
+    series = threading.Thread(target=controller.parse_combined_commands, args=('pump:on > isi1 > air:on',), daemon=True)
+    series.start()
+    time.sleep(0.5)
+    controller.abort_event.set() # like <Ctrl+C> on another board
+    series.join(TIMEOUT)
+    controller.abort_event.clear()
+    if series.is_alive():
+        return [f'command series still running {TIMEOUT} s after it was stopped']
+    time.sleep(1) # past the time the air valve was scheduled for
+    errors = state_errors(controller, {'pump': True, 'air': False})
+    if controller.ser.ser.firmware.scheduled:
+        errors.append(f'{len(controller.ser.ser.firmware.scheduled)} commands left scheduled on the board')
+    return errors
+
+def check_scheduled_command(controller):
+    '''
+    The feedback of a "<command>@<seconds>" arrives while the next command waits for its own feedback; it is deferred,
+    mirrored and logged instead of failing that command
+    '''
+    errors = []
+    for command in ['pump:on', 'air:on@0.2', 'isi0.5', 'r0.1']:
+        result = run_timed(controller.process_command, command)
+        if result != 0:
+            errors.append(f'{command} returned {result}')
+    controller.ClearSerialBuffer()
+    errors += state_errors(controller, {'pump': True, 'air': True})
+    valve_events = logged_events(controller, 'valve')
+    if valve_events != [('air', 'on')]:
+        errors.append(f'valve events {valve_events} instead of air on')
+    return errors
+
+
+CHECKS = {
+    'round trip': check_round_trip,
+    'flood': check_flood,
+    'reconnect': check_reconnect,
+    'prearmed valve': check_prearmed_valve,
+    'prearm cancel': check_prearm_cancel,
+    'scheduled': check_scheduled_command,
+}
+
+
+def run_checks(names=None, print_flag=True, **kwargs):
+    '''
+    Run the checks, each on a new controller on the emulated board
+
+    Parameters:
+        names (list): names of the CHECKS to run, all by default
+        kwargs: settings of the controllers, see new_controller()
+
+    Returns:
+        dict: {check name: list of errors}
+    '''
+    results = {}
+    for name in (CHECKS if names is None else names):
+        with tempfile.TemporaryDirectory() as save_path:
+            controller = new_controller(save_path, **kwargs)
+            try:
+                results[name] = CHECKS[name](controller)
+            except Exception as e: # e.g. a hung command, the next checks still run
+                results[name] = [f'{type(e).__name__}: {e}']
+            finally:
+                try:
+                    run_timed(close, controller)
+                except Exception as e:
+                    results[name].append(f'closing failed, {type(e).__name__}: {e}')
+        if print_flag:
+            status = '\033[32mPASSED\033[0m' if not results[name] else '\033[31mFAILED\033[0m'
+            print(f'{name:<16}{status}')
+            for error in results[name]:
+                print(f'    {error}')
+    return results
+
+
+if __name__ == '__main__':
+    results = run_checks(sys.argv[1:] or None)
+    os._exit(1 if any(results.values()) else 0) # a hung command leaves its thread behind
@@ -0,0 +1,225 @@
+'''
+Columnar event store of a session
+
+The text log and the CSV event file of a session that runs for days grow into files that take a full scan to find the
+events of one type. The event writer of log_writer.py also appends each event to an EventStore, a directory next to
+the log ("<date>_<name>_store") of fixed-width records in memory-mapped segment files:
+    segment_00000.bin, segment_00001.bin, ...: SEGMENT_RECORDS records of RECORD each, preallocated with zeros
+    strings.txt: the strings of the type, stimulus, target and value columns, one per line, a record keeps their line
+        index, so the records are fixed-width
+
+A record is never rewritten, so the store is read by any process while the controller appends to it. Each segment keeps
+the range of its wall times and an index of its rows per event type, built with one argsort when first queried, so
+query() and last() only read the rows of the requested type in the segments overlapping the requested time range.
+
+Usage:
+    store = event_store.EventStore(event_store.store_path(log_path)) # read-only, e.g. from an analysis script
+    store.last('LED', value='on') # dict of the last "LED on" event
+    records = store.query('valve', start=datetime(2024, 5, 1, 8), end=datetime(2024, 5, 1, 20), target='air')
+    table = store.decode(records) # {column: array}, pandas.DataFrame(table) for a table
+    # wall_ns is UTC, pandas.to_datetime(table['wall_ns'], utc=True).tz_convert(<time zone>) for the local wall time
+'''
+import os
+import glob
+import numpy as np
+from datetime import datetime
+
+RECORD = np.dtype([
+    ('t_ns', '<i8'), # time.perf_counter_ns() of the event in the session that recorded it
+    ('wall_ns', '<i8'), # wall time of the event, ns since the epoch
+    ('type', '<u4'), # line of strings.txt
+    ('stimulus', '<u4'),
+    ('target', '<u4'),
+    ('value', '<u4'),
+    ('number', '<f8'), # value as a number, NaN if it is not one
+    ('command', '<u4'), # index of the command of the session that caused the event
+])
+SEGMENT_RECORDS = 65536 # 2.9 MB per segment
+
+
+def store_path(path):
+    '''directory of the event store of a log file, "<date>_<name>_store" next to "<date>_<name>_log.txt"'''
+    return (path[:-len('_log.txt')] if path.endswith('_log.txt') else os.path.splitext(path)[0]) + '_store'
+
+def to_wall_ns(t):
+    '''wall time in ns since the epoch of a datetime, an EventTime or a number of ns'''
+    if t is None or isinstance(t, (int, np.integer)):
+        return t
+    if isinstance(t, datetime):
+        return round(t.timestamp() * 1e6) * 1000
+    return t.wall_ns
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class Segment:
+    '''one memory-mapped segment file of an EventStore'''
+    def __init__(self, path, writable):
+        if writable and not os.path.exists(path):
+            with open(path, 'wb') as segment:
+                segment.truncate(SEGMENT_RECORDS * RECORD.itemsize)
+        self.records = np.memmap(path, RECORD, 'r+' if writable else 'r')
+        written = self.records['wall_ns'] != 0
+        self.count = len(written) if written.all() else int(np.argmin(written)) # the records are appended in order
+        self.t_min = int(self.records['wall_ns'][:self.count].min()) if self.count else None
+        self.t_max = int(self.records['wall_ns'][:self.count].max()) if self.count else None
+        self.index = {} # {type: rows}
+        self.indexed = 0 # rows [0, indexed) are in the index
+        self.dirty = False # appended to since the last flush
+
+    def append(self, records):
+        self.records[self.count:self.count + len(records)] = records
+        self.count += len(records)
+        self.dirty = True
+        t_min, t_max = int(records['wall_ns'].min()), int(records['wall_ns'].max())
+        self.t_min = t_min if self.t_min is None else min(self.t_min, t_min)
+        self.t_max = t_max if self.t_max is None else max(self.t_max, t_max)
+
+    def overlaps(self, start, end):
+        return self.count > 0 and (start is None or self.t_max >= start) and (end is None or self.t_min <= end)
+
+    def rows(self, type_code):
+        '''rows of the events of a type, in the order they were appended'''
+        if self.indexed < self.count: # index the rows appended since the last query
+            types = np.asarray(self.records['type'][self.indexed:self.count])
+            order = np.argsort(types, kind='stable')
+            codes, starts = np.unique(types[order], return_index=True)
+            for code, rows in zip(codes.tolist(), np.split(order + self.indexed, starts[1:])):
+                self.index[code] = np.concatenate([self.index[code], rows]) if code in self.index else rows
+            self.indexed = self.count
+        return self.index.get(type_code, np.empty(0, dtype=np.intp))
+
+
+class EventStore:
+    '''
+    Append-only store of the events of a session, see the module docstring
+
+    Parameters:
+        path (str): directory of the store
+        writable (bool): open the store for appending, created if it does not exist; read-only otherwise
+    '''
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        if writable:
+            os.makedirs(path, exist_ok=True)
+        self.strings = []
+        self.codes = {} # {string: line of strings.txt}
+        strings_path = os.path.join(path, 'strings.txt')
+        if os.path.exists(strings_path):
+            with open(strings_path, encoding='utf-8') as strings:
+                for line in strings.read().split('\n')[:-1]:
+                    self.codes[line] = len(self.strings)
+                    self.strings.append(line)
+        self._strings = open(strings_path, 'a', encoding='utf-8') if writable else None
+        self.segments = [Segment(file, writable) for file in sorted(glob.glob(os.path.join(path, 'segment_*.bin')))]
+
+    def code(self, text):
+        '''line of strings.txt of a string, added to the file if it is new'''
+        text = str(text).replace('\n', ' ')
+        code = self.codes.get(text)
+        if code is None:
+            code = self.codes[text] = len(self.strings)
+            self.strings.append(text)
+            self._strings.write(text + '\n')
+            self._strings.flush() # before a record refers to it
+        return code
+
+    def append(self, events):
+        '''append (type, EventTime, stimulus, target, value, command) tuples, the rows of the CSV event file'''
+        records = np.zeros(len(events), dtype=RECORD)
+        for i, (event_type, t_event, stimulus, target, value, command) in enumerate(events):
+            records[i] = (t_event.ns, t_event.wall_ns, self.code(event_type), self.code(stimulus), self.code(target),
+                          self.code(value), as_number(value), command)
+        while len(records):
+            if not self.segments or self.segments[-1].count == SEGMENT_RECORDS:
+                self.segments.append(Segment(os.path.join(self.path, f'segment_{len(self.segments):05d}.bin'), True))
+            segment = self.segments[-1]
+            n = min(len(records), SEGMENT_RECORDS - segment.count)
+            segment.append(records[:n])
+            records = records[n:]
+
+    def flush(self):
+        '''write the mapped pages of the segments appended to the disk'''
+        for segment in self.segments:
+            if segment.dirty:
+                segment.records.flush()
+                segment.dirty = False
+
+    def close(self):
+        if self.writable:
+            self.flush()
+            self._strings.close()
+
+    def refresh(self):
+        '''read the records appended by another process since the store was opened, for a read-only store'''
+        if not self.writable:
+            self.__init__(self.path)
+
+    def query(self, event_type=None, start=None, end=None, target=None, value=None):
+        '''
+        Events in a time range
+
+        Parameters:
+            event_type (str): type of the events, None for all types
+            start, end (datetime, EventTime or int ns): range of the wall time of the events, None for no limit
+            target, value: only the events with this target or value (compared as text)
+
+        Returns:
+            records (RECORD array) in the order they were appended, see decode()
+        '''
+        return self._query(self.segments, event_type, start, end, target, value)
+
+    def _query(self, segments, event_type, start=None, end=None, target=None, value=None):
+        start, end = to_wall_ns(start), to_wall_ns(end)
+        filters = [(column, self.codes.get(str(text))) for column, text in (('target', target), ('value', value))
+                   if text is not None]
+        type_code = self.codes.get(event_type) if event_type is not None else None
+        if (event_type is not None and type_code is None) or any(code is None for _, code in filters):
+            return np.zeros(0, dtype=RECORD) # a string never recorded
+        found = []
+        for segment in segments:
+            if not segment.overlaps(start, end):
+                continue
+            rows = segment.rows(type_code) if event_type is not None else slice(0, segment.count)
+            records = segment.records[rows]
+            keep = np.ones(len(records), dtype=bool)
+            if start is not None:
+                keep &= records['wall_ns'] >= start
+            if end is not None:
+                keep &= records['wall_ns'] <= end
+            for column, code in filters:
+                keep &= records[column] == code
+            found.append(records[keep])
+        return np.concatenate(found) if found else np.zeros(0, dtype=RECORD)
+
+    def last(self, event_type, target=None, value=None):
+        '''the latest event of a type (dict of its fields, and 'wall', its local wall time), None if there is none'''
+        found = None
+        for segment in reversed(self.segments): # the board events of a pull are appended after later events
+            if found is not None and segment.t_max is not None and segment.t_max < found['wall_ns']:
+                break
+            records = self._query([segment], event_type, target=target, value=value)
+            if len(records):
+                latest = records[np.argmax(records['wall_ns'])]
+                if found is None or latest['wall_ns'] > found['wall_ns']:
+                    found = latest
+        if found is None:
+            return None
+        event = {column: values[0] for column, values in self.decode(found[None]).items()}
+        event['wall'] = datetime.fromtimestamp(event['wall_ns'] / 1e9)
+        return event
+
+    def decode(self, records):
+        '''{column: array} of records, with the strings in place of their codes'''
+        strings = np.array(self.strings, dtype=object)
+        table = {'type': strings[records['type']], 't_ns': records['t_ns'], 'wall_ns': records['wall_ns']}
+        for column in ('stimulus', 'target', 'value'):
+            table[column] = strings[records[column]]
+        table['number'] = records['number']
+        table['command'] = records['command']
+        return table
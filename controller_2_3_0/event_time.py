@@ -0,0 +1,96 @@
+'''
+Timestamps of the events of a session
+
+The helpers of stimfunc.py and the controller take the time of an event right when the feedback of the board arrives,
+in the timing-critical part of a command. EventTime.now() only reads time.perf_counter_ns(); the wall time is found
+from the session anchor, a (perf_counter_ns, time_ns) pair read when the module is imported, and formatted only when
+the timestamp is written to the log. The timestamps of a session are therefore monotonic and keep their spacing when
+the wall clock is stepped during the session (NTP, manual change).
+
+Usage:
+    t_fb = EventTime.now()
+    ...
+    log.write(f'Feedback Light ON at {t_fb}\\n') # 'YYYY-MM-DD HH:MM:SS.fff'
+'''
+import time
+import functools
+from datetime import datetime, timedelta
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def read_anchor(pairs=5):
+    '''(perf_counter_ns, time_ns) read back to back, the pair read in the shortest time out of a few'''
+    readings = []
+    for _ in range(pairs):
+        t0 = time.perf_counter_ns()
+        wall = time.time_ns()
+        t1 = time.perf_counter_ns()
+        readings.append((t1 - t0, (t0 + t1) // 2, wall))
+    _, perf_ns, wall_ns = min(readings)
+    return perf_ns, wall_ns
+
+PERF_ANCHOR_NS, WALL_ANCHOR_NS = read_anchor() # the session anchor
+
+
+@functools.total_ordering
+class EventTime:
+    '''
+    Time of an event, a time.perf_counter_ns() reading shown as wall time through the session anchor
+
+    str() gives the 'YYYY-MM-DD HH:MM:SS.fff' time of the log lines. Like a datetime, an EventTime has strftime(), can be
+    shifted by a timedelta, and the difference of two EventTimes is a timedelta.
+    '''
+    __slots__ = ('ns',)
+
+    def __init__(self, ns):
+        self.ns = ns # time.perf_counter_ns() of the event
+
+    @classmethod
+    def now(cls):
+        return cls(time.perf_counter_ns())
+
+    @classmethod
+    def from_datetime(cls, t):
+        '''EventTime of a wall time, e.g. a time parsed from a log line'''
+        return cls(PERF_ANCHOR_NS + round(t.timestamp() * 1e6) * 1000 - WALL_ANCHOR_NS)
+
+    @property
+    def wall_ns(self):
+        '''wall time of the event (ns since the epoch) according to the session anchor'''
+        return WALL_ANCHOR_NS + self.ns - PERF_ANCHOR_NS
+
+    def datetime(self):
+        seconds, ns = divmod(self.wall_ns, 1_000_000_000)
+        return datetime.fromtimestamp(seconds) + timedelta(microseconds=ns // 1000)
+
+    def strftime(self, fmt):
+        return self.datetime().strftime(fmt)
+
+    def __str__(self):
+        return self.strftime(TIME_FORMAT)[:-3]
+
+    def __repr__(self):
+        return f'EventTime({self.strftime(TIME_FORMAT)})'
+
+    def __format__(self, spec):
+        return format(str(self), spec)
+
+    def __add__(self, delta):
+        return EventTime(self.ns + delta // timedelta(microseconds=1) * 1000)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, EventTime):
+            return timedelta(microseconds=(self.ns - other.ns) / 1000)
+        return EventTime(self.ns - other // timedelta(microseconds=1) * 1000)
+
+    def __eq__(self, other):
+        return isinstance(other, EventTime) and self.ns == other.ns
+
+    def __lt__(self, other):
+        return self.ns < other.ns
+
+    def __hash__(self):
+        return hash(self.ns)
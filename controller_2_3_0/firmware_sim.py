@@ -0,0 +1,310 @@
+'''
+Simulation of arduino_communication_6.ino on a virtual clock
+
+FirmwareSimulator runs the loop() model of arduino_emulator.EmulatedFirmware pass by pass on a virtual micros()
+clock instead of the wall clock, so a sequence of commands always yields the same pin transitions, independent of
+the load of the computer. The serial line is modelled byte by byte: the 64-byte receive buffer of the board drops
+the bytes arriving while it is full, and Serial.print() blocks loop() while the 64-byte transmit buffer is full.
+
+run_regression() plays the timed sequences of the firmware (p, pulse, shock, trigger, delayed and scheduled
+commands, watchdog) and checks the widths, periods, delays and order of the recorded pulses against the expected values.
+benchmark() measures how many commands per second the loop absorbs at a given baud rate.
+
+Usage:
+    sim = FirmwareSimulator(baudrate=9600)
+    sim.send('p1000f10000w20')
+    sim.run(1500)
+    periods, widths = sim.pulse_timing(PIN_LED)
+    # REPL: bench:sim
+'''
+import time
+from collections import deque
+import numpy as np
+from arduino_emulator import EmulatedFirmware, BITS_PER_BYTE, CMD_BUFFER_SIZE, PIN_LED, PIN_LED_GREEN, PIN_TRIGGER, \
+    PIN_SHOCK, PIN_AIR, PIN_PUMP
+from serial_benchmark import STRESS_COMMANDS, pulse_timing
+
+RX_BUFFER_SIZE = 64 # receive buffer of HardwareSerial (Arduino Uno)
+TX_BUFFER_SIZE = 64 # transmit buffer of HardwareSerial (Arduino Uno)
+
+# name: ([(time ms, command), ...], [check, ...]), the host writes each command at its time; a check compares the
+# pulses on a pin with the expected width, period and count (ms, None to skip) and their delay from the handling
+# of the command "after"; the firmware counts whole milliseconds, so every value holds within TOLERANCE
+REGRESSION_CASES = {
+    'p': ([(0, 'p1000f10000w20')],
+          [dict(pin=PIN_LED, width=20, period=100, count=10, after='p1000f10000w20', delay=0)]),
+    'pulse': ([(0, 'pulse:f5000w50'), (900, 'pulse:off')],
+              [dict(pin=PIN_LED, width=50, period=200, count=5, after='pulse:f5000w50', delay=0)]),
+    'pulse ch1': ([(0, 'ch1:pulse:f4000w30'), (900, 'ch1:pulse:off')],
+                  [dict(pin=PIN_LED_GREEN, width=30, period=250, count=4, after='ch1:pulse:f4000w30', delay=0)]),
+    'shock': ([(0, 'shock:f2000w100n3'), (0, 'shock:on')],
+              [dict(pin=PIN_SHOCK, width=100, period=500, count=3, after='shock:on', delay=0)]),
+    'trigger': ([(0, 'trigger')],
+                [dict(pin=PIN_TRIGGER, width=10, period=None, count=1, after='trigger', delay=0)]),
+    'trigger train': ([(0, 'trig:f30000w5000n10')],
+                      [dict(pin=PIN_TRIGGER, width=5, period=1000 / 30, count=10, after='trig:f30000w5000n10', delay=0)]),
+    'r delay': ([(0, 'r300d200')],
+                [dict(pin=PIN_LED, width=300, period=None, count=1, after='r300d200', delay=200)]),
+    'scheduled': ([(0, 'trigger@250')],
+                  [dict(pin=PIN_TRIGGER, width=10, period=None, count=1, after='trigger@250', delay=250)]),
+    'cancel': ([(0, 'trigger@250'), (100, 'cancel')],
+               [dict(pin=PIN_TRIGGER, width=None, period=None, count=0, after='cancel', delay=None)]),
+    'timed valve': ([(0, 'pump:on'), (0, 'air:t400'), (600, 'pump:off')],
+                    [dict(pin=PIN_AIR, width=400, period=None, count=1, after='air:t400', delay=0)]),
+    'watchdog': ([(0, 'wd:300'), (0, 'pump:on')],
+                 [dict(pin=PIN_PUMP, width=300, period=None, count=1, after='pump:on', delay=0)]),
+    'trigger then r': ([(0, 'trigger'), (0, 'r50d20')],
+                       [dict(pin=PIN_TRIGGER, width=10, period=None, count=1, after='trigger', delay=0),
+                        dict(pin=PIN_LED, width=50, period=None, count=1, after='r50d20', delay=20)]),
+}
+TOLERANCE = 1.5 # ms, one millisecond of the firmware clock plus the loop period
+
+
+class FirmwareSimulator:
+    '''
+    The firmware model run on a virtual clock, one pass of loop() at a time
+
+    Parameters:
+        baudrate (int): baud rate of the serial line, None to deliver every command at once
+        loop_us (float): duration of a pass of loop() without a command (us)
+        command_us (float): additional duration of a pass that handles a command (us)
+    '''
+    def __init__(self, baudrate=9600, loop_us=200, command_us=300):
+        self.baudrate = baudrate
+        self.loop_us = loop_us
+        self.command_us = command_us
+        self.byte_us = BITS_PER_BYTE / baudrate * 1e6 if baudrate else 0
+        self.t_us = 0.0
+        self.firmware = EmulatedFirmware(lambda: self.t_us, record_transitions=True)
+        self.received = [] # (micros, command) of the commands handled by the loop
+        self.lines = [] # (micros, line) of the lines sent by the board, timed when their last byte is sent
+        self.dropped_bytes = 0 # bytes lost because the receive buffer of the board was full
+        self._rx = deque() # (arrival micros, byte) from host to board
+        self._t_rx_line = 0.0 # time when the host->board line is free again
+        self._t_tx_line = 0.0 # time when the transmit buffer of the board is empty
+        self._partial = bytearray()
+        self._overflow = False
+        self._drain_output()
+
+    @property
+    def transitions(self):
+        '''(micros, pin, value) of every output change'''
+        return self.firmware.transitions
+
+    def send(self, command, at_ms=None):
+        '''
+        Send a command line from the host
+
+        Parameters:
+            command (str): command without the "\\n"
+            at_ms (float): time when the host writes the command, None to write it now; bytes queue up behind the
+                previous command while the line is busy
+        '''
+        t_send = max(self.t_us if at_ms is None else at_ms * 1000, self._t_rx_line)
+        for b in (command + '\n').encode():
+            t_send += self.byte_us
+            self._rx.append((t_send, b))
+        self._t_rx_line = t_send
+
+    def step(self):
+        '''run one pass of loop() and advance the clock by its duration'''
+        self._drop_overflow()
+        command = self.firmware.due_command()
+        if command is None:
+            command = self._read_command()
+        if command is not None:
+            self.received.append((self.t_us, command))
+            self.firmware.receive_line(command)
+        self.firmware.update()
+        self.t_us += self.loop_us + (self.command_us if command is not None else 0)
+        self._drain_output()
+
+    def run(self, duration_ms):
+        '''run loop() for duration_ms of board time'''
+        self.run_until(self.t_us / 1000 + duration_ms)
+
+    def run_until(self, t_ms):
+        '''run loop() until the board clock reaches t_ms'''
+        while self.t_us < t_ms * 1000:
+            self.step()
+
+    def run_idle(self, timeout_ms=60000):
+        '''run loop() until every sent byte has been read or dropped, then return the board time (ms)'''
+        t_end = self.t_us + timeout_ms * 1000
+        while self._rx and self.t_us < t_end:
+            self.step()
+        return self.t_us / 1000
+
+    def pulse_timing(self, pin, t_start_ms=0):
+        '''(periods, widths) of the pulses on a pin in seconds, see serial_benchmark.pulse_timing()'''
+        return pulse_timing(self.transitions, pin, t_start_ms * 1000)
+
+    def rises(self, pin):
+        '''times (us) when a pin went high'''
+        return [t for t, p, v in self.transitions if p == pin and v]
+
+    def _drop_overflow(self):
+        '''the bytes arriving while the receive buffer holds RX_BUFFER_SIZE unread bytes are lost'''
+        arrived = 0
+        kept = deque()
+        while self._rx:
+            t, b = self._rx.popleft()
+            if t <= self.t_us:
+                arrived += 1
+                if arrived > RX_BUFFER_SIZE:
+                    self.dropped_bytes += 1
+                    continue
+            kept.append((t, b))
+        self._rx = kept
+
+    def _read_command(self):
+        '''readCommand() of the firmware, see ArduinoEmulator._read_command()'''
+        while self._rx and self._rx[0][0] <= self.t_us:
+            b = self._rx.popleft()[1]
+            if b == ord('\n'):
+                self.firmware.feed_watchdog()
+                command = None if self._overflow else self._partial.decode(errors='replace')
+                if self._overflow:
+                    self.firmware.serial_print('Error: Command too long\n')
+                self._partial = bytearray()
+                self._overflow = False
+                return command
+            if b == ord('\r'):
+                continue
+            if len(self._partial) < CMD_BUFFER_SIZE - 1:
+                self._partial.append(b)
+            else:
+                self._overflow = True
+        return None
+
+    def _drain_output(self):
+        '''queue the printed lines on the transmit buffer, loop() is blocked while the buffer is full'''
+        while self.firmware.output:
+            line = self.firmware.output.popleft()
+            size = len(line) if isinstance(line, bytes) else len(line.encode())
+            self._t_tx_line = max(self._t_tx_line, self.t_us) + size * self.byte_us
+            self.lines.append((self._t_tx_line, line))
+            self.t_us = max(self.t_us, self._t_tx_line - TX_BUFFER_SIZE * self.byte_us)
+
+
+def check_pulses(sim, pin, width, period, count, after, delay, tolerance=TOLERANCE):
+    '''
+    Compare the pulses recorded on a pin with the expected ones, see REGRESSION_CASES
+
+    Returns:
+        list: descriptions of the mismatches, empty if the pulses are as expected
+    '''
+    t0_us = next((t for t, command in sim.received if command == after), None)
+    if t0_us is None:
+        return [f'"{after}" was not handled by the board']
+    errors = []
+    periods, widths = sim.pulse_timing(pin, t0_us / 1000)
+    rises = [t for t in sim.rises(pin) if t >= t0_us]
+    if count is not None and len(rises) != count:
+        errors.append(f'pin {pin}: {len(rises)} pulses instead of {count}')
+    if width is not None and widths.size and np.max(np.abs(widths * 1000 - width)) > tolerance:
+        errors.append(f'pin {pin}: widths {np.round(widths * 1000, 2).tolist()} ms instead of {width} ms')
+    if period is not None and periods.size and np.max(np.abs(periods * 1000 - period)) > tolerance:
+        errors.append(f'pin {pin}: periods {np.round(periods * 1000, 2).tolist()} ms instead of {period} ms')
+    if delay is not None and rises and abs((rises[0] - t0_us) / 1000 - delay) > tolerance:
+        errors.append(f'pin {pin}: first pulse after {(rises[0] - t0_us) / 1000:.2f} ms instead of {delay} ms')
+    return errors
+
+
+def run_case(commands, checks, baudrate=9600, tail_ms=2000):
+    '''
+    Play one regression case on a new simulator
+
+    Returns:
+        tuple: (simulator, list of mismatches)
+    '''
+    sim = FirmwareSimulator(baudrate=baudrate)
+    for at_ms, command in commands:
+        sim.send(command, at_ms)
+    sim.run_idle()
+    sim.run(tail_ms + max(at_ms for at_ms, _ in commands))
+    errors = []
+    for check in checks:
+        errors += check_pulses(sim, **check)
+    # pulses of several checks must start in the order of the checks
+    firsts = [sim.rises(check['pin'])[0] for check in checks if sim.rises(check['pin'])]
+    if firsts != sorted(firsts):
+        errors.append('pulses started out of order')
+    return sim, errors
+
+
+def run_regression(cases=None, baudrate=9600, print_flag=True):
+    '''
+    Play the regression cases and check the pulse timing of each
+
+    Returns:
+        dict: {case name: list of mismatches}
+    '''
+    cases = REGRESSION_CASES if cases is None else cases
+    results = {}
+    for name, (commands, checks) in cases.items():
+        results[name] = run_case(commands, checks, baudrate=baudrate)[1]
+        if print_flag:
+            status = '\033[32mPASSED\033[0m' if not results[name] else '\033[31mFAILED\033[0m'
+            print(f'{name:<16}{status}')
+            for error in results[name]:
+                print(f'    {error}')
+    return results
+
+
+def flood(count, baudrate=9600, rate=None, commands=None):
+    '''
+    Send count commands at a fixed rate (commands/s, None for back to back) and run the loop until it has read them
+
+    Returns:
+        tuple: (simulator, board time in ms)
+    '''
+    commands = STRESS_COMMANDS if commands is None else commands
+    sim = FirmwareSimulator(baudrate=baudrate)
+    for k in range(count):
+        sim.send(commands[k % len(commands)][0], k * 1000 / rate if rate else 0)
+    return sim, sim.run_idle()
+
+
+def max_command_rate(baudrate=9600, count=200, commands=None, resolution=0.01):
+    '''highest rate (commands/s) at which count commands are absorbed by the loop without dropping a byte'''
+    sim, t_end = flood(count, baudrate, None, commands)
+    if not sim.dropped_bytes:
+        return count / (t_end / 1000)
+    low, high = 0, count / (t_end / 1000) * 10
+    while high - low > resolution * high:
+        rate = (low + high) / 2
+        if flood(count, baudrate, rate, commands)[0].dropped_bytes:
+            high = rate
+        else:
+            low = rate
+    return low
+
+
+def benchmark(count=500, baudrate=9600, commands=None, print_flag=True):
+    '''
+    Send commands back to back and measure how many the loop handles, then search the highest rate it absorbs
+    without losing bytes; the feedback of the commands blocks loop() once the transmit buffer is full
+
+    Parameters:
+        count (int): number of commands sent
+        baudrate (int): baud rate of the serial line
+        commands (list): (command, number of feedback lines) cycled through, see serial_benchmark.STRESS_COMMANDS
+
+    Returns:
+        dict: commands sent and handled back to back, dropped bytes, board time (s), handled commands per second,
+            highest lossless rate (commands/s) and the simulation speed (board seconds per wall-clock second)
+    '''
+    commands = STRESS_COMMANDS if commands is None else commands
+    t_wall = time.perf_counter()
+    sim, t_end = flood(count, baudrate, None, commands)
+    t_wall = time.perf_counter() - t_wall
+    handled = sum(1 for _, command in sim.received if command in [c for c, _ in commands])
+    results = {'sent': count, 'handled': handled, 'dropped_bytes': sim.dropped_bytes, 'board_time': t_end / 1000,
+               'rate': handled / (t_end / 1000) if t_end else 0, 'lossless_rate': max_command_rate(baudrate, commands=commands),
+               'speed': t_end / 1000 / t_wall if t_wall else 0}
+    if print_flag:
+        print(f'{baudrate} baud: {handled}/{count} commands sent back to back handled in {t_end:.1f} ms of board time '
+              f'({results["rate"]:.0f} commands/s, {sim.dropped_bytes} bytes dropped), '
+              f'up to {results["lossless_rate"]:.0f} commands/s without loss; simulated {results["speed"]:.1f}x faster than real time')
+    return results
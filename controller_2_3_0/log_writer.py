@@ -0,0 +1,370 @@
+'''
+Background writer of the log files
+
+The helpers of stimfunc.py and the controller write a few lines to the log file for each event, often right after the
+feedback of the board, in the timing-critical part of a command. A LogWriter owns the open file: "with open_log(path)
+as log: log.write(...)" only queues the lines of the block, and a background thread writes the queue in batches and
+fsyncs the file every fsync_interval seconds and when the writer is closed. Without a running writer, open_log() falls
+back to appending to the file directly, so the helpers work the same in scripts that do not start one.
+
+Every event is also recorded by log_event() as one row of a CSV file next to the log ("<date>_<name>_events.csv"),
+with the fields EVENT_FIELDS, so a session is loaded by a single read (pandas.read_csv(), readtable() of MATLAB)
+instead of scanning the wording of the text lines:
+    type: kind of event, e.g. 'LED', 'pump', 'valve', 'video', 'command', 'board' (output change timed by the board)
+    t_ns: time.perf_counter_ns() of the event (see event_time.py), immune to the adjustments of the wall clock
+    wall: wall time of the event, 'YYYY-MM-DD HH:MM:SS.ffffff'
+    stimulus: stimulus of the controller when the event happened
+    target: hardware output or object of the event, e.g. 'LED ch1', 'air', 'pin 9'
+    value: new state or value, e.g. 'on', 'off', 200, the command line of a 'command' event
+    command: index of the command of the session that caused the event, 0 before the first one
+The same events are appended to the columnar event store of the session (event_store.py), queried by type and time
+range without reading the whole file, e.g. event_log(log_path).last('LED', value='on') in the controller, and to the
+HDF5 session container of the log file if one was started (session_file.py).
+
+A writer started with a segment_size or a segment_interval rotates its file in segments: when the file exceeds
+segment_size bytes or was opened segment_interval seconds ago, it is renamed "<stem>.<n><ext>" (e.g.
+"<date>_<name>_log.0001.txt"), compressed to "<stem>.<n><ext>.gz" by a background thread and listed in the manifest
+"<stem>.manifest.json", and the writer goes on in a new file of the same path. read_lines() reads the segments of
+the manifest and the current file in order as one stream.
+
+Usage:
+    writer = log_writer.start(log_path)
+    with log_writer.open_log(log_path) as log:
+        log.write('Light ON at ...\\n')
+    log_writer.stop(log_path) # writes the rest of the queue and fsyncs the file
+'''
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import atexit
+import shutil
+import threading
+from datetime import datetime
+from collections import deque
+from event_time import EventTime, TIME_FORMAT
+from event_store import EventStore, store_path
+
+writers = {} # {log path: LogWriter}
+event_writers = {} # {log path: EventWriter}
+session_writers = {} # {log path: SessionWriter of session_file.py}, the events are also written to its container
+EVENT_FIELDS = ['type', 't_ns', 'wall', 'stimulus', 'target', 'value', 'command']
+
+
+class LogWriter:
+    '''
+    Append-only writer of a log file, fed by write() from any thread
+
+    Parameters:
+        path (str): path of the log file
+        flush_interval (float): time (s) between two batch writes of the queue
+        fsync_interval (float): time (s) between two fsyncs of the file, 0 to fsync after every batch
+        segment_size (int): size (bytes) of the file that closes its segment, 0 for no limit
+        segment_interval (float): time (s) after which the file closes its segment, 0 for no limit
+    '''
+    def __init__(self, path, flush_interval=0.2, fsync_interval=5, segment_size=0, segment_interval=0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.segment_size = segment_size
+        self.segment_interval = segment_interval
+        self._queue = deque() # appended by the callers, popped by the writer thread only
+        self._file = None # opened by the first write, no empty file is left by a writer that wrote nothing
+        self._file_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._t_fsync = time.time()
+        self._t_segment = time.time() # the segment of a file kept from a previous run starts now
+        self._compressing = [] # threads compressing the closed segments
+        self._thread = threading.Thread(target=self._run, name=f'log writer {os.path.basename(path)}', daemon=True)
+        self._thread.start()
+
+    def write(self, text):
+        '''queue the text (a row for EventWriter), the only work done in the thread of the caller'''
+        if self._closed: # e.g. a reconnect thread logging while the session ends
+            with open(self.path, 'a') as log:
+                log.write(self._format([text]))
+            return
+        self._queue.append(text)
+
+    def flush(self, sync=False):
+        '''write the queue now, e.g. before the file is read by another program; sync to fsync the file as well'''
+        with self._file_lock:
+            self._drain()
+            if sync:
+                self._sync()
+
+    def close(self):
+        '''stop the writer thread, then write the rest of the queue and fsync the file'''
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+        with self._file_lock:
+            self._drain()
+            self._sync()
+            self._close()
+        for thread in self._compressing:
+            thread.join()
+
+    def _drain(self):
+        batch = []
+        while self._queue:
+            batch.append(self._queue.popleft())
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+            if self._file.tell() == 0:
+                self._header()
+        self._file.write(self._format(batch))
+        self._file.flush()
+        if (self.segment_size and self._file.tell() >= self.segment_size) or \
+           (self.segment_interval and time.time() - self._t_segment >= self.segment_interval):
+            self._rotate()
+
+    def _rotate(self):
+        '''close the segment of the file, compress it in the background, and go on in a new file'''
+        self._sync()
+        self._close()
+        t_opened, self._t_segment = self._t_segment, time.time()
+        segment = add_segment(self.path, t_opened, self._t_segment)
+        thread = threading.Thread(target=compress_segment, args=(self.path, segment),
+                                  name=f'log compressor {os.path.basename(segment)}', daemon=True)
+        thread.start()
+        self._compressing = [t for t in self._compressing if t.is_alive()] + [thread]
+
+    def _header(self):
+        '''first lines of a new file'''
+        pass
+
+    def _format(self, batch):
+        return ''.join(batch)
+
+    def _sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+        self._t_fsync = time.time()
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            with self._file_lock:
+                if self._closed:
+                    break
+                self._drain()
+                if time.time() - self._t_fsync >= self.fsync_interval:
+                    self._sync()
+
+
+class EventWriter(LogWriter):
+    '''
+    Writer of the CSV event file of a log file, fed by log_event() with (type, EventTime, stimulus, target, value,
+    command) tuples; the rows are formatted by the writer thread, the callers only queue the tuple. The tuples are also
+    appended to the event store, if one is given.
+    '''
+    def __init__(self, path, flush_interval=0.2, fsync_interval=5, store=None):
+        self.store = store
+        super().__init__(path, flush_interval, fsync_interval)
+        self.context = {'stimulus': '', 'command': 0} # kept up to date by the controller with set_context()
+
+    def _header(self):
+        self._file.write(','.join(EVENT_FIELDS) + '\n')
+
+    def _format(self, batch):
+        text = io.StringIO()
+        rows = csv.writer(text, lineterminator='\n')
+        for event_type, t_event, stimulus, target, value, command in batch:
+            rows.writerow((event_type, t_event.ns, t_event.strftime(TIME_FORMAT), stimulus, target, value, command))
+        return text.getvalue()
+
+    def _write(self, batch):
+        super()._write(batch)
+        if self.store is not None:
+            self.store.append(batch)
+
+    def _sync(self):
+        super()._sync()
+        if self.store is not None:
+            self.store.flush()
+
+    def _close(self):
+        super()._close()
+        if self.store is not None:
+            self.store.close()
+
+
+class LogEntry:
+    '''the lines written in one "with open_log(path) as log:" block, queued as one piece at the end of the block'''
+    def __init__(self, writer):
+        self.writer = writer
+        self.parts = []
+
+    def write(self, text):
+        self.parts.append(text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.parts:
+            self.writer.write(''.join(self.parts))
+
+
+def open_log(path):
+    '''
+    Open the log file for appending a block of lines
+
+    Returns:
+        LogEntry queued to the running writer of the file, or the file opened in append mode if no writer runs
+    '''
+    writer = writers.get(path)
+    if writer is None:
+        return open(path, 'a')
+    return LogEntry(writer)
+
+def manifest_path(path):
+    '''path of the manifest of the segments of a log file, "<stem>.manifest.json"'''
+    return os.path.splitext(path)[0] + '.manifest.json'
+
+def read_manifest(path):
+    '''segments of a log file, oldest first: [{'file': name, 'opened': time, 'closed': time, 'size': bytes}]'''
+    if not os.path.exists(manifest_path(path)):
+        return []
+    with open(manifest_path(path)) as manifest:
+        return json.load(manifest)['segments']
+
+def write_manifest(path, segments):
+    temp = manifest_path(path) + '.tmp'
+    with open(temp, 'w') as manifest:
+        json.dump({'file': os.path.basename(path), 'segments': segments}, manifest, indent=1)
+    os.replace(temp, manifest_path(path)) # a reader never sees a partial manifest
+
+manifest_lock = threading.Lock() # the writer threads add the segments, the compressor threads rename them
+
+def add_segment(path, t_opened, t_closed):
+    '''rename the closed file to the next segment "<stem>.<n><ext>" and list it in the manifest, return its path'''
+    with manifest_lock:
+        segments = read_manifest(path)
+        stem, ext = os.path.splitext(path)
+        segment = f'{stem}.{len(segments) + 1:04d}{ext}'
+        os.replace(path, segment)
+        segments.append({'file': os.path.basename(segment), 'size': os.path.getsize(segment),
+                         'opened': datetime.fromtimestamp(t_opened).strftime(TIME_FORMAT)[:-3],
+                         'closed': datetime.fromtimestamp(t_closed).strftime(TIME_FORMAT)[:-3]})
+        write_manifest(path, segments)
+    return segment
+
+def compress_segment(path, segment):
+    '''gzip a closed segment of a log file and point its entry of the manifest to the compressed file'''
+    with open(segment, 'rb') as source, gzip.open(segment + '.gz', 'wb', compresslevel=6) as target:
+        shutil.copyfileobj(source, target)
+    with manifest_lock:
+        segments = read_manifest(path)
+        for entry in segments:
+            if entry['file'] == os.path.basename(segment):
+                entry['file'] += '.gz'
+        write_manifest(path, segments)
+        os.remove(segment)
+
+def read_lines(path):
+    '''the lines of a log file and of all its closed segments, oldest first, as one stream'''
+    folder = os.path.dirname(path)
+    for entry in read_manifest(path):
+        segment = os.path.join(folder, entry['file'])
+        if not os.path.exists(segment): # compressed since the manifest was read
+            segment += '.gz'
+        with (gzip.open(segment, 'rt') if segment.endswith('.gz') else open(segment)) as lines:
+            yield from lines
+    if os.path.exists(path):
+        with open(path) as lines:
+            yield from lines
+
+def events_path(path):
+    '''path of the CSV event file of a log file, "<date>_<name>_events.csv" next to "<date>_<name>_log.txt"'''
+    return (path[:-len('_log.txt')] if path.endswith('_log.txt') else os.path.splitext(path)[0]) + '_events.csv'
+
+def start(path, flush_interval=0.2, fsync_interval=5, events=True, store=True, segment_size=0, segment_interval=0):
+    '''
+    Start the writer of a log file, or return the one already running
+
+    Parameters:
+        events (bool): record the events in the CSV event file of the log file as well
+        store (bool): and in its event store
+        segment_size, segment_interval: rotation of the log file in compressed segments, see LogWriter
+    '''
+    if path not in writers:
+        writers[path] = LogWriter(path, flush_interval, fsync_interval, segment_size, segment_interval)
+    if events and path not in event_writers:
+        event_writers[path] = EventWriter(events_path(path), flush_interval, fsync_interval,
+                                          EventStore(store_path(path), writable=True) if store else None)
+    return writers[path]
+
+def stop(path):
+    '''close the writers of a log file, the next blocks are appended to the file directly and events are not recorded'''
+    for registry in (writers, event_writers, session_writers):
+        writer = registry.pop(path, None)
+        if writer is not None:
+            writer.close()
+
+def flush(path):
+    '''write the queued lines and events of a log file now, e.g. before its records are read'''
+    for registry in (writers, event_writers, session_writers):
+        writer = registry.get(path)
+        if writer is not None:
+            writer.flush()
+
+def event_log(path):
+    '''event store of a running log writer, with the queued events appended, None if the events are not stored'''
+    writer = event_writers.get(path)
+    if writer is None or writer.store is None:
+        return None
+    writer.flush()
+    return writer.store
+
+def set_context(path, **context):
+    '''update the stimulus and the command index recorded with the next events of a log file'''
+    writer = event_writers.get(path)
+    if writer is not None:
+        writer.context.update(context)
+
+def log_event(path, event_type, target='', value='', t_event=None):
+    '''
+    Record an event in the CSV event file of a log file, nothing is done if the file has no running event writer
+    
+    Parameters:
+        path (str): path of the log file
+        event_type (str): kind of event, see EVENT_FIELDS
+        target (str): hardware output or object of the event
+        value: new state or value
+        t_event (EventTime, datetime or str): time of the event, None for now; a wall time, e.g. the
+            '%Y-%m-%d %H:%M:%S.%f' string of a line of the text log, is converted through the session anchor
+    '''
+    writer = event_writers.get(path)
+    if writer is None:
+        return
+    if t_event is None:
+        t_event = EventTime.now()
+    elif not isinstance(t_event, EventTime):
+        t_event = EventTime.from_datetime(datetime.fromisoformat(t_event) if isinstance(t_event, str) else t_event)
+    event = (event_type, t_event, writer.context['stimulus'], target, value, writer.context['command'])
+    writer.write(event)
+    session = session_writers.get(path)
+    if session is not None:
+        session.write(('events', event))
+
+@atexit.register
+def stop_all():
+    '''the queued lines are written even when the session ends without terminate()'''
+    for path in set(writers) | set(event_writers) | set(session_writers):
+        stop(path)
@@ -7,7 +7,7 @@ player = StimController(
     LED_retention = 2000, # ms
     video_retention = 1000, # ms,
     shut_backgroud = True,
-    board_type = 'Arduino',
+    board_type = 'Arduino', # 'Emulator' to run without a board
     
     pulse_span = 10, # seconds
     pulse_frequency = 1, # Hz
@@ -0,0 +1,198 @@
+'''
+Deterministic replay of a recorded session
+
+The autosaved protocol only keeps the commands and their rounded ISIs. The structured record of a session (the CSV
+event file, the event store or the HDF5 session container, see log_writer.py) has the time.perf_counter_ns() of each
+command, so a Replay issues the same commands at the same times relative to the first one, against:
+    a StimController connected to a board (board_type 'Arduino ...'), or to the emulator (board_type 'Emulator')
+    no controller, a dry run that only keeps the schedule (measures the timing of the replay loop itself)
+and reports per command how late it was issued (deviation) and how long it ran, so a timing regression is bisected on
+the recorded workload of a real session.
+
+The 'isi' commands are not issued: their wait is the gap of the schedule before the next command. The commands that
+prompt for input or only print (SKIPPED, SKIPPED_PREFIXES) are not issued either; the "stim" commands set the stimulus
+recorded by their 'stimulus' event. The commands run with the settings of the controller replaying them, not those of
+the recording.
+
+Usage:
+    commands = replay.read_commands('Jail/20240501/20240501_fly1_events.csv') # the last session of the file
+    rows = replay.Replay(commands, controller).run() # controller None for a dry run
+    replay.print_report(rows)
+    replay.write_report(path, rows)
+    or the "replay:<record>" command of the controller
+'''
+import os
+import csv
+import time
+import numpy as np
+import log_writer
+import serial_benchmark
+import status_renderer
+from event_store import EventStore
+
+SKIPPED = ['q', 'load', 'h', 'shortcuts', 'boards', 'well', 'u', 'run'] # and the commands starting with SKIPPED_PREFIXES
+SKIPPED_PREFIXES = ('isi', 'help', 'bench', 'show:', 'last:', 'replay:')
+REPORT_FIELDS = ['command_index', 'command', 'scheduled_ms', 'issued_ms', 'deviation_ms', 'duration_ms', 'result']
+
+
+def read_events(path):
+    '''
+    {column: array} of the type, t_ns, stimulus, value and command of the events of a record
+
+    Parameters:
+        path (str): CSV event file ("<date>_<name>_events.csv"), event store ("<date>_<name>_store"), session container
+            ("<date>_<name>_session.h5") or the log file they belong to
+    '''
+    if path.endswith('_log.txt'):
+        path = log_writer.events_path(path)
+    columns = ['type', 't_ns', 'stimulus', 'value', 'command']
+    if os.path.isdir(path):
+        store = EventStore(path)
+        table = store.decode(store.query())
+        return {column: table[column] for column in columns}
+    if path.endswith('.h5'):
+        import h5py # optional, only needed for the session containers
+        with h5py.File(path, 'r', libver='latest', swmr=True) as session:
+            events = session['events'][:]
+        return {column: np.array([value.decode('utf-8') for value in events[column]], dtype=object)
+                if events.dtype[column].kind == 'O' else events[column] for column in columns}
+    with open(path, newline='', encoding='utf-8') as file:
+        rows = list(csv.DictReader(file))
+    table = {column: np.array([row[column] for row in rows], dtype=object) for column in columns}
+    table['t_ns'] = table['t_ns'].astype(np.int64)
+    table['command'] = table['command'].astype(np.int64)
+    return table
+
+def sessions(events):
+    '''row ranges (start, end) of the runs of the controller in a record, each run counts its commands from 1'''
+    command = np.asarray(events['command'], dtype=np.int64)
+    starts = np.flatnonzero(np.diff(command) < 0) + 1
+    bounds = np.concatenate([[0], starts, [len(command)]])
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def read_commands(path, session=-1):
+    '''
+    Commands of one session of a record
+
+    Parameters:
+        path (str): record of the session, see read_events()
+        session (int): run of the controller in the record, the last one by default (a record of a day may hold several)
+
+    Returns:
+        list of dicts {'index', 't_ns', 'command', 'stimulus'}, in the order they were run; 'stimulus' is the one set
+        by the command ('stimulus' event), None if it set none
+    '''
+    events = read_events(path)
+    runs = sessions(events)
+    if not runs:
+        return []
+    start, end = runs[session]
+    commands, stimuli, replaying = [], {}, False
+    for i in range(start, end):
+        if events['type'][i] == 'replay': # the commands of a replay run in the session are not part of its record
+            replaying = events['value'][i] == 'start'
+        elif replaying:
+            continue
+        elif events['type'][i] == 'command':
+            commands.append({'index': int(events['command'][i]), 't_ns': int(events['t_ns'][i]),
+                             'command': str(events['value'][i]), 'stimulus': None})
+        elif events['type'][i] == 'stimulus':
+            stimuli[int(events['command'][i])] = str(events['value'][i])
+    for command in commands:
+        command['stimulus'] = stimuli.get(command['index'])
+    return commands
+
+def skipped(command):
+    '''whether a recorded command is not issued by a replay'''
+    return command in SKIPPED or command.lower().startswith(SKIPPED_PREFIXES)
+
+
+class Replay:
+    '''
+    Replay of recorded commands on their recorded schedule
+
+    Parameters:
+        commands (list): commands of read_commands()
+        controller (StimController): controller issuing the commands, None for a dry run
+        speed (float): factor of the replay speed, 2 replays the schedule twice as fast
+    '''
+    def __init__(self, commands, controller=None, speed=1):
+        self.commands = [command for command in commands if not skipped(command['command'])]
+        self.controller = controller
+        self.speed = speed
+
+    def issue(self, command):
+        '''run one command on the controller, its return value'''
+        controller = self.controller
+        if controller is None:
+            return 0
+        if command['stimulus'] is not None and command['command'] in ('stim', controller.stim_name):
+            controller.record_command(command['command'])
+            return controller.reset_stimulus(command['stimulus'])
+        return controller.process_command(command['command'])
+
+    def wait_until(self, t_ns):
+        '''sleep until 2 ms before t_ns (perf_counter_ns), then spin, like the frame loop of play_video()'''
+        while t_ns - time.perf_counter_ns() > 2_000_000:
+            time.sleep(0.001)
+        while time.perf_counter_ns() < t_ns:
+            pass
+
+    def run(self):
+        '''
+        Issue the commands on their schedule, a late command is issued at once and the next ones keep their schedule
+
+        Returns:
+            list of dicts of REPORT_FIELDS, the times in ms from the start of the replay
+        '''
+        rows = []
+        if not self.commands:
+            return rows
+        controller = self.controller
+        if controller is not None: # the prompts of "p" and "t" would stop the schedule
+            update_pulse, update_timer = controller.update_pulse, controller.update_timer
+            controller.update_pulse = controller.update_timer = False
+            log_writer.log_event(controller.log_file, 'replay', '', 'start')
+        else: # the commands print their own lines otherwise
+            status_renderer.show(lambda: f'Replayed {len(rows)}/{len(self.commands)} commands'
+                                         + (f", {rows[-1]['command']} {rows[-1]['deviation_ms']:+.2f} ms" if rows else ''))
+        t_recorded = self.commands[0]['t_ns']
+        t_start = time.perf_counter_ns()
+        try:
+            for command in self.commands:
+                t_scheduled = t_start + round((command['t_ns'] - t_recorded) / self.speed)
+                self.wait_until(t_scheduled)
+                t_issued = time.perf_counter_ns()
+                result = self.issue(command)
+                t_done = time.perf_counter_ns()
+                rows.append({'command_index': command['index'], 'command': command['command'],
+                             'scheduled_ms': (t_scheduled - t_start) / 1e6, 'issued_ms': (t_issued - t_start) / 1e6,
+                             'deviation_ms': (t_issued - t_scheduled) / 1e6, 'duration_ms': (t_done - t_issued) / 1e6,
+                             'result': result})
+                if result == -1:
+                    break
+        finally:
+            status_renderer.clear()
+            if controller is not None:
+                controller.update_pulse, controller.update_timer = update_pulse, update_timer
+                log_writer.log_event(controller.log_file, 'replay', '', 'end')
+        return rows
+
+
+def print_report(rows):
+    '''p50/p95/max of the deviations and durations of a replay, and its latest commands'''
+    if not rows:
+        print('No command replayed')
+        return
+    for name in ('deviation_ms', 'duration_ms'):
+        stats = serial_benchmark.summarize_latency([row[name] for row in rows])
+        print(f'{name[:-3]:<10} p50 {stats["p50"]:.2f} ms, p95 {stats["p95"]:.2f} ms, max {stats["max"]:.2f} ms ({stats["n"]} commands)')
+    late = sorted(rows, key=lambda row: row['deviation_ms'])[-5:][::-1]
+    print('latest commands: ' + ', '.join(f"{row['command']} (#{row['command_index']}) {row['deviation_ms']:+.2f} ms" for row in late))
+
+def write_report(path, rows):
+    '''write the rows of a replay to a CSV file'''
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        report = csv.DictWriter(file, fieldnames=REPORT_FIELDS)
+        report.writeheader()
+        report.writerows(rows)
@@ -0,0 +1,276 @@
+'''
+Round-trip latency benchmark of the serial commands of the Arduino firmware
+
+The benchmark sends every command type repeatedly, measures the time from writing the command to receiving its
+acknowledgement and summarizes the distribution (p50/p95/max). The results are saved per board in a JSON file,
+loaded by StimController at startup and used to estimate the duration of command series.
+'''
+import os
+import sys
+import json
+import time
+import numpy as np
+import status_renderer
+from datetime import datetime
+
+# command type: (setup commands, [(command, expected feedback prefix), ...], teardown commands)
+# setup/teardown commands are sent with their feedback discarded; valves can only be opened while the pump is on
+BENCHMARK_COMMANDS = {
+    'led':        ([], [('on', 'Light ON'), ('off', 'Light OFF')], []),
+    'pump':       ([], [('pump:on', 'Pump ON'), ('pump:off', 'Pump OFF')], []),
+    'pump_value': ([], [('pump:value:200', 'Pump value set to')], []),
+    'valve':      (['pump:on'], [('air:on', 'Air valve OPEN'), ('air:off', 'Air valve CLOSED'),
+                                 ('odor_a:on', 'Odor A valve OPEN'), ('odor_a:off', 'Odor A valve CLOSED'),
+                                 ('odor_b:on', 'Odor B valve OPEN'), ('odor_b:off', 'Odor B valve CLOSED')], ['pump:off']),
+    'shock':      ([], [('shock:on', 'Shock pulses ON'), ('shock:off', 'Shock pulses OFF')], []),
+    'trigger':    ([], [('trigger', 'Trigger OFF')], []), # send_trigger() returns after "Trigger OFF"
+    'pulse':      ([], [('pulse:f1000w10', 'Continuous Pulse ON'), ('pulse:off', 'Continuous Pulse OFF')], []),
+    'quit':       ([], [('quit', 'All operations terminated')], []),
+    'status':     ([], [('status', 'Status ')], []),
+}
+
+
+def drain(ser, settle=0.05):
+    '''read and discard everything the board sends until it has been silent for "settle" seconds'''
+    t_last = time.perf_counter()
+    while time.perf_counter() - t_last < settle:
+        if ser.inWaiting() > 0:
+            ser.readline()
+            t_last = time.perf_counter()
+    return 0
+
+
+def measure_round_trip(ser, command, expected, timeout=5):
+    '''
+    Measure the time between writing a command and receiving the expected feedback
+
+    Parameters:
+        ser: Serial port object
+        command (str): command without the trailing "\\n"
+        expected (str): prefix of the feedback line that acknowledges the command
+        timeout (float): timeout in seconds
+
+    Returns:
+        float: round-trip latency in seconds
+    '''
+    t_write = time.perf_counter()
+    ser.write((command + '\n').encode('utf-8'))
+    while True:
+        if time.perf_counter() - t_write > timeout:
+            raise TimeoutError(f'Arduino timeout while benchmarking "{command}"')
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if fb.startswith(expected):
+                return time.perf_counter() - t_write
+
+
+def summarize_latency(samples):
+    '''p50/p95/max/mean of latency samples (s)'''
+    samples = np.asarray(samples, dtype=float)
+    return {
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'max': float(np.max(samples)),
+        'mean': float(np.mean(samples)),
+        'n': int(samples.size),
+    }
+
+
+def benchmark_latency(ser, repeats=20, command_types=None, print_flag=True):
+    '''
+    Measure the round-trip latency distribution of every command type
+
+    Parameters:
+        ser: Serial port object, a real board or the emulator
+        repeats (int): number of round trips per command
+        command_types (list): command types to benchmark, defaults to all types in BENCHMARK_COMMANDS
+        print_flag (bool): whether to print the results
+
+    Returns:
+        dict: {command type: {'p50', 'p95', 'max', 'mean', 'n'}} with latencies in seconds
+    '''
+    if command_types is None:
+        command_types = list(BENCHMARK_COMMANDS.keys())
+    results = {}
+    drain(ser)
+    try:
+        for i, cmd_type in enumerate(command_types):
+            setup, commands, teardown = BENCHMARK_COMMANDS[cmd_type]
+            for cmd in setup:
+                ser.write((cmd + '\n').encode('utf-8'))
+            drain(ser)
+            samples = []
+            if print_flag: # rendered by the status thread, the round trips do not print
+                status_renderer.show(lambda: f'Benchmarking {cmd_type} ({i+1}/{len(command_types)}): '
+                                             f'{len(samples) // len(commands)}/{repeats}')
+            for _ in range(repeats):
+                for cmd, expected in commands:
+                    samples.append(measure_round_trip(ser, cmd, expected))
+            for cmd in teardown:
+                ser.write((cmd + '\n').encode('utf-8'))
+            drain(ser)
+            results[cmd_type] = summarize_latency(samples)
+        if print_flag:
+            status_renderer.clear(f'Benchmarked {len(command_types)} command types, {repeats} round trips each')
+    finally:
+        status_renderer.clear()
+    if print_flag:
+        print()
+        print_latency_model(results)
+    return results
+
+
+def print_latency_model(model):
+    print(f'{"command":<12}{"p50 (ms)":>10}{"p95 (ms)":>10}{"max (ms)":>10}{"n":>6}')
+    for cmd_type, stats in model.items():
+        print(f'{cmd_type:<12}{stats["p50"]*1000:>10.2f}{stats["p95"]*1000:>10.2f}{stats["max"]*1000:>10.2f}{stats["n"]:>6d}')
+
+
+def save_latency_model(path, board_id, model, baud_rate=None):
+    '''save the latency model of a board into the JSON file at path, keeping the models of other boards'''
+    models = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            models = json.load(f)
+    models[board_id] = {
+        'measured_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'baud_rate': baud_rate,
+        'commands': model,
+    }
+    with open(path, 'w') as f:
+        json.dump(models, f, indent=4)
+    return 0
+
+
+def load_latency_model(path, board_id):
+    '''
+    Load the latency model of a board
+
+    Returns:
+        dict: {command type: stats}, empty if the board has not been benchmarked
+    '''
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            models = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'\033[33mWarning: cannot read latency model from {path}: {e}\033[0m')
+        return {}
+    return models.get(board_id, {}).get('commands', {})
+
+
+# commands flooded by stress_test(): (command, number of feedback lines); none of them touches the LED
+STRESS_COMMANDS = [('status', 1), ('pump:value:200', 1), ('pin:7:0', 0), ('bogus', 1)]
+
+
+def pulse_timing(transitions, pin, t_start=0):
+    '''
+    Periods and widths of the pulses on a pin from the (micros, pin, value) transitions recorded by the emulator
+
+    Returns:
+        tuple: (periods, widths) in seconds, as numpy arrays
+    '''
+    rises = [t for t, p, v in transitions if p == pin and v and t >= t_start]
+    falls = [t for t, p, v in transitions if p == pin and not v and t >= t_start]
+    widths = [min(f for f in falls if f > r) - r for r in rises if any(f > r for f in falls)]
+    return np.diff(rises) / 1e6, np.asarray(widths, dtype=float) / 1e6
+
+
+def stress_test(ser, duration=5, frequency=10, pulse_width=20, command_rate=40, split_every=4, split_delay=0.02,
+                tolerance=0.002, print_flag=True):
+    '''
+    Flood the board with commands while it runs a continuous LED pulse train, and check that the pulse timing holds
+
+    Every split_every-th command is sent in two halves split_delay apart, the partial line that used to stall loop()
+    in Serial.readStringUntil(). The pulse timing can only be observed on the emulator (from its recorded pin
+    transitions); on a real board only the feedback is checked, probe pin 5 with a logic analyzer for the timing.
+
+    Parameters:
+        ser: Serial port object, a real board or the emulator
+        duration (float): flooding time in seconds
+        frequency (float): frequency (Hz) of the continuous pulse
+        pulse_width (int): pulse width (ms) of the continuous pulse
+        command_rate (float): commands per second, keep the bytes per second below baud rate / 10
+        split_every (int): every n-th command is split into two writes, 0 to never split
+        split_delay (float): time (s) between the two halves of a split command
+        tolerance (float): largest accepted deviation (s) of the pulse period and width
+        print_flag (bool): whether to print the results
+
+    Returns:
+        dict: {'commands', 'feedback_expected', 'feedback_received', 'pulses', 'period_error', 'width_error', 'passed'},
+            period/width errors are the largest deviations in seconds, None (as passed) when the timing is not observable
+    '''
+    firmware = getattr(ser, 'firmware', None)
+    recording = firmware.record_transitions if firmware is not None else False
+    switch_interval = sys.getswitchinterval()
+    drain(ser)
+    try: # the emulator is restored also when the board stops answering
+        if firmware is not None:
+            firmware.record_transitions = True
+            t_record = firmware.micros()
+            sys.setswitchinterval(0.0005) # the board thread of the emulator must not wait 5 ms for the GIL
+        measure_round_trip(ser, f'pulse:f{int(frequency*1000)}w{pulse_width}', 'Continuous Pulse ON')
+
+        sent = expected = received = 0
+        t_start = time.perf_counter()
+        t_next = t_start
+        if print_flag: # rendered by the status thread, the flooding loop does not print
+            status_renderer.show(lambda: f'Flooding: {sent} commands, {received}/{expected} feedback lines')
+        try:
+            while time.perf_counter() - t_start < duration:
+                while ser.inWaiting() > 0:
+                    ser.readline()
+                    received += 1
+                if time.perf_counter() < t_next:
+                    time.sleep(0.0005) # leave the CPU to the board thread of the emulator
+                    continue
+                command, n_feedback = STRESS_COMMANDS[sent % len(STRESS_COMMANDS)]
+                data = (command + '\n').encode('utf-8')
+                if split_every and sent % split_every == split_every - 1:
+                    ser.write(data[:len(data)//2])
+                    time.sleep(split_delay)
+                    ser.write(data[len(data)//2:])
+                else:
+                    ser.write(data)
+                sent += 1
+                expected += n_feedback
+                t_next += 1 / command_rate
+            if print_flag:
+                status_renderer.clear(f'Flooding: {sent} commands, {received}/{expected} feedback lines')
+        finally:
+            status_renderer.clear()
+        t_end = time.perf_counter() + 1
+        while received < expected and time.perf_counter() < t_end: # feedback still on its way
+            if ser.inWaiting() > 0:
+                ser.readline()
+                received += 1
+        measure_round_trip(ser, 'pulse:off', 'Continuous Pulse OFF')
+    finally:
+        if firmware is not None:
+            firmware.record_transitions = recording
+        sys.setswitchinterval(switch_interval)
+
+    results = {'commands': sent, 'feedback_expected': expected, 'feedback_received': received,
+               'pulses': None, 'period_error': None, 'width_error': None, 'passed': None}
+    if firmware is not None:
+        from arduino_emulator import PIN_LED
+        periods, widths = pulse_timing(firmware.transitions, PIN_LED, t_record)
+        periods, widths = periods[1:-1], widths[1:-1] # the first and last pulses are cut by pulse:on/off
+        results['pulses'] = int(widths.size)
+        if periods.size and widths.size:
+            # the firmware counts whole milliseconds, the period is int(1000/frequency) ms
+            results['period_error'] = float(np.max(np.abs(periods - int(1000/frequency)/1000)))
+            results['width_error'] = float(np.max(np.abs(widths - pulse_width/1000)))
+            results['passed'] = results['period_error'] <= tolerance and results['width_error'] <= tolerance \
+                                and received == expected
+    if print_flag:
+        print()
+        print(f'Commands sent: {sent} ({command_rate} /s, 1 in {split_every} split), feedback lines: {received}/{expected}')
+        if results['passed'] is None:
+            print('Pulse timing is only observable on the emulator, please probe pin 5 with a logic analyzer.')
+        else:
+            print(f'Pulses: {results["pulses"]}, largest period error: {results["period_error"]*1000:.2f} ms, '
+                  f'largest width error: {results["width_error"]*1000:.2f} ms (tolerance {tolerance*1000:.1f} ms)')
+            print('\033[32mPASSED\033[0m' if results['passed'] else '\033[31mFAILED\033[0m')
+    return results
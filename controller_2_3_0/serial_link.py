@@ -0,0 +1,320 @@
+'''
+Serial link to the Arduino board: cached board identity, "READY" handshake and automatic reconnect
+
+The firmware prints "READY" at the end of setup(), so the host waits only as long as the board needs to reset
+after its port was opened instead of a fixed 2 s (older firmware without the banner falls back to the timeout).
+The identity of the used boards (VID, PID and USB serial number) is cached in a JSON file, so the same board is
+found again when it comes back on another port, and it is preferred when several boards match the description.
+ReconnectingSerial wraps the port: when the board disappears mid-session, it waits for the board to come back,
+reopens the port and lets the controller restore its outputs.
+Heartbeat feeds the watchdog of the firmware ("wd:<ms>") from a background thread while the host writes nothing, so the
+board switches its outputs off when the host process dies or the USB link drops.
+'''
+import os
+import json
+import time
+import threading
+import serial
+import serial.tools.list_ports
+import log_writer
+from event_time import EventTime
+
+READY_BANNER = 'READY'
+READY_TIMEOUT = 2 # s, the auto-reset delay of the Arduino Uno bootloader
+HEARTBEAT = b'hb\n' # feeds the watchdog of the firmware, which prints nothing back
+
+
+class SerialReconnected(serial.SerialException):
+    '''raised when a read was interrupted by a reconnect, the command waiting for feedback is lost'''
+
+
+def port_identity(port):
+    '''identity of a serial.tools.list_ports ListPortInfo that survives re-enumeration'''
+    return {
+        'vid': port.vid,
+        'pid': port.pid,
+        'serial_number': port.serial_number,
+        'device': port.device,
+        'description': port.description,
+    }
+
+
+def same_board(port, identity):
+    '''whether the port belongs to the board of the identity, by serial number if it has one'''
+    if (port.vid, port.pid) != (identity.get('vid'), identity.get('pid')):
+        return False
+    if identity.get('serial_number'):
+        return port.serial_number == identity['serial_number']
+    return port.device == identity.get('device') # clones without serial number are identified by their port
+
+
+def load_port_cache(path):
+    '''
+    Load the cached board identities
+
+    Returns:
+        dict: {board type: [identity, ...]}
+    '''
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f'\033[33mWarning: cannot read port cache from {path}: {e}\033[0m')
+        return {}
+
+
+def save_port_cache(path, board_type, ports):
+    '''cache the identities of the ports used for board_type, keeping the other board types'''
+    if not path:
+        return 0
+    cache = load_port_cache(path)
+    cache[board_type] = [port_identity(port) for port in ports]
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=4)
+    return 0
+
+
+def find_cached_ports(path, board_type, ports=None):
+    '''
+    Find the connected ports of the boards cached for board_type
+
+    Parameters:
+        path (str): path to the port cache
+        board_type (str): type of the boards
+        ports (list): ListPortInfo to search, defaults to all serial ports
+
+    Returns:
+        list: ListPortInfo of the cached boards that are connected
+    '''
+    identities = load_port_cache(path).get(board_type, [])
+    if not identities:
+        return []
+    if ports is None:
+        ports = serial.tools.list_ports.comports()
+    return [port for port in ports if any(same_board(port, identity) for identity in identities)]
+
+
+def locate_port(identity):
+    '''current device name of the board with the identity, None if it is not connected'''
+    for port in serial.tools.list_ports.comports():
+        if same_board(port, identity):
+            return port.device
+    return None
+
+
+def wait_for_ready(ser, timeout=READY_TIMEOUT):
+    '''
+    Wait for the "READY" banner the firmware prints when setup() is done
+
+    Parameters:
+        ser: Serial port object, opened just before (opening the port resets the board)
+        timeout (float): maximum waiting time in seconds, the fixed delay used for firmware without the banner
+
+    Returns:
+        float: time (s) the board took to get ready, None if no banner arrived before the timeout
+    '''
+    t_start = time.perf_counter()
+    received = b''
+    while time.perf_counter() - t_start < timeout:
+        if ser.inWaiting() > 0:
+            received += ser.read(ser.inWaiting())
+            complete_lines = received.split(b'\n')[:-1] # the banner is printed by Serial.println(), ending with "\r\n"
+            if any(line.strip() == READY_BANNER.encode() for line in complete_lines):
+                return time.perf_counter() - t_start
+        else:
+            time.sleep(0.001)
+    return None
+
+
+class ReconnectingSerial:
+    '''
+    Serial port that reconnects to its board when the port disappears
+
+    Every attribute not defined here is taken from the wrapped port. When a write fails, the board is reconnected and
+    the write is repeated; when a read fails, the board is reconnected and SerialReconnected is raised, as the
+    feedback the caller was waiting for is lost. Reconnect events are printed and written to log_path.
+
+    Parameters:
+        ser: opened serial.Serial (or ArduinoEmulator)
+        identity (dict): identity of the board from port_identity(), used to find it again
+        reopen (callable): function returning the reopened port, defaults to opening the port of the identity
+        reconnect_timeout (float): time (s) to wait for the board to come back before giving up
+        log_path (str): log file of the reconnect events
+        on_reconnect (callable): called without arguments once the board is ready again, to restore its state
+
+    trace, if set, is called with (True, data) for every write() and (False, line) for every readline(), e.g. to record
+    the lines exchanged with the board in the session container (session_file.py)
+    '''
+    def __init__(self, ser, identity=None, reopen=None, reconnect_timeout=10, log_path=None, on_reconnect=None):
+        self.ser = ser
+        self.identity = identity if identity else {}
+        self.reopen = reopen if reopen else self.reopen_port
+        self.reconnect_timeout = reconnect_timeout
+        self.log_path = log_path
+        self.on_reconnect = on_reconnect
+        self.serial_number = self.identity.get('serial_number') or getattr(ser, 'serial_number', None)
+        self.reconnect_count = 0
+        self.closed = False
+        self.write_lock = threading.Lock() # shared with the Heartbeat, so a heartbeat never splits a command
+        self.reconnecting = False # set during reconnect(), the Heartbeat leaves the port alone meanwhile
+        self.t_last_write = time.perf_counter()
+        self.trace = None
+
+    def __getattr__(self, name):
+        if 'ser' not in self.__dict__: # not initialized yet, e.g. while unpickling or copying
+            raise AttributeError(name)
+        return getattr(self.ser, name)
+
+    def reopen_port(self):
+        port = locate_port(self.identity)
+        if port is None:
+            raise serial.SerialException(f'Board {self.serial_number} is not connected')
+        return serial.Serial(port=port, baudrate=self.ser.baudrate, timeout=self.ser.timeout)
+
+    def log(self, message):
+        t_event = EventTime.now()
+        print(f'\n\033[33m{message} at {t_event}\033[0m')
+        if self.log_path:
+            with log_writer.open_log(self.log_path) as log:
+                log.write(f'{message} at {t_event}\n')
+                log.write('\n')
+
+    def reconnect(self, error):
+        '''reopen the port of the board, wait until it is ready and restore its state'''
+        if self.closed:
+            raise error
+        self.reconnecting = True
+        try:
+            return self._reconnect(error)
+        finally:
+            self.reconnecting = False
+
+    def _reconnect(self, error):
+        t_lost = time.perf_counter()
+        self.log(f'Serial connection to board {self.serial_number} lost ({error})')
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        while True:
+            try:
+                self.ser = self.reopen()
+                break
+            except (serial.SerialException, OSError):
+                if time.perf_counter() - t_lost > self.reconnect_timeout:
+                    self.log(f'Board {self.serial_number} did not come back within {self.reconnect_timeout} s')
+                    raise serial.SerialException(f'Board {self.serial_number} is disconnected') from error
+                time.sleep(0.1)
+        t_ready = wait_for_ready(self.ser)
+        self.reconnect_count += 1
+        self.log(f'Serial connection to board {self.serial_number} restored after {time.perf_counter()-t_lost:.2f} s'
+                 f'{"" if t_ready is not None else " (no READY banner)"}')
+        if self.on_reconnect:
+            self.on_reconnect()
+        return 0
+
+    # ---------------------------------------------------------------- serial.Serial API
+    def write(self, data):
+        with self.write_lock:
+            self.t_last_write = time.perf_counter()
+            if self.trace is not None:
+                self.trace(True, data)
+            try:
+                return self.ser.write(data)
+            except (serial.SerialException, OSError) as e:
+                error = e
+        self.reconnect(error) # without the lock: on_reconnect() writes to the port to restore the outputs
+        with self.write_lock:
+            self.t_last_write = time.perf_counter()
+            return self.ser.write(data)
+
+    def read(self, size=1):
+        try:
+            return self.ser.read(size)
+        except (serial.SerialException, OSError) as e:
+            self.reconnect(e)
+            raise SerialReconnected(f'Board {self.serial_number} was reconnected while reading') from e
+
+    def readline(self):
+        try:
+            line = self.ser.readline()
+        except (serial.SerialException, OSError) as e:
+            self.reconnect(e)
+            raise SerialReconnected(f'Board {self.serial_number} was reconnected while reading') from e
+        if self.trace is not None:
+            self.trace(False, line)
+        return line
+
+    @property
+    def in_waiting(self):
+        try:
+            return self.ser.in_waiting
+        except (serial.SerialException, OSError) as e:
+            self.reconnect(e)
+            raise SerialReconnected(f'Board {self.serial_number} was reconnected while reading') from e
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def close(self):
+        self.closed = True
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Heartbeat:
+    '''
+    Background thread writing "hb" to a board while the host sends it nothing else
+
+    Every line of the host feeds the watchdog of the firmware, so a heartbeat is only written when the port has been
+    idle for interval seconds, and it is skipped while a command is being written or the board is reconnected. Errors of
+    the port are left to the thread of the controller, which reconnects the board.
+
+    Parameters:
+        ser (ReconnectingSerial): port of the board
+        interval (float): idle time (s) after which a heartbeat is written, well below the watchdog window
+    '''
+    def __init__(self, ser, interval=0.5):
+        self.ser = ser
+        self.interval = interval
+        self.count = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f'Heartbeat-{self.ser.serial_number}', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        return 0
+
+    def _run(self):
+        while not self._stop.wait(max(self.ser.t_last_write + self.interval - time.perf_counter(), 0.01)):
+            if self.ser.closed or self.ser.reconnecting or time.perf_counter() - self.ser.t_last_write < self.interval:
+                continue
+            if not self.ser.write_lock.acquire(blocking=False): # a command is being written and feeds the watchdog
+                continue
+            try:
+                self.ser.ser.write(HEARTBEAT)
+                self.count += 1
+            except (serial.SerialException, OSError):
+                pass
+            finally:
+                self.ser.t_last_write = time.perf_counter()
+                self.ser.write_lock.release()
@@ -0,0 +1,133 @@
+'''
+Session container (HDF5)
+
+With session_container = True, the controller also writes the session into one HDF5 file next to the log
+("<date>_<name>_session.h5"), appended during the run by a background writer like the log file (log_writer.py). Its
+datasets are chunked, gzip-compressed and resizable, so analysis code opens the file lazily and reads slices of them,
+also while the session runs (SWMR mode of HDF5, h5py.File(path, 'r', libver='latest', swmr=True)):
+    events: the events of the CSV event file (t_ns, wall_ns, type, stimulus, target, value, command)
+    commands: the commands of the session (t_ns, index, command), in the order they were run
+    serial: every line sent to the board (sent = 1) and received from it (sent = 0) with its perf_counter_ns()
+        time, e.g. the feedback lines acknowledging the hardware commands
+    frames: the time each frame of each played video was shown (t_ns, video, frame, stimulus)
+and its attribute 'config' holds the settings of the controller (JSON).
+
+h5py is optional: without it start() prints a warning and the session is only written to the log files. A container
+left by a crashed session keeps its data, but is flagged as still open: "h5clear -s <file>" clears the flag.
+
+Usage:
+    with h5py.File(path, 'r') as session:
+        commands = session['commands'][:]
+        onsets = session['frames'][-1000:]['t_ns']
+        config = json.loads(session.attrs['config'])
+'''
+import os
+import json
+import time
+import atexit
+import numpy as np
+import log_writer
+try:
+    import h5py
+except ImportError: # optional, see start()
+    h5py = None
+
+CHUNK = 4096 # rows per chunk of the datasets
+
+
+def container_path(path):
+    '''path of the session container of a log file, "<date>_<name>_session.h5" next to "<date>_<name>_log.txt"'''
+    return (path[:-len('_log.txt')] if path.endswith('_log.txt') else os.path.splitext(path)[0]) + '_session.h5'
+
+def text(value):
+    return value.decode('utf-8', 'replace').rstrip('\r\n') if isinstance(value, bytes) else str(value)
+
+
+class SessionWriter(log_writer.LogWriter):
+    '''
+    Writer of the session container of a log file, fed with (dataset, row) pairs by log_event(), trace() and
+    log_frames(); the rows are converted and appended to the datasets by the writer thread
+    '''
+    def __init__(self, path, config, flush_interval=0.2, fsync_interval=5):
+        string = h5py.string_dtype()
+        self.dtypes = {
+            'events': np.dtype([('t_ns', '<i8'), ('wall_ns', '<i8'), ('type', string), ('stimulus', string),
+                                ('target', string), ('value', string), ('command', '<u4')]),
+            'commands': np.dtype([('t_ns', '<i8'), ('index', '<u4'), ('command', string)]),
+            'serial': np.dtype([('t_ns', '<i8'), ('sent', 'u1'), ('line', string)]),
+            'frames': np.dtype([('t_ns', '<i8'), ('video', '<u4'), ('frame', '<u4'), ('stimulus', string)]),
+        }
+        self._h5 = h5py.File(path, 'a', libver='latest') # a restarted session goes on in the same container
+        for name, dtype in self.dtypes.items():
+            if name not in self._h5:
+                self._h5.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(CHUNK,),
+                                        compression='gzip', compression_opts=1) # gzip is readable by MATLAB
+        self._h5.attrs['config'] = json.dumps(config, default=str)
+        self._h5.swmr_mode = True # readers may open the file while it is written, no dataset is created from now on
+        self.video_count = int(self._h5['frames']['video'].max()) + 1 if len(self._h5['frames']) else 0
+        super().__init__(path, flush_interval, fsync_interval)
+
+    def write(self, item):
+        if not self._closed: # a closed container is not reopened, unlike a text file
+            self._queue.append(item)
+
+    def trace(self, sent, data):
+        '''record a line sent to the board or received from it, called by serial_link.ReconnectingSerial'''
+        self.write(('serial', (time.perf_counter_ns(), sent, data)))
+
+    def _write(self, batch):
+        rows = {name: [] for name in self.dtypes}
+        for name, row in batch:
+            if name == 'events':
+                event_type, t_event, stimulus, target, value, command = row
+                rows['events'].append((t_event.ns, t_event.wall_ns, event_type, text(stimulus), text(target), text(value), command))
+                if event_type == 'command':
+                    rows['commands'].append((t_event.ns, command, text(value)))
+            elif name == 'serial':
+                rows['serial'].append((row[0], row[1], text(row[2])))
+            elif name == 'frames': # (EventTime of the first frame, intervals (ms) between the frames, stimulus)
+                t_play, interval, stimulus = row
+                t_frames = t_play.ns + np.round(np.concatenate([[0], np.cumsum(interval)]) * 1e6).astype(np.int64)
+                rows['frames'] += [(t_ns, self.video_count, frame, text(stimulus)) for frame, t_ns in enumerate(t_frames)]
+                self.video_count += 1
+        for name, new_rows in rows.items():
+            if new_rows:
+                dataset = self._h5[name]
+                dataset.resize((len(dataset) + len(new_rows),))
+                dataset[-len(new_rows):] = np.array(new_rows, dtype=self.dtypes[name])
+        self._h5.flush() # visible to the SWMR readers
+
+    def _sync(self):
+        self._h5.flush()
+        self._t_fsync = time.time()
+
+    def _close(self):
+        self._h5.close()
+
+
+def start(log_path, config, flush_interval=0.2, fsync_interval=5):
+    '''start the container of the session of a log file, None if h5py is not installed'''
+    if h5py is None:
+        print('\033[33mh5py is not installed, the session container is not written (pip install h5py)\033[0m')
+        return None
+    if log_path not in log_writer.session_writers:
+        log_writer.session_writers[log_path] = SessionWriter(container_path(log_path), config, flush_interval, fsync_interval)
+    return log_writer.session_writers[log_path]
+
+def trace(log_path, ser):
+    '''record the lines exchanged with the board of a log file in its session container'''
+    writer = log_writer.session_writers.get(log_path)
+    if writer is not None and hasattr(ser, 'trace'):
+        ser.trace = writer.trace
+
+def log_frames(log_path, t_play, interval, stimulus):
+    '''record the frame times of a video played by stimfunc.play_video(), the first frame at t_play'''
+    writer = log_writer.session_writers.get(log_path)
+    if writer is not None:
+        writer.write(('frames', (t_play, interval, stimulus)))
+
+@atexit.register
+def stop_all():
+    '''close the containers left open at exit, registered after the import of h5py so it runs before h5py shuts down'''
+    for path in list(log_writer.session_writers):
+        log_writer.session_writers.pop(path).close()
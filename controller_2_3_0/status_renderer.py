@@ -0,0 +1,92 @@
+'''
+Status line of the terminal, rendered by a background thread
+
+The countdowns of the timing loops (time_delay, LED_timer, LED_pulse of stimfunc.py, the ISIs of the controller) used
+to print their "\\r" line from inside the loop, so the terminal I/O ran in the timing-critical part of a command. A loop
+now only sets the status once, as a function rendering the line from the shared state (a deadline, counters), and the
+renderer thread samples it RATE times per second and rewrites the line. The status is disabled when stdout is not a
+terminal (output redirected to a file or a pipe), where the "\\r" lines would only pile up.
+
+Usage:
+    status_renderer.countdown('LED left:', time.perf_counter() + timer) # 'LED left: 1.9 s'
+    try:
+        ... # timing loop, no printing
+        status_renderer.clear('LED left: 0.0 s') # last state of the line, left on the terminal
+    finally:
+        status_renderer.clear() # e.g. interrupted by <Ctrl+C>
+'''
+import sys
+import time
+import threading
+
+RATE = 10 # renders per second
+
+
+class StatusRenderer:
+    '''
+    One status line of a stream, rewritten by a daemon thread while a status is shown
+
+    Parameters:
+        stream: output of the line, sys.stdout by default
+        rate (float): renders per second
+    '''
+    def __init__(self, stream=None, rate=RATE):
+        self.stream = stream if stream is not None else sys.stdout
+        self.rate = rate
+        self.enabled = hasattr(self.stream, 'isatty') and self.stream.isatty()
+        self._render = None # function returning the line, None when no status is shown
+        self._width = 0 # length of the line on the terminal
+        self._lock = threading.Lock() # a clear() never interleaves with a render
+        self._wake = threading.Event()
+        self._thread = None
+
+    def show(self, render):
+        '''show the line returned by render(), called by the renderer thread until clear()'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._render = render
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='status renderer', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def clear(self, final=None):
+        '''stop showing the status, leave the final line on the terminal (without newline) or erase the line'''
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._render is None and final is None:
+                return
+            self._render = None
+            self._write(final if final is not None else '')
+            if final is None:
+                self.stream.write('\r')
+                self._width = 0
+
+    def _write(self, line):
+        self.stream.write('\r' + line + ' ' * max(self._width - len(line), 0))
+        self.stream.flush()
+        self._width = len(line)
+
+    def _run(self):
+        while True:
+            self._wake.wait(1 / self.rate)
+            self._wake.clear()
+            with self._lock:
+                if self._render is not None:
+                    self._write(self._render())
+
+
+renderer = StatusRenderer()
+
+def show(render):
+    '''show the line returned by render() on the terminal until clear(), see StatusRenderer'''
+    renderer.show(render)
+
+def countdown(prefix, t_end, suffix='s', digits=1, note=''):
+    '''show the time left to t_end (time.perf_counter()), e.g. "LED left: 1.9 s"'''
+    renderer.show(lambda: f'{prefix} {max(t_end - time.perf_counter(), 0):.{digits}f} {suffix}{note}')
+
+def clear(final=None):
+    renderer.clear(final)
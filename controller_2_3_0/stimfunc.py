@@ -1,15 +1,21 @@
 import os
+import re
 import cv2
 import time
 import serial
 import shutil
+import struct
 import platform
 import serial.tools.list_ports
+import serial_link
+import log_writer
+import status_renderer
+from event_time import EventTime
 import matplotlib.pyplot as plt
 import moviepy.editor # requires moviepy==1.0.3
 # Magic happends here, but I quit figuring out why. The moviepy.editor improves the performance of the video playing dramatically.
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import timedelta
 from types import SimpleNamespace
 from matplotlib.patches import Ellipse
 
@@ -89,17 +95,17 @@ def play_video(frame_list, fps=240, window='image', retention_time=1000):
     print('Playing video...', end='')
     step = 1 / fps  # Time per frame in seconds
     frmN = 0
-    t0 = time.time()
+    t0 = time.perf_counter()
     t_seq = []
-    t_play = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_play = EventTime.now()
 
     for i in range(len(frame_list)):
-        curr_time = time.time()
+        curr_time = time.perf_counter()
         t_theo = i * step
 
         # Wait until the theoretical time for the current frame
         while curr_time - t0 < t_theo:
-            curr_time = time.time()
+            curr_time = time.perf_counter()
 
         # Calculate the nearest frame index to the theoretical time
         nearest_frame_index = min(len(frame_list) - 1, round((curr_time - t0) * fps))
@@ -109,11 +115,11 @@ def play_video(frame_list, fps=240, window='image', retention_time=1000):
         t_seq.append(1000 * (curr_time - t0))  # Time in ms
         cv2.waitKey(1)
 
-    t1 = time.time()
+    t1 = time.perf_counter()
     cv2.waitKey(max(retention_time, 1))
     cv2.destroyWindow(window)
     cv2.waitKey(1)
-    t_end = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_end = EventTime.now()
     playFPS = frmN / (t1 - t0)
     interval = np.diff(t_seq)
     print('done.', end=' ')
@@ -124,7 +130,7 @@ def write_video_log(log_path, real_fps, read_fps, r2v, t_play, t_end, LED_state,
     print('Read fps = {:.2f}'.format(read_fps))
     print('Real fps = {:.2f}'.format(real_fps))
     print('LED state: {}'.format(LED_state))
-    with open(log_path,'a') as log: # save the log file
+    with log_writer.open_log(log_path) as log: # save the log file
         log.write('r/v = {} ms\n'.format(r2v))
         log.write('Starting playing time: {}\n'.format(t_play))
         log.write('Done playing time: {}\n'.format(t_end)) # including retention time
@@ -133,6 +139,8 @@ def write_video_log(log_path, real_fps, read_fps, r2v, t_play, t_end, LED_state,
         log.write('Real fps = {:.2f}\n'.format(real_fps))
         log.write('LED state: {}\n'.format(LED_state))
         log.write('\n')
+    log_writer.log_event(log_path, 'video', 'screen', 'start', t_play)
+    log_writer.log_event(log_path, 'video', 'screen', 'end', t_end)
     return
 
 
@@ -156,43 +164,209 @@ def write_video_log(log_path, real_fps, read_fps, r2v, t_play, t_end, LED_state,
 #     else:
 #         print('\n\033[33mNo {} is connected.\nSerial communication is unavailable.\033[0m\n'.format(board_type))
 #     return ser
-def SetUpSerialPort(board_type='Arduino Uno', baud_rate = 9600, require_confirm=False, **kwargs):
+def FindSerialPorts(board_type='Arduino Uno', port_cache=None):
+    '''
+    Find all serial ports of the given board type
+
+    Parameters:
+        board_type (str): board name in the port description (Windows) or manufacturer (Mac and Linux)
+        port_cache (str): path to the cached board identities, boards used before are found by VID/PID/serial number
+
+    Returns:
+        tuple: (list of matching serial.tools.list_ports ListPortInfo sorted by serial number, board type searched for)
+    '''
     current_os = platform.system()
-    Port = ''
-    port_list = list(serial.tools.list_ports.comports())
-    port_names = [None]*len(port_list)
-    port_num = 0
-    ser = ''
-    
-    for i, port in enumerate(port_list):
-        port_name = port.device
-        port_names[i] = port_name
-        if current_os == 'Windows':
+    ports = []
+    all_ports = serial.tools.list_ports.comports()
+    cached_ports = serial_link.find_cached_ports(port_cache, board_type, all_ports)
+    for port in all_ports:
+        if port in cached_ports:
+            ports.append(port)
+        elif current_os == 'Windows':
             if port.description.find(board_type) != -1:
-                port_num += 1
-                Port = port_name
+                ports.append(port)
         elif current_os == 'Darwin' or current_os == 'Linux':
             if board_type != 'Arduino':
                 board_type = 'Arduino'
                 print('Detailed Arduino board cannot be recognized on Mac or Linux. Searching for all "Arduino" boards.')
             if port.manufacturer != None and port.manufacturer.find(board_type) != -1:
-                port_num += 1
-                Port = port_name
+                ports.append(port)
+    ports.sort(key=lambda port: (port.serial_number or '', port.device))
+    return ports, board_type
+
+def SetUpSerialPorts(board_type='Arduino Uno', baud_rate = 9600, board_count = 1, port_cache=None, **kwargs):
+    '''
+    Connect to all boards of the given type
+
+    Parameters:
+        board_type (str): type of the boards, 'Emulator' for software boards
+        baud_rate (int): baud rate of the serial ports
+        board_count (int): number of emulated boards, only used when board_type is 'Emulator'
+        port_cache (str): path to the cached board identities, see serial_link.py
+
+    Returns:
+        dict: {board id (USB serial number): serial port object}, in the order of the serial numbers
+    '''
+    boards = dict()
+    if board_type.lower() == 'emulator':
+        for i in range(board_count):
+            ser = SetUpEmulator(baud_rate, port=f'EMULATOR{i}', serial_number=f'EMU{i}', print_flag=False, **kwargs)
+            boards[ser.serial_number] = ser
+        print('\n{} Arduino emulators are connected'.format(board_count))
+        return boards
+    ports, board_type_found = FindSerialPorts(board_type, port_cache)
+    if not ports:
+        print('\n\033[33mNo {} is connected.\nSerial communication is unavailable.\033[0m\n'.format(board_type_found))
+        return boards
+    print('\nBuilding serial connection to {} {} boards...'.format(len(ports), board_type_found))
+    for port in ports:
+        board_id = port.serial_number if port.serial_number else port.device
+        boards[board_id] = serial_link.ReconnectingSerial(serial.Serial(port=port.device, baudrate=baud_rate, **kwargs),
+                                                         identity=serial_link.port_identity(port))
+        print('\t{} on {}'.format(board_id, port.device))
+    # all boards reset in parallel when their ports are opened
+    for board_id, ser in boards.items():
+        if serial_link.wait_for_ready(ser) is None:
+            print('\t{} did not send "READY", please update its firmware'.format(board_id))
+    serial_link.save_port_cache(port_cache, board_type, ports)
+    return boards
+
+def SetUpEmulator(baud_rate = 9600, print_flag=True, **kwargs):
+    '''open an emulated board (see arduino_emulator.py), which is reopened with a reset like a real board'''
+    from arduino_emulator import ArduinoEmulator
+    emulator = ArduinoEmulator(baudrate=baud_rate, **kwargs)
+    def reopen():
+        emulator.open()
+        return emulator
+    ser = serial_link.ReconnectingSerial(emulator, reopen=reopen)
+    serial_link.wait_for_ready(ser)
+    if print_flag:
+        print('\nArduino emulator is connected on {}'.format(ser.port))
+    return ser
+
+def SetUpSerialPort(board_type='Arduino Uno', baud_rate = 9600, require_confirm=False, port_cache=None, **kwargs):
+    if board_type.lower() == 'emulator': # software board, see arduino_emulator.py
+        return SetUpEmulator(baud_rate, **kwargs)
+    Port = ''
+    ser = ''
+    ports, board_type_found = FindSerialPorts(board_type, port_cache)
+    if len(ports) > 1: # prefer the board used last time
+        ports = serial_link.find_cached_ports(port_cache, board_type, ports) or ports
+    port_num = len(ports)
     if port_num == 1:
-        print('\n{} is found on {}'.format(board_type,Port))
+        Port = ports[0].device
+        print('\n{} is found on {}'.format(board_type_found,Port))
         if require_confirm:
             answer = input('\nDo you confirm using this port? (Y/n): ')
             if not (answer == 'Y' or answer == 'y'):
                 raise ValueError('Port is not confirmed.')
         print('\nBuilding serial connection...')
-        ser = serial.Serial(port=Port,baudrate=baud_rate, **kwargs)
-        time.sleep(2)
+        ser = serial_link.ReconnectingSerial(serial.Serial(port=Port,baudrate=baud_rate, **kwargs),
+                                             identity=serial_link.port_identity(ports[0]))
+        t_ready = serial_link.wait_for_ready(ser) # replaces the fixed 2 s delay of the auto-reset
+        if t_ready is None:
+            print('No "READY" from the board, please update its firmware to arduino_communication_6.')
+        serial_link.save_port_cache(port_cache, board_type, ports)
     elif port_num > 1:
-        raise ValueError('More than one {} is connected'.format(board_type))
+        raise ValueError('More than one {} is connected, set multi_board=True to use all of them'.format(board_type_found))
     else:
-        print('\n\033[33mNo {} is connected.\nSerial communication is unavailable.\033[0m\n'.format(board_type))
+        print('\n\033[33mNo {} is connected.\nSerial communication is unavailable.\033[0m\n'.format(board_type_found))
     return ser
 
+def get_board_id(ser):
+    '''identify the connected board by its USB serial number, falling back to the port name'''
+    if ser == '':
+        return ''
+    serial_number = getattr(ser, 'serial_number', None) # set by the emulator
+    if serial_number is None:
+        for port in serial.tools.list_ports.comports():
+            if port.device == ser.port:
+                serial_number = port.serial_number
+                break
+    return serial_number if serial_number else ser.port
+
+# lines the firmware prints by itself when a timed action ends, they can arrive while another command waits for feedback
+ASYNC_FEEDBACK = ['Light ON', 'Light OFF', 'Pulsing OFF', 'Trigger OFF', 'Air valve CLOSED', 'Odor A valve CLOSED',
+                  'Odor B valve CLOSED', 'Pump OFF and all valves are CLOSED', 'Shock pulses done', 'Wave done',
+                  'Watchdog tripped', 'Trigger train done']
+deferred_feedback = {} # {id of the serial port: [lines]}
+scheduled_feedback = {} # {id of the serial port: [(feedback prefix, log path, command)]} of the "@<ms>" commands not run yet
+VALVE_LABELS = {'air': 'Air', 'odor_a': 'Odor A', 'odor_b': 'Odor B'} # the feedback of a valve starts with its label
+
+def output_feedback(fb):
+    '''
+    Event of the feedback line of a switched output, e.g. 'Odor A valve OPEN' -> ('valve', 'odor_a', 'on')
+    
+    Returns:
+        tuple: (event type, output, 'on' or 'off'), None if the line switches no output
+    '''
+    for valve, label in VALVE_LABELS.items():
+        if fb in (label + ' valve OPEN', label + ' valve CLOSED'):
+            return 'valve', valve, 'on' if fb.endswith('OPEN') else 'off'
+    if fb == 'Pump ON' or fb.startswith('Pump OFF'): # "Pump OFF and all valves are CLOSED"
+        return 'pump', 'pump', 'on' if fb == 'Pump ON' else 'off'
+    if fb == 'Shock pulses ON' or fb.startswith('Shock pulses OFF'): # followed by the number of delivered pulses
+        return 'shock', 'shock', 'on' if fb == 'Shock pulses ON' else 'off'
+    if fb == 'Trigger ON':
+        return 'trigger', 'trigger', 'on'
+    return None
+
+def defer_feedback(ser, fb):
+    '''
+    Keep a line of a concurrently running timed action for later processing
+    
+    Returns:
+        bool: whether the line belongs to a timed action, otherwise it is left to the caller
+    '''
+    line = re.sub(r'^ch\d:', '', fb) # feedback of the LED channels is prefixed with their "ch<k>:"
+    if not log_scheduled_feedback(ser, fb) and not any(line.startswith(async_line) for async_line in ASYNC_FEEDBACK):
+        return False
+    deferred_feedback.setdefault(id(ser), []).append(fb)
+    return True
+
+def pop_deferred_feedback(ser):
+    '''lines kept by defer_feedback() for the port, in arrival order'''
+    return deferred_feedback.pop(id(ser), [])
+
+def log_scheduled_feedback(ser, fb):
+    '''
+    Log the event of the feedback of a command scheduled with "@<ms>", printed by the board when the command runs
+    
+    Returns:
+        bool: whether the line is the feedback of a scheduled command, it is then left to the caller or deferred
+    '''
+    pending = scheduled_feedback.get(id(ser), [])
+    for entry in pending:
+        expected, log_path, command = entry
+        if fb.startswith(expected):
+            pending.remove(entry)
+            t_fb = EventTime.now()
+            with log_writer.open_log(log_path) as log:
+                log.write('Feedback {} of the scheduled {} at {}\n'.format(fb, command, t_fb))
+                log.write('\n')
+            event_type, output, value = output_feedback(fb)
+            if ':t' in command: # timed valve or pump, like output_timer()
+                value += ' {} s'.format(int(command.split(':t')[1]) / 1000)
+            log_writer.log_event(log_path, event_type, output, value, t_fb)
+            return True
+    return False
+
+def forget_scheduled(ser):
+    '''drop the feedback expected from the scheduled commands of the port, e.g. after "cancel" or a reset of the board'''
+    scheduled_feedback.pop(id(ser), None)
+
+def LED_tag(channel=0):
+    '''prefix "ch<k>:" addressing LED channel k of the firmware and tagging its feedback, empty for channel 0'''
+    return f'ch{channel}:' if channel else ''
+
+def LED_label(name=''):
+    '''tag of the log lines and messages of a named LED channel'''
+    return f'[{name}] ' if name else ''
+
+def LED_output(channel=0):
+    '''name of the output of LED channel k in the event file and OUTPUT_PINS'''
+    return f'LED ch{channel}' if channel else 'LED'
+
 def LED_check(LED_state, ser):
     if LED_state:
         print('\nThe LEDs were ON. Please turn OFF before setting timer.')
@@ -203,8 +377,9 @@ def LED_check(LED_state, ser):
     else:
         return 0
 
-def LED_switch(LED_state,ser,log_path,turn_on=None):
+def LED_switch(LED_state,ser,log_path,turn_on=None,channel=0,name=''):
     t_timeout = 5000
+    tag, label = LED_tag(channel), LED_label(name)
     if ser == '':
         print('\nSerial communication is unavailable. LED state cannot be changed.\n')
         return LED_state
@@ -214,141 +389,137 @@ def LED_switch(LED_state,ser,log_path,turn_on=None):
         elif (not turn_on) and (not LED_state): # if LED is already off
             return LED_state
     if LED_state:
-        ser.write(b'off\n')
+        ser.write((tag + 'off\n').encode('utf-8'))
     else:
-        ser.write(b'on\n')
-    t_led = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        ser.write((tag + 'on\n').encode('utf-8'))
+    t_led = EventTime.now()
     LED_state = 1 - LED_state
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     while True:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout: # wait for 5 seconds
             raise TimeoutError('Arduino timeout')
         feedback = ser.readline()
         if feedback != b'':
             feedback = feedback.decode()[:-1]
-            if feedback == 'Light ON' or feedback == 'Light OFF':
-                t_led_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                with open(log_path,'a') as log: # save the log file
+            if feedback == tag + 'Light ON' or feedback == tag + 'Light OFF':
+                feedback = label + feedback[len(tag):]
+                t_led_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log: # save the log file
                     log.write('{} at {}\n'.format(feedback, t_led))
                     log.write('Feedback {} at {}\n'.format(feedback, t_led_fb))
                     log.write('\n')
+                log_writer.log_event(log_path, 'LED', LED_output(channel), 'on' if LED_state else 'off', t_led_fb)
                 print(feedback)
                 break
-            else:
+            elif not defer_feedback(ser, feedback):
                 raise ValueError(feedback)
     return LED_state
 
 
-def LED_timer(LED_state,ser,log_path,timer,delay=0,wait_for_feedback=True):
+def LED_timer(LED_state,ser,log_path,timer,delay=0,wait_for_feedback=True,channel=0,name=''):
     if LED_check(LED_state, ser) != 0: return
     t_timeout = timer + 5
+    tag, label = LED_tag(channel), LED_label(name)
     if delay <= 0:
         delay = 0
-        print(f'LED timer: {timer:.3f} s (Press <Ctrl+C>) to interrupt)')
+        print(f'{label}LED timer: {timer:.3f} s (Press <Ctrl+C>) to interrupt)')
     elif delay > 0:
-        print(f'Delayed LED timer: {timer:.3f} s after {delay:.3f} s delay (Press <Ctrl+C>) to interrupt)')
+        print(f'{label}Delayed LED timer: {timer:.3f} s after {delay:.3f} s delay (Press <Ctrl+C>) to interrupt)')
         
-    cmd_t = 'r' + str(int(timer*1000)) + 'd' + str(int(delay*1000)) + '\n'
+    cmd_t = tag + 'r' + str(int(timer*1000)) + 'd' + str(int(delay*1000)) + '\n'
     ser.write(cmd_t.encode('utf-8'))
-    t_on = datetime.now() + timedelta(seconds=delay)
+    t_on = EventTime.now() + timedelta(seconds=delay)
     t_off = t_on + timedelta(seconds=timer)
-    t_on = t_on.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    t_off = t_off.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
     if wait_for_feedback:
-        t_arduino = time.time()
-        while True:
-            t_wait = time.time() - t_arduino
-            if t_wait > t_timeout:
-                raise TimeoutError('Arduino timeout')
-            if LED_state and timer > 1: # if timer is longer than 1 second
-                current_time = time.time()
-                remaining = timer-(current_time-t_start)
-                # Print countdown regularly
-                if not hasattr(LED_timer, 'last_print_time') or current_time - LED_timer.last_print_time >= 0.1:
-                    if remaining > 0.05:  # Normal countdown
-                        print(f'\rLED left: {remaining:.1f} s (Press <Ctrl+C>) to interrupt)', end='      ')
-                    else:  # Final 0.0
-                        print('\rLED left: 0.0 s', end='      ')
-                    LED_timer.last_print_time = current_time
-            if ser.inWaiting() > 0:
-                fb = ser.readline().decode()[:-1]
-                if fb == 'Light ON':
-                    t_on_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                    LED_state = 1
-                    t_start = time.time()
-                    print(fb)
-                elif fb == 'Light OFF':
-                    t_off_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                    LED_state = 0
-                    print('\n'+fb)
-                    break
-                else:
-                    raise ValueError('Wrong feedback from Arduino: {}'.format(fb))
+        t_arduino = time.perf_counter()
+        try:
+            while True:
+                t_wait = time.perf_counter() - t_arduino
+                if t_wait > t_timeout:
+                    raise TimeoutError('Arduino timeout')
+                if ser.inWaiting() > 0:
+                    fb = ser.readline().decode()[:-1]
+                    if fb == tag + 'Light ON':
+                        t_on_fb = EventTime.now()
+                        LED_state = 1
+                        t_start = time.perf_counter()
+                        print(label + fb[len(tag):])
+                        if timer > 1: # countdown rendered by the status thread, not by this loop
+                            status_renderer.countdown('LED left:', t_start + timer, note=' (Press <Ctrl+C>) to interrupt)')
+                    elif fb == tag + 'Light OFF':
+                        t_off_fb = EventTime.now()
+                        LED_state = 0
+                        status_renderer.clear('LED left: 0.0 s' if timer > 1 else None)
+                        print('\n' + label + fb[len(tag):])
+                        break
+                    elif not defer_feedback(ser, fb):
+                        raise ValueError('Wrong feedback from Arduino: {}'.format(fb))
+        finally:
+            status_renderer.clear()
     else:
         print('\033[30mNot listening to the feedbacks from Arduino\033[0m')
-    with open(log_path,'a') as log:
-        log.write('LED timer: {} s\n'.format(timer))
-        log.write('Light ON at {}\n'.format(t_on))
-        log.write('Light OFF at {}\n'.format(t_off))
+    with log_writer.open_log(log_path) as log:
+        log.write('{}LED timer: {} s\n'.format(label, timer))
+        log.write('{}Light ON at {}\n'.format(label, t_on))
+        log.write('{}Light OFF at {}\n'.format(label, t_off))
         if wait_for_feedback:
-            log.write('Feedback Light ON at {}\n'.format(t_on_fb))
-            log.write('Feedback Light OFF at {}\n'.format(t_off_fb))
+            log.write('Feedback {}Light ON at {}\n'.format(label, t_on_fb))
+            log.write('Feedback {}Light OFF at {}\n'.format(label, t_off_fb))
         log.write('\n')
+    log_writer.log_event(log_path, 'LED', LED_output(channel), 'on', t_on_fb if wait_for_feedback else t_on)
+    log_writer.log_event(log_path, 'LED', LED_output(channel), 'off', t_off_fb if wait_for_feedback else t_off)
     return 0
 
 
-def LED_pulse(LED_state,ser,log_path,duration,frequency,pulse_width):
+def LED_pulse(LED_state,ser,log_path,duration,frequency,pulse_width,channel=0,name=''):
     if LED_check(LED_state, ser) != 0: return
     t_timeout = duration + 5
-    cmd_p = 'p' + str(int(duration*1000)) + 'f' + str(int(frequency*1000)) + 'w' + str(pulse_width) + '\n'
+    tag, label = LED_tag(channel), LED_label(name)
+    cmd_p = tag + 'p' + str(int(duration*1000)) + 'f' + str(int(frequency*1000)) + 'w' + str(pulse_width) + '\n'
     ser.write(cmd_p.encode('utf-8'))
-    t_on = datetime.now()
+    t_on = EventTime.now()
     t_off = t_on + timedelta(seconds=duration)
-    t_on = t_on.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    t_off = t_off.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    print('LED pulsing for {:.3f} s at {:.3f} Hz with {:d} ms pulse width'.format(duration,frequency,pulse_width))
-    t_arduino = time.time()
-    while True:
-        t_wait = time.time() - t_arduino
-        if t_wait > t_timeout:
-            raise TimeoutError('Arduino timeout')
-        if LED_state and duration > 1: # if timer is longer than 1 second
-            current_time = time.time()
-            remaining = duration-(current_time-t_start)
-            # Print countdown regularly
-            if not hasattr(LED_pulse, 'last_print_time') or current_time - LED_pulse.last_print_time >= 0.1:
-                if remaining > 0.05:  # Normal countdown
-                    print(f'\rLED left: {remaining:.1f} s (Press <Ctrl+C>) to interrupt)', end='      ')
-                else:  # Final 0.0
-                    print('\rLED left: 0.0 s', end='      ')
-                LED_pulse.last_print_time = current_time
-        if ser.inWaiting() > 0:
-            fb = ser.readline().decode()[:-1]
-            if fb == 'Pulsing ON':
-                t_on_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                LED_state = 1
-                t_start = time.time()
-                print(fb)
-            elif fb == 'Pulsing OFF':
-                t_off_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                LED_state = 0
-                print('\n'+fb)
-                break
-            else:
-                raise ValueError('Wrong feedback from Arduino: {}'.format(fb))
-    with open(log_path,'a') as log:
-        log.write('LED Pulsing: {} s\n'.format(duration))
-        log.write('Frequency: {} Hz\n'.format(frequency))
-        log.write('Pulse width: {} ms\n'.format(pulse_width))
-        log.write('Pulsing ON at {}\n'.format(t_on))
-        log.write('Pulsing OFF at {}\n'.format(t_off))
-        log.write('Feedback Pulsing ON at {}\n'.format(t_on_fb))
-        log.write('Feedback Pulsing OFF at {}\n'.format(t_off_fb))
+    print(label + 'LED pulsing for {:.3f} s at {:.3f} Hz with {:d} ms pulse width'.format(duration,frequency,pulse_width))
+    t_arduino = time.perf_counter()
+    try:
+        while True:
+            t_wait = time.perf_counter() - t_arduino
+            if t_wait > t_timeout:
+                raise TimeoutError('Arduino timeout')
+            if ser.inWaiting() > 0:
+                fb = ser.readline().decode()[:-1]
+                if fb == tag + 'Pulsing ON':
+                    t_on_fb = EventTime.now()
+                    LED_state = 1
+                    t_start = time.perf_counter()
+                    print(label + fb[len(tag):])
+                    if duration > 1: # countdown rendered by the status thread, not by this loop
+                        status_renderer.countdown('LED left:', t_start + duration, note=' (Press <Ctrl+C>) to interrupt)')
+                elif fb == tag + 'Pulsing OFF':
+                    t_off_fb = EventTime.now()
+                    LED_state = 0
+                    status_renderer.clear('LED left: 0.0 s' if duration > 1 else None)
+                    print('\n' + label + fb[len(tag):])
+                    break
+                elif not defer_feedback(ser, fb):
+                    raise ValueError('Wrong feedback from Arduino: {}'.format(fb))
+    finally:
+        status_renderer.clear()
+    with log_writer.open_log(log_path) as log:
+        log.write('{}LED Pulsing: {} s\n'.format(label, duration))
+        log.write('{}Frequency: {} Hz\n'.format(label, frequency))
+        log.write('{}Pulse width: {} ms\n'.format(label, pulse_width))
+        log.write('{}Pulsing ON at {}\n'.format(label, t_on))
+        log.write('{}Pulsing OFF at {}\n'.format(label, t_off))
+        log.write('Feedback {}Pulsing ON at {}\n'.format(label, t_on_fb))
+        log.write('Feedback {}Pulsing OFF at {}\n'.format(label, t_off_fb))
         log.write('\n')
+    log_writer.log_event(log_path, 'pulse', LED_output(channel), f'on {frequency} Hz {pulse_width} ms', t_on_fb)
+    log_writer.log_event(log_path, 'pulse', LED_output(channel), 'off', t_off_fb)
     return 0
 
-def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=1.0, pulse_width=50):
+def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=1.0, pulse_width=50, channel=0, name=''):
     """
     Control the continuous LED pulsing (turn on/off)
     
@@ -359,6 +530,8 @@ def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=
         turn_on (bool, optional): Force on/off state. Defaults to None (toggle).
         frequency (float): Pulse frequency in Hz
         pulse_width (int): Pulse width in ms
+        channel (int): LED channel of the firmware
+        name (str): name of the LED channel tagging the log lines, '' for no tag
         
     Returns:
         bool: New pulse state
@@ -369,6 +542,7 @@ def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=
     
     # Format frequency with 3 decimal places precision (x1000)
     freq_val = int(frequency * 1000)
+    tag, label = LED_tag(channel), LED_label(name)
     
     # Determine command based on current state and parameters
     if turn_on is None:
@@ -387,34 +561,38 @@ def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=
         print('Turning continuous pulse OFF')
     
     # Log action time
-    t_pulse = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    ser.write(cmd.encode('utf-8'))
+    t_pulse = EventTime.now()
+    ser.write((tag + cmd).encode('utf-8'))
     
     # Wait for feedback from Arduino - accept multiple possible responses
     t_timeout = 5  # timeout in seconds
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     feedback_received = False
     
     # Keep track of which message we received
     received_message = ""
     
-    while not feedback_received and (time.time() - t_arduino < t_timeout):
+    while not feedback_received and (time.perf_counter() - t_arduino < t_timeout):
         if ser.in_waiting > 0:
             response = ser.readline().decode('utf-8').strip()
-            print(response)
             
-            # Accept any of these messages as valid feedback
-            valid_on_messages = ["Continuous Pulse ON", "Pulsing ON"]
-            valid_off_messages = ["Continuous Pulse OFF", "Pulsing OFF"]
-            valid_update_messages = ["Pulse parameters updated"]
+            # Accept any of these messages of the channel as valid feedback
+            valid_on_messages = [tag + "Continuous Pulse ON", tag + "Pulsing ON"]
+            valid_off_messages = [tag + "Continuous Pulse OFF", tag + "Pulsing OFF"]
+            valid_update_messages = [tag + "Pulse parameters updated"]
+            
+            if not any(response.startswith(msg) for msg in valid_on_messages + valid_off_messages + valid_update_messages) \
+               and defer_feedback(ser, response):
+                continue # end of a timed action, e.g. of another LED channel
+            print(label + response[len(tag):] if response.startswith(tag) else response)
             
-            if any(msg in response for msg in valid_on_messages):
+            if any(response.startswith(msg) for msg in valid_on_messages):
                 feedback_received = True
                 received_message = "ON"
-            elif any(msg in response for msg in valid_off_messages):
+            elif any(response.startswith(msg) for msg in valid_off_messages):
                 feedback_received = True
                 received_message = "OFF"
-            elif any(msg in response for msg in valid_update_messages):
+            elif any(response.startswith(msg) for msg in valid_update_messages):
                 feedback_received = True
                 received_message = "UPDATED"
     
@@ -429,15 +607,17 @@ def continuous_pulse_switch(pulse_state, ser, log_path, turn_on=None, frequency=
         # For "UPDATED", don't change the state
         
         # Log the action
-        with open(log_path, 'a') as log:
+        with log_writer.open_log(log_path) as log:
             if received_message == "UPDATED":
-                log.write('{}\tPulse parameters\tFreq:{:.3f}Hz Width:{}ms\n'.format(
-                    t_pulse, frequency, pulse_width
+                log.write('{}\t{}Pulse parameters\tFreq:{:.3f}Hz Width:{}ms\n'.format(
+                    t_pulse, label, frequency, pulse_width
                 ))
             else:
-                log.write('{}\t{}\tContinuous Pulse {}\n'.format(
-                    t_pulse, received_message, received_message
+                log.write('{}\t{}\t{}Continuous Pulse {}\n'.format(
+                    t_pulse, received_message, label, received_message
                 ))
+        log_writer.log_event(log_path, 'pulse', LED_output(channel), f'on {frequency} Hz {pulse_width} ms'
+                             if received_message != 'OFF' else 'off', t_pulse)
     
     return pulse_state
 
@@ -458,27 +638,28 @@ def pump_switch(pump_state, ser, log_path, turn_on=None):
         ser.write(b'pump:off\n')
     else:
         ser.write(b'pump:on\n')
-    t_pump = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_pump = EventTime.now()
     pump_state = 1 - pump_state
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     while True:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout:  # wait for 5 seconds
             raise TimeoutError('Arduino timeout')
         feedback = ser.readline()
         if feedback != b'':
             feedback = feedback.decode()[:-1]
             if feedback == 'Pump ON' or feedback.startswith('Pump OFF'):
-                t_pump_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                with open(log_path, 'a') as log:  # save the log file
+                t_pump_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:  # save the log file
                     log.write('{} at {}\n'.format(feedback, t_pump))
                     log.write('Feedback {} at {}\n'.format(feedback, t_pump_fb))
                     log.write('\n')
+                log_writer.log_event(log_path, *output_feedback(feedback), t_pump_fb)
                 print(feedback)
                 break
             elif feedback.startswith('Warning:'):
                 print('\033[33m' + feedback + '\033[0m')
-            else:
+            elif not defer_feedback(ser, feedback):
                 raise ValueError(feedback)
     return pump_state
 
@@ -502,27 +683,28 @@ def set_pump_value(ser, log_path, value):
     t_timeout = 5000
     cmd = 'pump:value:{}\n'.format(value)
     ser.write(cmd.encode('utf-8'))
-    t_pump = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    t_arduino = time.time()
+    t_pump = EventTime.now()
+    t_arduino = time.perf_counter()
     while True:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout:  # wait for 5 seconds
             raise TimeoutError('Arduino timeout')
         feedback = ser.readline()
         if feedback != b'':
             feedback = feedback.decode()[:-1]
             if feedback.startswith('Pump value set to'):
-                t_pump_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                with open(log_path, 'a') as log:  # save the log file
+                t_pump_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:  # save the log file
                     log.write('{} at {}\n'.format(feedback, t_pump))
                     log.write('Feedback received at {}\n'.format(t_pump_fb))
                     log.write('\n')
+                log_writer.log_event(log_path, 'pump value', 'pump', value, t_pump_fb)
                 print(feedback)
                 return 0
             elif feedback.startswith('Invalid pump value'):
                 print('\033[31m' + feedback + '\033[0m')
                 return 1
-            else:
+            elif not defer_feedback(ser, feedback):
                 raise ValueError(feedback)
 
 
@@ -554,49 +736,130 @@ def shock_switch(shock_state, ser, log_path, turn_on=None):
     # Send command to Arduino
     if shock_state:
         ser.write(b'shock:off\n')
-        expected_feedback = "Shock pulses OFF"  # Match exact string from Arduino
+        expected_feedback = "Shock pulses OFF"  # followed by the number of delivered pulses
     else:
         ser.write(b'shock:on\n')
         expected_feedback = "Shock pulses ON"  # Match exact string from Arduino
     
     # Log action time
-    t_shock = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_shock = EventTime.now()
     
     # Wait for immediate feedback from Arduino confirming state change
     t_timeout = 5  # timeout in seconds
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     feedback_received = False
     
     while not feedback_received:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout:
             print(f'\033[33mWarning: No feedback received from Arduino after {t_timeout}s. Shock state may not have changed.\033[0m')
             break
             
         if ser.inWaiting() > 0:
             feedback = ser.readline().decode()[:-1]
-            if feedback == expected_feedback:
-                t_shock_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                with open(log_path, 'a') as log:
+            if feedback.startswith(expected_feedback):
+                t_shock_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:
                     log.write(f'Sent command for {expected_feedback} at {t_shock}\n')
                     log.write(f'Received confirmation: "{feedback}" at {t_shock_fb}\n')
                     log.write('\n')
+                log_writer.log_event(log_path, *output_feedback(feedback), t_shock_fb)
                 print(f"Received: {feedback}")
                 feedback_received = True
-            else:
+            elif not defer_feedback(ser, feedback):
                 print(f'\033[33mReceived unexpected response: "{feedback}" (waiting for "{expected_feedback}")\033[0m')
     
     # Update shock state ONLY if we received confirmation
     if feedback_received:
         shock_state = 1 - shock_state
     else:
-        with open(log_path, 'a') as log:
+        with log_writer.open_log(log_path) as log:
             log.write(f'Warning: Failed to confirm shock state change at {t_shock}\n')
             log.write('\n')
     
     return shock_state
 
 
+def set_shock_parameters(ser, log_path, frequency, pulse_width, pulse_count=0):
+    """
+    Set the shock pulse train of the board, applied from the next pulse if the shock pulses are on
+    
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        frequency (float): Shock frequency in Hz, precision 0.001 Hz
+        pulse_width (int): Shock pulse width in ms, shorter than the period
+        pulse_count (int): Number of pulses after 'shock:on', 0 for no limit
+        
+    Returns:
+        int: 0 if the board accepted the parameters, 1 otherwise
+    """
+    if ser == '':
+        print('\nSerial communication is unavailable. Shock parameters cannot be set.\n')
+        return 1
+    cmd = 'shock:f{}w{}n{}\n'.format(int(frequency*1000), int(pulse_width), int(pulse_count))
+    ser.write(cmd.encode('utf-8'))
+    t_shock = EventTime.now()
+    t_timeout = 1 # firmware without the command does not answer
+    t_arduino = time.perf_counter()
+    while time.perf_counter() - t_arduino < t_timeout:
+        if ser.inWaiting() > 0:
+            feedback = ser.readline().decode()[:-1]
+            if feedback.startswith('Shock parameters set'):
+                t_shock_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:
+                    log.write('{} at {}\n'.format(feedback, t_shock))
+                    log.write('Feedback received at {}\n'.format(t_shock_fb))
+                    log.write('\n')
+                log_writer.log_event(log_path, 'shock parameters', 'shock', f'{frequency} Hz {pulse_width} ms {pulse_count} pulses', t_shock_fb)
+                print(feedback)
+                return 0
+            elif feedback.startswith('Error:'):
+                print('\033[31m' + feedback + '\033[0m')
+                return 1
+            elif not defer_feedback(ser, feedback):
+                print('\033[33mUnexpected response: {}\033[0m'.format(feedback))
+    print('\033[33mWarning: No feedback received from Arduino, the firmware may not support shock parameters.\033[0m')
+    return 1
+
+
+def set_watchdog(ser, log_path, window):
+    """
+    Set the watchdog of the board, which switches all outputs off when no line has come from the host for the window
+    
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        window (float): Time without any line from the host in seconds, 0 to disable the watchdog
+        
+    Returns:
+        int: 0 if the board accepted the window, 1 otherwise
+    """
+    if ser == '':
+        print('\nSerial communication is unavailable. Watchdog cannot be set.\n')
+        return 1
+    cmd = 'wd:{}\n'.format(int(window*1000))
+    ser.write(cmd.encode('utf-8'))
+    t_watchdog = EventTime.now()
+    t_timeout = 1
+    t_arduino = time.perf_counter()
+    while time.perf_counter() - t_arduino < t_timeout:
+        if ser.inWaiting() > 0:
+            feedback = ser.readline().decode()[:-1]
+            if feedback.startswith('Watchdog window set to'):
+                with log_writer.open_log(log_path) as log:
+                    log.write('{} at {}\n'.format(feedback, t_watchdog))
+                    log.write('\n')
+                log_writer.log_event(log_path, 'watchdog', 'board', f'{window} s', t_watchdog)
+                return 0
+            elif feedback.startswith('Invalid Request'): # firmware without the watchdog
+                break
+            elif not defer_feedback(ser, feedback):
+                print('\033[33mUnexpected response: {}\033[0m'.format(feedback))
+    print('\033[33mWarning: The firmware does not support the watchdog, please update it to arduino_communication_6.\033[0m')
+    return 1
+
+
 def valve_switch(valve_name, valve_state, ser, log_path, turn_on=None):
     """
     Control the valves (air, odor_a, odor_b)
@@ -619,6 +882,8 @@ def valve_switch(valve_name, valve_state, ser, log_path, turn_on=None):
         elif (not turn_on) and (not valve_state):  # if valve is already off
             return valve_state
     
+    label = VALVE_LABELS[valve_name]
+    
     # Prepare command
     if valve_state:
         cmd = '{}:off\n'.format(valve_name)
@@ -627,16 +892,16 @@ def valve_switch(valve_name, valve_state, ser, log_path, turn_on=None):
         
     # Send command
     ser.write(cmd.encode('utf-8'))
-    t_valve = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_valve = EventTime.now()
     
     # Log the command being sent
-    with open(log_path, 'a') as log:
+    with log_writer.open_log(log_path) as log:
         log.write('Sent {} command at {}\n'.format(cmd.strip(), t_valve))
 
     # Wait for feedback with reasonable timeout
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     while True:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout:  # wait for 5 seconds
             print('\033[33mWarning: No feedback received from Arduino. Command may not have been processed.\033[0m')
             # Don't update the state since we don't know if command succeeded
@@ -646,12 +911,13 @@ def valve_switch(valve_name, valve_state, ser, log_path, turn_on=None):
             feedback = ser.readline().decode()[:-1]
             if feedback != '':
                 # Handle different types of feedback
-                if feedback.endswith('valve OPEN') or feedback.endswith('valve CLOSED'):
-                    t_valve_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                    with open(log_path, 'a') as log:
+                if feedback in (label + ' valve OPEN', label + ' valve CLOSED'):
+                    t_valve_fb = EventTime.now()
+                    with log_writer.open_log(log_path) as log:
                         log.write('{} at {}\n'.format(feedback, t_valve))
                         log.write('Feedback {} at {}\n'.format(feedback, t_valve_fb))
                         log.write('\n')
+                    log_writer.log_event(log_path, *output_feedback(feedback), t_valve_fb)
                     print(feedback)
                     
                     # Update the valve state based on the feedback
@@ -665,7 +931,7 @@ def valve_switch(valve_name, valve_state, ser, log_path, turn_on=None):
                     # If the warning indicates failure, don't change the state
                     if "Cannot open valve - Pump is OFF" in feedback:
                         return valve_state
-                else:
+                elif not defer_feedback(ser, feedback):
                     # Unexpected feedback
                     print('\033[33mUnexpected response: {}\033[0m'.format(feedback))
 
@@ -678,28 +944,446 @@ def quit_all_operations(ser, log_path):
     
     t_timeout = 5  # timeout in seconds
     ser.write(b'quit\n')
-    t_quit = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_quit = EventTime.now()
+    forget_scheduled(ser) # quit also drops the scheduled commands
     print('Sending quit command to Arduino...')
     
     # Wait for feedback from Arduino
-    t_arduino = time.time()
+    t_arduino = time.perf_counter()
     while True:
-        t_wait = time.time() - t_arduino
+        t_wait = time.perf_counter() - t_arduino
         if t_wait > t_timeout:
             raise TimeoutError('Arduino timeout')
         if ser.inWaiting() > 0:
             fb = ser.readline().decode()[:-1]
             if fb == "All operations terminated":
-                t_quit_fb = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                with open(log_path, 'a') as log:  # save the log file
+                t_quit_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:  # save the log file
                     log.write('Quit command sent at {}\n'.format(t_quit))
                     log.write('Feedback: {} at {}\n'.format(fb, t_quit_fb))
                     log.write('\n')
+                log_writer.log_event(log_path, 'quit', 'board', 'all off', t_quit_fb)
                 print('All operations on Arduino terminated successfully.')
                 break
-            else:
+            elif not defer_feedback(ser, fb):
+                raise ValueError(f'Wrong feedback from Arduino: {fb}')
+    
+    return 0
+
+def output_timer(output, ser, log_path, duration):
+    '''
+    Open a valve or run the pump for given time with a timer of the firmware, without waiting for the end
+    
+    Parameters:
+        output (str): 'air', 'odor_a', 'odor_b' or 'pump'
+        ser: Serial port object
+        log_path (str): Path to log file
+        duration (float): time in seconds
+        
+    Returns:
+        bool: whether the output was switched on; the end arrives later as "... CLOSED" or "Pump OFF ..."
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. {} cannot be switched.\n'.format(output))
+        return False
+    expected = 'Pump ON' if output == 'pump' else VALVE_LABELS[output] + ' valve OPEN'
+    cmd = '{}:t{}\n'.format(output, int(duration*1000))
+    ser.write(cmd.encode('utf-8'))
+    t_output = EventTime.now()
+    t_timeout = 5
+    t_arduino = time.perf_counter()
+    while True:
+        if time.perf_counter() - t_arduino > t_timeout:
+            raise TimeoutError('Arduino timeout')
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if fb == expected:
+                t_output_fb = EventTime.now()
+                with log_writer.open_log(log_path) as log:
+                    log.write('{} timer: {} s\n'.format(output, duration))
+                    log.write('{} at {}\n'.format(fb, t_output))
+                    log.write('Feedback {} at {}\n'.format(fb, t_output_fb))
+                    log.write('\n')
+                log_writer.log_event(log_path, 'pump' if output == 'pump' else 'valve', output, f'on {duration} s', t_output_fb)
+                print('{} for {:.3f} s'.format(fb, duration))
+                return True
+            elif fb.startswith('Warning:') or fb.startswith('Error:'):
+                print('\033[33m' + fb + '\033[0m')
+                return False
+            elif not defer_feedback(ser, fb):
                 raise ValueError(f'Wrong feedback from Arduino: {fb}')
+
+def schedule_command(ser, log_path, command, delay, timeout=0.5, feedback=None):
+    '''
+    Send a command that the board runs after given delay, timed by the board clock instead of the PC
     
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        command (str): firmware command, e.g. 'air:on' or 'trigger'
+        delay (float): delay in seconds from the reception of the command
+        timeout (float): timeout in seconds for the "Scheduled" acknowledgement
+        feedback (str): prefix of the feedback of the command, deferred and logged by whichever command reads it when the
+            board runs the command; None when the caller waits for the feedback itself (see complete_prearmed())
+        
+    Returns:
+        bool: whether the board scheduled the command; False for firmware without "@" scheduling,
+            the feedback of the command itself arrives when the board runs it
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Command cannot be scheduled.\n')
+        return False
+    cmd = '{}@{}\n'.format(command, int(round(max(delay, 0)*1000)))
+    ser.write(cmd.encode('utf-8'))
+    t_schedule = EventTime.now()
+    t_arduino = time.perf_counter()
+    while time.perf_counter() - t_arduino < timeout:
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if fb == 'Scheduled ' + command:
+                with log_writer.open_log(log_path) as log:
+                    log.write('{} scheduled in {:.3f} s at {}\n'.format(command, delay, t_schedule))
+                    log.write('\n')
+                log_writer.log_event(log_path, 'schedule', command, f'{delay:.3f} s', t_schedule)
+                if feedback is not None:
+                    scheduled_feedback.setdefault(id(ser), []).append((feedback, log_path, command))
+                return True
+            elif fb.startswith('Error:') or fb == 'Invalid Request':
+                print('\033[33m' + fb + '\033[0m')
+                return False
+            elif not defer_feedback(ser, fb):
+                print('\033[33mUnexpected response: {}\033[0m'.format(fb))
+    print('\033[33mThe board did not acknowledge the scheduled command, please update the firmware to arduino_communication_6.\033[0m')
+    return False
+
+def cancel_scheduled(ser, log_path):
+    '''drop the commands scheduled on the board that have not run yet'''
+    if ser == '':
+        return 1
+    ser.write(b'cancel\n')
+    t_cancel = EventTime.now()
+    forget_scheduled(ser)
+    t_arduino = time.perf_counter()
+    while time.perf_counter() - t_arduino < 1:
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if fb == 'Scheduled commands cancelled':
+                with log_writer.open_log(log_path) as log:
+                    log.write('{} at {}\n'.format(fb, t_cancel))
+                    log.write('\n')
+                return 0
+            defer_feedback(ser, fb)
+    return 1
+
+def wait_for_line(ser, prefixes, timeout, command):
+    '''read lines until one starts with any of the prefixes, the other lines of timed actions are deferred'''
+    t_arduino = time.perf_counter()
+    while True:
+        if time.perf_counter() - t_arduino > timeout:
+            raise TimeoutError(f'Arduino timeout while waiting for the feedback of "{command}"')
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if any(fb.startswith(prefix) for prefix in prefixes):
+                return fb
+            elif not defer_feedback(ser, fb):
+                raise ValueError(f'Wrong feedback from Arduino: {fb}')
+
+def upload_waveform(ser, log_path, commands):
+    '''
+    Replace the waveform table of the board
+    
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        commands (list): "wave:add:" lines from waveform.encode_commands()
+        
+    Returns:
+        int: 0 if the whole table was accepted, 1 otherwise
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Waveform cannot be uploaded.\n')
+        return 1
+    ser.write(b'wave:clear\n')
+    wait_for_line(ser, ['Wave cleared'], 5, 'wave:clear')
+    for cmd in commands: # one line at a time, so the 64-byte serial buffer of the board never overflows
+        ser.write((cmd + '\n').encode('utf-8'))
+        fb = wait_for_line(ser, ['Wave ', 'Error:'], 5, cmd)
+        if fb.startswith('Error:'):
+            print('\033[31m' + fb + '\033[0m')
+            return 1
+    with log_writer.open_log(log_path) as log:
+        log.write('Waveform uploaded ({}) at {}\n'.format(fb, EventTime.now()))
+        log.write('\n')
+    return 0
+
+def play_waveform(ser, log_path, duration, plays=1, period=0, wait_for_end=True):
+    '''
+    Play the uploaded waveform table
+    
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        duration (float): duration of one play in seconds, for the timeout
+        plays (int): number of plays
+        period (float): time from the start of a play to the start of the next one in seconds, at least the duration
+        wait_for_end (bool): whether to wait for the end of the last play
+        
+    Returns:
+        int: 0 on success
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Waveform cannot be played.\n')
+        return 1
+    cmd = 'wave:play:{}:{}'.format(int(plays), int(period * 1e6))
+    ser.write((cmd + '\n').encode('utf-8'))
+    t_play = EventTime.now()
+    fb = wait_for_line(ser, ['Wave started at', 'Error:'], 5, cmd)
+    if fb.startswith('Error:'):
+        print('\033[31m' + fb + '\033[0m')
+        return 1
+    t_start_board = int(fb.split()[-1]) # micros() of the board
+    t_start_fb = EventTime.now()
+    print('Wave started')
+    with log_writer.open_log(log_path) as log:
+        log.write('Wave started at {}\n'.format(t_play))
+        log.write('Feedback Wave started at {} (board {} us)\n'.format(t_start_fb, t_start_board))
+        if not wait_for_end:
+            log.write('\n')
+    log_writer.log_event(log_path, 'wave', 'waveform', f'start {plays} plays', t_start_fb)
+    if not wait_for_end:
+        return 0
+    total = max(duration, period) * (plays - 1) + duration
+    fb = wait_for_line(ser, ['Wave done at', 'Wave stopped at'], total + 5, cmd)
+    t_end_board = int(fb.split()[-1])
+    t_end_fb = EventTime.now()
+    print('{} after {:.6f} s on the board clock'.format(fb.split(' at')[0], ((t_end_board - t_start_board) % 2**32) / 1e6))
+    with log_writer.open_log(log_path) as log:
+        log.write('Feedback {} at {} (board {} us)\n'.format(fb.split(' at')[0], t_end_fb, t_end_board))
+        log.write('\n')
+    log_writer.log_event(log_path, 'wave', 'waveform', fb.split(' at')[0].split()[-1], t_end_fb) # done or stopped
+    return 0
+
+def stop_waveform(ser, log_path):
+    '''stop the waveform played by the board and switch off its pins'''
+    if ser == '':
+        print('\nSerial communication is unavailable. Waveform cannot be stopped.\n')
+        return 1
+    ser.write(b'wave:stop\n')
+    t_stop = EventTime.now()
+    fb = wait_for_line(ser, ['Wave stopped at'], 5, 'wave:stop')
+    with log_writer.open_log(log_path) as log:
+        log.write('Wave stopped at {}\n'.format(t_stop))
+        log.write('Feedback {} us\n'.format(fb))
+        log.write('\n')
+    log_writer.log_event(log_path, 'wave', 'waveform', 'stopped', t_stop)
+    print('Wave stopped')
+    return 0
+
+TRIGGER_TRAIN_COMMANDS = ['trig:on', 'trig:off', 'trig:count']
+
+def line_sent_time(ser, fb):
+    '''PC time when the board started sending the feedback line just read: its arrival less its transmission time'''
+    t_transmit = (len(fb) + 1) * 10 / ser.baudrate # 10 bits per byte with the "\n"
+    return EventTime.now() - timedelta(seconds=t_transmit)
+
+def start_trigger_train(ser, log_path, frequency, pulse_width, pulse_count=0):
+    '''
+    Start a train of frame trigger pulses on the trigger output, timed by the board to synchronize the cameras
+    
+    Parameters:
+        ser: Serial port object
+        log_path (str): Path to log file
+        frequency (float): frequency (Hz) of the pulses, e.g. the frame rate of the cameras
+        pulse_width (float): width (ms) of each pulse, shorter than the period
+        pulse_count (int): number of pulses, the board stops by itself after the last one; 0 for no limit
+        
+    Returns:
+        dict: {'start': board micros of the first rise, 'period': us between two rises, 'width': us of each pulse,
+            'pulses': pulses reported so far, 'running': bool, 'samples': [(board micros, PC time)]},
+            None if the train was not started
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Trigger train cannot be started.\n')
+        return None
+    cmd = 'trig:f{}w{}n{}'.format(int(round(frequency * 1000)), int(round(pulse_width * 1000)), int(pulse_count))
+    ser.write((cmd + '\n').encode('utf-8'))
+    t_cmd = EventTime.now()
+    fb = wait_for_line(ser, ['Trigger train ON at', 'Error:', 'Invalid Request'], 5, cmd)
+    if not fb.startswith('Trigger train ON'):
+        print('\033[31m' + (fb if fb.startswith('Error:') else 'The firmware has no trigger train, please update it to arduino_communication_6') + '\033[0m')
+        return None
+    period, width = map(int, re.search(r'\((\d+) us period, (\d+) us pulse width\)', fb).groups())
+    t_start = int(fb.split()[4]) # Trigger train ON at <micros> (...), sent right after the first rise
+    t_pc = line_sent_time(ser, fb)
+    print('Trigger train ON ({:.3f} Hz, {} us pulse width)'.format(1e6 / period, width))
+    with log_writer.open_log(log_path) as log:
+        log.write('Trigger train started at {}\n'.format(t_cmd))
+        log.write('Feedback Trigger train ON at {} (board {} us, {} us period, {} us pulse width, {} pulses)\n'.format(
+            t_pc.strftime('%Y-%m-%d %H:%M:%S.%f'), t_start, period, width, pulse_count if pulse_count else 'no limit of'))
+        log.write('\n')
+    log_writer.log_event(log_path, 'trigger train', 'trigger', f'on {period} us period {width} us', t_pc)
+    return {'start': t_start, 'period': period, 'width': width, 'pulses': 1, 'running': True, 'samples': [(t_start, t_pc)]}
+
+def sample_trigger_train(ser, log_path, stop=False):
+    '''
+    Read the number of pulses of the trigger train with the board clock ("trig:count"), or stop the train ("trig:off")
+    
+    Returns:
+        tuple: (pulses so far, board micros, PC time), None if the firmware has no trigger train
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Trigger train cannot be read.\n')
+        return None
+    cmd = 'trig:off' if stop else 'trig:count'
+    ser.write((cmd + '\n').encode('utf-8'))
+    fb = wait_for_line(ser, ['Trigger train OFF' if stop else 'Trigger train count', 'Invalid Request'], 5, cmd)
+    if fb == 'Invalid Request':
+        print('\033[31mThe firmware has no trigger train, please update it to arduino_communication_6\033[0m')
+        return None
+    pulses = int(re.search(r'\((\d+) pulses\)', fb).group(1))
+    t_board = int(fb.split()[-1])
+    t_pc = line_sent_time(ser, fb)
+    with log_writer.open_log(log_path) as log:
+        log.write('Feedback Trigger train {} ({} pulses) at {} (board {} us)\n'.format(
+            'OFF' if stop else 'count', pulses, t_pc.strftime('%Y-%m-%d %H:%M:%S.%f'), t_board))
+        log.write('\n')
+    log_writer.log_event(log_path, 'trigger train', 'trigger', f'{"off" if stop else "count"} {pulses} pulses', t_pc)
+    return pulses, t_board, t_pc
+
+def trigger_clock_fit(train):
+    '''
+    Map the board clock of a trigger train to the PC clock with a least-squares line through its samples, which takes
+    out the drift of the board crystal once the train has been sampled more than once
+    
+    Returns:
+        tuple: (PC time of the first rise, seconds on the PC clock per board second)
+    '''
+    board = []
+    offset = 0
+    for t_board, _ in train['samples']: # micros() wraps every 71.6 min, the samples are in order
+        if board and t_board + offset < board[-1]:
+            offset += 2**32
+        board.append(t_board + offset)
+    x = (np.array(board, dtype=float) - train['start']) / 1e6
+    t_ref = train['samples'][0][1]
+    y = np.array([(t_pc - t_ref).total_seconds() for _, t_pc in train['samples']])
+    if len(x) < 2 or x[-1] - x[0] < 60: # too short to tell the drift from the jitter of the USB link
+        return t_ref + timedelta(seconds=float(np.mean(y - x))), 1.0
+    slope, intercept = np.polyfit(x, y, 1)
+    return t_ref + timedelta(seconds=float(intercept)), float(slope)
+
+def trigger_frame_times(train, frames):
+    '''PC times of the rises of the given frame trigger pulses, 1 for the first pulse of the train'''
+    t_first, scale = trigger_clock_fit(train)
+    return [t_first + timedelta(seconds=(frame - 1) * train['period'] / 1e6 * scale) for frame in frames]
+
+def log_trigger_frames(log_path, train):
+    '''write the mapping of the frame number to the PC time of its trigger pulse to the log file'''
+    t_first, scale = trigger_clock_fit(train)
+    with log_writer.open_log(log_path) as log:
+        log.write('Trigger frame k at {} + (k-1) x {:.9f} s, {} pulses, from {} board clock samples\n'.format(
+            t_first.strftime('%Y-%m-%d %H:%M:%S.%f'), train['period'] / 1e6 * scale, train['pulses'], len(train['samples'])))
+        log.write('\n')
+    return 0
+
+STATUS_FLAGS = ['led', 'trig', 'pump', 'air', 'odor_a', 'odor_b', 'shock', 'shock_pin', 'pulse', 'train'] # order of the flags in the status line
+
+def query_status(ser, timeout=1):
+    '''
+    Snapshot all outputs of the board with a single "status" round trip
+    
+    Parameters:
+        ser: Serial port object
+        timeout (float): timeout in seconds
+        
+    Returns:
+        tuple: (status, other lines)
+            status (dict): {'t': board ms, 'op': current operation, 'rem': ms left of the operation, 'pwm': pump value,
+                'led', 'trig', 'pump', 'air', 'odor_a', 'odor_b', 'shock', 'shock_pin', 'pulse', 'train': 0/1 ('train' is
+                missing with firmware before the trigger train),
+                'leds': [{'op', 'rem', 'led', 'pulse'} of each LED channel, channel 0 being the 'op', 'rem', 'led', 'pulse' above]},
+                None if the firmware has no "status" command
+            other lines (list): feedback of earlier commands received before the status line
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Cannot query the board status.\n')
+        return None, []
+    ser.write(b'status\n')
+    other_lines = []
+    t_arduino = time.perf_counter()
+    while True:
+        if time.perf_counter() - t_arduino > timeout:
+            raise TimeoutError('Arduino timeout')
+        if ser.inWaiting() > 0:
+            fb = ser.readline().decode()[:-1]
+            if fb.startswith('Status '): # Status <ms> <operation> <ms left> <flags> <pump value> [<operation>,<ms left>,<LED><pulse> ...]
+                t_board, operation, remaining, flags, pump_value = fb.split()[1:6]
+                status = {'t': int(t_board), 'op': operation, 'rem': int(remaining), 'pwm': int(pump_value)}
+                status.update(zip(STATUS_FLAGS, map(int, flags)))
+                status['leds'] = [{'op': status['op'], 'rem': status['rem'], 'led': status['led'], 'pulse': status['pulse']}]
+                for channel in fb.split()[6:]: # the other LED channels
+                    operation, remaining, flags = channel.split(',')
+                    status['leds'].append({'op': operation, 'rem': int(remaining), 'led': int(flags[0]), 'pulse': int(flags[1])})
+                return status, other_lines
+            elif fb == 'Invalid Request': # firmware before the "status" command
+                return None, other_lines
+            other_lines.append(fb)
+
+
+EVENT_RECORD = struct.Struct('<IBB') # record of "events": board micros, pin, value, see dumpEvents() of the firmware
+OUTPUT_PINS = {3: 'pump', 5: 'LED', 6: 'LED ch1', 8: 'shock', 10: 'air', 11: 'odor_a', 12: 'odor_b', 14: 'trigger'} # arduino_communication_6
+
+def read_events(ser, timeout=5):
+    '''
+    Pull the output changes recorded by the board, chunk by chunk, until its ring buffer is empty
+    
+    Parameters:
+        ser: Serial port object
+        timeout (float): timeout in seconds of each chunk
+        
+    Returns:
+        tuple: (events, lost)
+            events (list): (board micros, pin, value, PC time) of each change in order, the PC time being estimated from
+                the board clock sent with each chunk; None if the firmware does not record events
+            lost (int): number of events overwritten in the ring buffer before they were pulled
+    '''
+    if ser == '':
+        print('\nSerial communication is unavailable. Cannot pull the events of the board.\n')
+        return None, 0
+    events = []
+    lost = 0
+    left = 1
+    while left > 0:
+        ser.write(b'events\n')
+        fb = wait_for_line(ser, ['Events ', 'Invalid Request'], timeout, 'events')
+        if fb == 'Invalid Request': # firmware before the event buffer
+            return None, 0
+        n, left, chunk_lost, t_board = map(int, fb.split()[1:5]) # Events <n> <left> <lost> <micros>
+        t_header = line_sent_time(ser, fb) # <micros> is read when the header starts, not when it has arrived
+        lost = max(lost, chunk_lost)
+        data = b''
+        t_arduino = time.perf_counter()
+        while len(data) < n * EVENT_RECORD.size:
+            if time.perf_counter() - t_arduino > timeout:
+                raise TimeoutError('Arduino timeout while reading the events')
+            data += ser.read(n * EVENT_RECORD.size - len(data))
+        for t_event, pin, value in EVENT_RECORD.iter_unpack(data):
+            age = ((t_board - t_event) & 0xFFFFFFFF) / 1e6 # micros() wraps every 71.6 min
+            events.append((t_event, pin, value, t_header - timedelta(seconds=age)))
+    return events, lost
+
+def log_events(log_path, events, lost=0):
+    '''write the output changes pulled by read_events() to the log file, one line per change'''
+    t_pull = EventTime.now()
+    with log_writer.open_log(log_path) as log:
+        log.write(f'Board output events pulled at {t_pull}: {len(events)} events'
+                  + (f', {lost} older events lost (ring buffer full)' if lost else '') + '\n')
+        for t_event, pin, value, t_pc in events:
+            state = 'ON' if value == 1 else 'OFF' if value == 0 else f'PWM {value}'
+            log.write(f'{OUTPUT_PINS.get(pin, f"pin {pin}")} {state} at {t_pc.strftime("%Y-%m-%d %H:%M:%S.%f")} (board {t_event} us)\n')
+        log.write('\n')
+    for t_event, pin, value, t_pc in events: # exact edges timed by the board clock
+        log_writer.log_event(log_path, 'board', OUTPUT_PINS.get(pin, f'pin {pin}'), 'on' if value == 1 else 'off' if value == 0 else value, t_pc)
     return 0
 
 
@@ -708,14 +1392,18 @@ def time_delay(delay,prefix='left:',suffix='s', print_left=True):
     delay in seconds
     prefix: string before the time left to print
     suffix: string after the time left to print
-    print_left: whether to print the notice of time left
+    print_left: whether to show the time left, rendered by the status thread (status_renderer.py)
     '''
-    t_start = time.time()
-    while True:
-        t_wait = time.time() - t_start
-        if t_wait >= delay:
-            break
-        if print_left: print(f'\r{prefix} {delay-t_wait:.2f} {suffix}',end='')
+    t_start = time.perf_counter()
+    if print_left: status_renderer.countdown(prefix, t_start + delay, suffix, digits=2)
+    try:
+        while True:
+            t_wait = time.perf_counter() - t_start
+            if t_wait >= delay:
+                break
+        if print_left: status_renderer.clear(f'{prefix} 0.00 {suffix}')
+    finally:
+        status_renderer.clear()
     if print_left: print()
     return 0
 
@@ -847,12 +1535,13 @@ def set_pin_value(ser, log_path, pin_index, value):
     # Send command format "pin:X:Y" where X is pin index and Y is value
     cmd = 'pin:{}:{}\n'.format(pin_index, value)
     ser.write(cmd.encode('utf-8'))
-    t_pin = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_pin = EventTime.now()
     
     # Log the command but don't wait for feedback
-    with open(log_path, 'a') as log:
+    with log_writer.open_log(log_path) as log:
         log.write('Pin command sent at {}: pin {} set to {}\n'.format(t_pin, pin_index, value))
         log.write('\n')
+    log_writer.log_event(log_path, 'pin', f'pin {pin_index}', value, t_pin)
     
     # Use HIGH/LOW in output message if the value is 0 or 1
     if value == 0:
@@ -879,7 +1568,7 @@ def play_bell_sound(log_path, duration=500):
     import platform
     current_os = platform.system()
     
-    t_bell = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+    t_bell = EventTime.now()
     
     try:
         # Different implementations based on the OS
@@ -897,9 +1586,10 @@ def play_bell_sound(log_path, duration=500):
             time.sleep(duration/1000)  # Convert ms to seconds
             
         # Log the bell event
-        with open(log_path, 'a') as log:
+        with log_writer.open_log(log_path) as log:
             log.write('Bell sound played at {}\n'.format(t_bell))
             log.write('\n')
+        log_writer.log_event(log_path, 'bell', 'speaker', f'{duration} ms', t_bell)
             
         print('Bell sound played')
         return 0
@@ -907,7 +1597,7 @@ def play_bell_sound(log_path, duration=500):
         print(f'Error playing bell sound: {str(e)}')
         
         # Log the error
-        with open(log_path, 'a') as log:
+        with log_writer.open_log(log_path) as log:
             log.write('Error playing bell sound at {}: {}\n'.format(t_bell, str(e)))
             log.write('\n')
         
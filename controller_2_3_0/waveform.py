@@ -0,0 +1,159 @@
+'''
+Waveform tables played by the Arduino board: bursts, PWM ramps and randomized pulse trains
+
+A pattern is compiled into a table of (t_us, pin, value) events, t_us being the time from the start of the pattern
+in microseconds and value 0/1 for digital writes or 2-255 for PWM. The table is uploaded in "wave:add:" lines that
+fit the 64-byte command buffer of the firmware, and played by the board on its micros() clock with "wave:play".
+
+Usage:
+    events = compile_pattern('burst', pin=5, bursts=3, pulses=5, frequency=20, width=10, interval=1)
+    commands = encode_commands(events)
+    # REPL: wave:burst:pin=5,bursts=3,pulses=5,frequency=20,width=10,interval=1
+'''
+import inspect
+import numpy as np
+
+MAX_EVENTS = 64 # size of the waveform table of the firmware
+LINE_SIZE = 63 # longest command accepted by the firmware, without the "\n"
+PWM_PINS = [3, 5, 6, 9, 10, 11] # PWM-capable pins of the Arduino Uno
+
+
+def burst(pin=5, bursts=3, pulses=5, frequency=20, width=10, interval=1.0):
+    '''
+    Bursts of square pulses
+
+    Parameters:
+        pin (int): output pin
+        bursts (int): number of bursts
+        pulses (int): number of pulses per burst
+        frequency (float): pulse frequency within a burst (Hz)
+        width (float): pulse width (ms)
+        interval (float): time from the start of a burst to the start of the next one (s)
+    '''
+    period_us = 1e6 / frequency
+    if width * 1000 >= period_us:
+        raise ValueError(f'Pulse width {width} ms is not shorter than the pulse period {period_us/1000:.3f} ms')
+    if bursts > 1 and (pulses - 1) * period_us + width * 1000 >= interval * 1e6:
+        raise ValueError(f'A burst of {pulses} pulses at {frequency} Hz does not fit in the burst interval {interval} s')
+    events = []
+    for b in range(int(bursts)):
+        for k in range(int(pulses)):
+            t_on = b * interval * 1e6 + k * period_us
+            events.append((t_on, pin, 1))
+            events.append((t_on + width * 1000, pin, 0))
+    return events
+
+
+def ramp(pin=5, duration=2.0, start=0, end=255, steps=50):
+    '''
+    Linear PWM ramp, the output is switched off at the end
+
+    Parameters:
+        pin (int): PWM-capable output pin
+        duration (float): duration of the ramp (s)
+        start (int): PWM value at the start (0-255)
+        end (int): PWM value at the end (0-255)
+        steps (int): number of PWM changes
+    '''
+    if pin not in PWM_PINS:
+        raise ValueError(f'Pin {pin} is not a PWM pin, use one of {PWM_PINS}')
+    if not (0 <= start <= 255 and 0 <= end <= 255):
+        raise ValueError('PWM values must be between 0-255')
+    times = np.linspace(0, duration * 1e6, int(steps), endpoint=False)
+    values = np.rint(np.linspace(start, end, int(steps))).astype(int)
+    events = [(t, pin, int(v)) for t, v in zip(times, values)]
+    events.append((duration * 1e6, pin, 0))
+    return events
+
+
+def random_train(pin=5, duration=5.0, rate=5, width=10, refractory=50, seed=None):
+    '''
+    Pulses at random (Poisson) intervals
+
+    Parameters:
+        pin (int): output pin
+        duration (float): duration of the train (s)
+        rate (float): mean pulse rate (Hz)
+        width (float): pulse width (ms)
+        refractory (float): shortest time from the end of a pulse to the start of the next one (ms)
+        seed (int): seed of the random intervals, None for a new train every time
+    '''
+    rng = np.random.default_rng(None if seed is None else int(seed))
+    events = []
+    t_on = rng.exponential(1e6 / rate)
+    while t_on + width * 1000 <= duration * 1e6:
+        events.append((t_on, pin, 1))
+        events.append((t_on + width * 1000, pin, 0))
+        t_on += max(rng.exponential(1e6 / rate), (width + refractory) * 1000)
+    return events
+
+
+PATTERNS = {
+    'burst': burst,
+    'ramp': ramp,
+    'random': random_train,
+}
+
+
+def parse_pattern(text):
+    '''
+    Parse "<kind>:<name>=<value>,..." of the REPL command "wave:<kind>:<name>=<value>,..."
+
+    Returns:
+        tuple: (kind, {name: value}), values converted to int or float
+    '''
+    kind, _, args = text.partition(':')
+    if kind not in PATTERNS:
+        raise ValueError(f'Unknown waveform "{kind}", available: {list(PATTERNS.keys())}')
+    params = {}
+    for arg in filter(None, args.replace(' ', '').split(',')):
+        name, _, value = arg.partition('=')
+        if name not in inspect.signature(PATTERNS[kind]).parameters:
+            raise ValueError(f'Unknown parameter "{name}" of waveform "{kind}"')
+        try:
+            params[name] = int(value) if value.lstrip('-').isnumeric() else float(value)
+        except ValueError:
+            raise ValueError(f'Invalid value of "{name}": {value}')
+    return kind, params
+
+
+def compile_pattern(kind, **params):
+    '''
+    Compile a pattern into its event table
+
+    Returns:
+        list: (t_us, pin, value) events sorted by time, t_us as int
+    '''
+    events = sorted((int(round(t)), int(pin), int(value)) for t, pin, value in PATTERNS[kind](**params))
+    if not events:
+        raise ValueError('The waveform has no events')
+    if len(events) > MAX_EVENTS:
+        raise ValueError(f'The waveform has {len(events)} events, the board holds at most {MAX_EVENTS}')
+    return events
+
+
+def duration(events):
+    '''duration of an event table in seconds'''
+    return events[-1][0] / 1e6 if events else 0
+
+
+def encode_commands(events, line_size=LINE_SIZE):
+    '''
+    Encode an event table as "wave:add:<dt_us>,<pin>,<value>;..." lines, dt_us being the time from the previous event
+
+    Returns:
+        list: command lines without "\\n", each at most line_size characters
+    '''
+    commands = []
+    line = ''
+    t_last = 0
+    for t, pin, value in events:
+        item = f'{t - t_last},{pin},{value}'
+        t_last = t
+        if line and len(line) + 1 + len(item) > line_size:
+            commands.append(line)
+            line = ''
+        line = f'{line};{item}' if line else f'wave:add:{item}'
+    if line:
+        commands.append(line)
+    return commands